@@ -275,6 +275,16 @@ document.addEventListener("DOMContentLoaded", () => {
 			}
 		})
 		
+		let inlineRateTimeout = null
+		window.electronAPI.onInlineVideoSyncRate((data) => {
+			if (!videoPlayer) return
+			clearTimeout(inlineRateTimeout)
+			videoPlayer.playbackRate = data.rate
+			inlineRateTimeout = setTimeout(() => {
+				if (videoPlayer) videoPlayer.playbackRate = 1
+			}, data.durationMs)
+		})
+		
 		window.electronAPI.onInlineVideoSyncPlaying((data) => {
 			if (!videoPlayer) return
 			if (data.isPlaying && videoPlayer.paused) {
@@ -44,7 +44,14 @@ let wss
 let USER 
 let hasMoreMessages = true
 let isLoadingMessages = false
-let oldestMessageId = null
+// opaque cursor from the last history page, load_more_messages sends it back as is
+let nextHistoryCursor = null
+let watchersState = new Map()
+let watchersVersion = 0
+// when a watchers_resync went out (0 = none), deltas are dropped until its snapshot
+// arrives; after WATCHERS_RESYNC_RETRY_MS without one (e.g. rate limited) it can go again
+let watchersResyncAt = 0
+const WATCHERS_RESYNC_RETRY_MS = 5000
 let isConnecting = false
 let reconnectTimeout = null
 let connectionTimeout = null 
@@ -936,10 +943,24 @@ document.addEventListener("DOMContentLoaded", async () => {
 	
 
 	let reconnectAttempts = 0
-	let lastMessageDate = 0
+	// from room_info, reconnects send it instead of the passwords
+	let sessionToken = null
+	// newest message id seen, reconnects ask for what came after it
+	let lastMessageId = 0
 	let waitingForMessage = 0
 	let consecutiveSendTimeouts = 0
 
+	function clearChatMessages() {
+		const messagesEl = document.getElementById("chat-content")
+		if (messagesEl) messagesEl.innerHTML = ''
+		messagesById.clear()
+		messageReactions.clear()
+		messageHandlers.clear()
+		nextHistoryCursor = null
+		hasMoreMessages = true
+		lastMessageId = 0
+	}
+
 	function connectWebSocket(reconnectDelay=0) {
 		if (isConnecting) {
 			loggerWss.warn('Connection attempt already in progress')
@@ -974,12 +995,16 @@ document.addEventListener("DOMContentLoaded", async () => {
 					return
 				}
 				
-				const queryParams = new URLSearchParams({
+				const queryParams = new URLSearchParams(sessionToken ? {
+					token: sessionToken,
+					roomid: ROOM_ID,
+					lastMessageId: lastMessageId
+				} : {
 					user: USER,
 					psw: USER_PSW,
 					roomid: ROOM_ID,
 					roompsw: ROOM_PSW,
-					lastMessageDate: lastMessageDate
+					lastMessageId: lastMessageId
 				}).toString()
 				
 				try {
@@ -1116,6 +1141,7 @@ document.addEventListener("DOMContentLoaded", async () => {
 			// loggerWss.debug("Message received", data)
 
 			if (data.type == "room_info") {
+				if (data.session_token) sessionToken = data.session_token
 				const safeRoomName = escapeHtml(data.room_name)
 				if (chatRoomName) chatRoomName.innerHTML = `Chat - ${safeRoomName}`
 				if (inputRoomName) inputRoomName.innerHTML = `Watch Video - ${safeRoomName}`
@@ -1132,9 +1158,30 @@ document.addEventListener("DOMContentLoaded", async () => {
 				handleReactionRemoval(data)
 			} else if (data.type == "message_deleted") {
 				handleMessageDeletion(data)
+			} else if (data.type == "history_gap") {
+				// too much was missed to catch up, the latest page follows this
+				loggerWss.info('History gap after reconnect, reloading latest messages')
+				clearChatMessages()
+			} else if (data.type == "room_history" && data.is_catchup) {
+				// messages missed while reconnecting, newer than anything shown, so they go
+				// below like live ones and leave the paging state alone
+				data.messages.forEach((message) => {
+					if (message.message_type === "new_reaction") {
+						// removed reactions come without a target
+						if (message.reply_to?.id) {
+							addMessage({ ...message, reply_to: message.reply_to.id }, true)
+						}
+					} else {
+						addMessage(message, true)
+					}
+				})
+				if (data.catchup_more) {
+					sendSafe({ type: "catchup_more", after_id: data.last_message_id })
+				}
 			} else if (data.type == "room_history") {
 				const isPagination = data.is_pagination || false
 				hasMoreMessages = data.has_more || false
+				nextHistoryCursor = data.next_cursor || null
 				
 				if (isPagination) {
 					const messagesContainer = document.getElementById("chat-content")
@@ -1201,29 +1248,28 @@ document.addEventListener("DOMContentLoaded", async () => {
 					})
 				}
 				
-				if (data.messages.length > 0) {
-					const actualMessages = data.messages.filter(msg => msg.message_type === "new_message")
-					
-					if (actualMessages.length > 0) {
-						if (isPagination) {
-							const oldestActualMessage = actualMessages.reduce((oldest, msg) => 
-								msg.id < oldest.id ? msg : oldest
-							)
-							if (!oldestMessageId || oldestActualMessage.id < oldestMessageId) {
-								oldestMessageId = oldestActualMessage.id
-							}
-						} else {
-							const firstActualMessage = actualMessages[0]
-							oldestMessageId = firstActualMessage.id
-						}
-					}
-				}
-				
 				isLoadingMessages = false
 			} else if (data.type == "user_image") {
 				cacheUserImage(data.username, data.imageurl || '')
 			} else if (data.type == "watchers_update") {
+				watchersState = new Map(data.watchers.map(w => [w.username, w]))
+				watchersVersion = data.version || 0
+				watchersResyncAt = 0
 				updateWatchersList(data.watchers)
+			} else if (data.type == "watchers_delta") {
+				if (watchersResyncAt && Date.now() - watchersResyncAt < WATCHERS_RESYNC_RETRY_MS) {
+					// the snapshot on its way supersedes it
+				} else if (data.version == watchersVersion + 1) {
+					watchersVersion = data.version
+					data.changed.forEach(w => watchersState.set(w.username, w))
+					data.removed.forEach(u => watchersState.delete(u))
+					updateWatchersList(Array.from(watchersState.values()))
+				} else if (data.version > watchersVersion) {
+					loggerWss.warn(`watchers version gap: have ${watchersVersion} got ${data.version}, resyncing`)
+					if (sendSafe({ type: "watchers_resync" })) {
+						watchersResyncAt = Date.now()
+					}
+				}
 			} else if (data.type == "video_history") {
 				loggerWss.info("Received video_history:", data.history)
 				if (window.handleVideoHistory) {
@@ -1263,6 +1309,11 @@ document.addEventListener("DOMContentLoaded", async () => {
 			
 			isConnecting = false
 			
+			if (ev.reason === "Invalid session token") {
+				// expired, or a password changed since it was issued
+				sessionToken = null
+			}
+			
 			const shouldReconnect = ev.code !== 1000 && 
 				ev.reason !== "New connection established" &&
 				wasCurrentSocket
@@ -1357,7 +1408,7 @@ document.addEventListener("DOMContentLoaded", async () => {
 	updateTypingIndicator([])
 
 	function loadMoreMessages() {
-		if (!oldestMessageId || isLoadingMessages || !hasMoreMessages) {
+		if (!nextHistoryCursor || isLoadingMessages || !hasMoreMessages) {
 			return
 		}
 		
@@ -1366,10 +1417,10 @@ document.addEventListener("DOMContentLoaded", async () => {
 		if (wss && wss.readyState === WebSocket.OPEN) {
 			const data = {
 				type: "load_more_messages",
-				before_message_id: oldestMessageId
+				cursor: nextHistoryCursor
 			}
 			if (sendSafe(data)) {
-				loggerWss.debug(`Loading more messages before ID: ${oldestMessageId}`)
+				loggerWss.debug(`Loading more messages before cursor: ${nextHistoryCursor}`)
 			} else {
 				loggerWss.error('loadMoreMessages: failed to request more messages')
 			}
@@ -1489,8 +1540,8 @@ document.addEventListener("DOMContentLoaded", async () => {
 		const isDeleted = data.is_deleted || false
 		const messageTimestamp = data.date || Math.floor(Date.now() / 1000)
 		
-		if (messageTimestamp && messageTimestamp > lastMessageDate) {
-			lastMessageDate = messageTimestamp
+		if (messageId && messageId > lastMessageId) {
+			lastMessageId = messageId
 		}
 		
 		const fulldate = new Date(messageTimestamp * 1000)
@@ -593,7 +593,7 @@ const connectVideoSyncWS = async () => {
 		} else if (isVLCwatching) {
 			try {
 				const info = await getInfo()
-				const currentTime = Math.floor(parseFloat(info.data.length) * parseFloat(info.data.position))
+				const currentTime = parseFloat(info.data.length) * parseFloat(info.data.position)
 				const diff = Math.abs(currentTime - time)
 				if (passive) {
 					if (diff > TIME_SYNC_TOLERANCE + 8) {
@@ -626,6 +626,14 @@ const connectVideoSyncWS = async () => {
 		}
 	}
 	
+	videoSyncManager.onRateChange = async (rate, durationMs) => {
+		if (isInlineWatching) {
+			mainWindow.webContents.send('inline-video-sync-rate', { rate, durationMs })
+		} else if (isVLCwatching) {
+			await setRateVLC(rate, durationMs)
+		}
+	}
+	
 	videoSyncManager.onSubtitleAvailable = async () => {
 		logger.info('Subtitle available, auto-downloading...')
 		await requestSubtitle()
@@ -729,8 +737,9 @@ const makeRequest_videoSync = async (type, data = {}) => {
 		
 		if (result && result.type === 'ack') {
 			if (!result.success && result.error && result.error.includes('not authorized')) {
-				logger.debug('Update rejected, requesting sync...')
-				await videoSyncManager.requestSync()
+				// the monitor loop fetches the room state, applies it and sends imuptodate
+				logger.debug('Update rejected, resyncing...')
+				isClientUpToDate = false
 				return { status: false, error: 'User not up to date' }
 			}
 			return { status: result.success, data: { status: result.success } }
@@ -1117,7 +1126,7 @@ const setTimeVLC = async (time) => {
 				return true
 			}
 			await axios.post(
-				`http://127.0.0.1:${VLC_PORT}/requests/status.json?command=seek&val=${time}`,
+				`http://127.0.0.1:${VLC_PORT}/requests/status.json?command=seek&val=${Math.floor(time)}`,
 				null,
 				{ auth: { username: '', password: VLC_HTTP_PASS } }
 			)
@@ -1144,6 +1153,25 @@ const setTimeVLC = async (time) => {
 	return false
 }
 
+let vlcRateTimeout = null
+// soft drift correction from the server: play at rate for durationMs, then back to 1.0
+const setRateVLC = async (rate, durationMs) => {
+	clearTimeout(vlcRateTimeout)
+	const send = async (val) => {
+		try {
+			await axios.post(
+				`http://127.0.0.1:${VLC_PORT}/requests/status.json?command=rate&val=${val}`,
+				null,
+				{ auth: { username: '', password: VLC_HTTP_PASS } }
+			)
+		} catch (error) {
+			logger.debug("Failed to set rate:", error.message)
+		}
+	}
+	await send(rate)
+	vlcRateTimeout = setTimeout(() => send(1), durationMs)
+}
+
 const setPlayingVLC = async (is_playing) => {
 	const command = is_playing ? "pl_play" : "pl_pause"
 	
@@ -1715,7 +1743,8 @@ const startVLCMonitoring = async () => {
 				currentState = stateVLC
 			}
 			
-			const timeVLC = Math.floor(parseFloat(infoVLC.data.length) * parseFloat(infoVLC.data.position))
+			// fractional, v2 sends it in milliseconds and the protocol floors it for v1
+			const timeVLC = parseFloat(infoVLC.data.length) * parseFloat(infoVLC.data.position)
 			if (currentTime === undefined || lastSentTime === undefined){
 				currentTime = timeVLC
 				lastSentTime = timeVLC
@@ -1726,7 +1755,7 @@ const startVLCMonitoring = async () => {
 				status: isplayingVLC ? 'playing' : 'paused',
 				isPlaying: isplayingVLC
 			}, {
-				currentTime: timeVLC,
+				currentTime: Math.floor(timeVLC),
 				isUpToDate: isClientUpToDate
 			})
 
@@ -67,6 +67,11 @@ contextBridge.exposeInMainWorld('electronAPI', {
 			callback(data)
 		})
 	},
+	onInlineVideoSyncRate: (callback) => {
+		ipcRenderer.on('inline-video-sync-rate', (_, data) => {
+			callback(data)
+		})
+	},
 	onInlineVideoSyncPlaying: (callback) => {
 		ipcRenderer.on('inline-video-sync-playing', (_, data) => {
 			callback(data)
@@ -3,8 +3,10 @@ import aiomysql
 import logging
 from os import getenv
 from dotenv import load_dotenv
-from bcrypt import checkpw
+from credentials import verifier
 from datetime import datetime
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
 
 load_dotenv()
 
@@ -54,8 +56,8 @@ async def check_user(user: str, psw: str) -> bool:
 			async with conn.cursor() as cursor:
 				await cursor.execute("SELECT password_hash FROM users WHERE user = %s", (user,))
 				result = await cursor.fetchone()
-				if result and checkpw(psw.encode(), result[0].encode()):
-					return True
+		if result and await verifier.verify(f"user:{user}", psw, result[0]):
+			return True
 		return False
 	except Exception as e:
 		logger.error(f"check_user error: {e}")
@@ -70,8 +72,8 @@ async def check_room(roomid: str, roompsw: str) -> bool:
 			async with conn.cursor() as cursor:
 				await cursor.execute("SELECT password_hash FROM rooms WHERE roomid = %s", (roomid,))
 				result = await cursor.fetchone()
-				if result and checkpw(roompsw.encode(), result[0].encode()):
-					return True
+		if result and await verifier.verify(f"room:{roomid}", roompsw, result[0]):
+			return True
 		return False
 	except Exception as e:
 		logger.error(f"check_room error: {e}")
@@ -86,13 +88,52 @@ async def check_room_get_name(roomid: str, roompsw: str):
 			async with conn.cursor() as cursor:
 				await cursor.execute("SELECT password_hash, name FROM rooms WHERE roomid = %s", (roomid,))
 				result = await cursor.fetchone()
-				if result and checkpw(roompsw.encode(), result[0].encode()):
-					return result[1]
+		if result and await verifier.verify(f"room:{roomid}", roompsw, result[0]):
+			return result[1]
 		return False
 	except Exception as e:
 		logger.error(f"check_room_get_name error: {e}")
 		return False
 
+async def fetch_password_hashes(user: str, roomid: str):
+	# (user hash, room hash) for session token epochs, no bcrypt involved
+	if not user or not roomid:
+		return None
+	try:
+		p = await get_pool()
+		async with p.acquire() as conn:
+			async with conn.cursor() as cursor:
+				await cursor.execute(
+					"SELECT u.password_hash, r.password_hash FROM users u JOIN rooms r ON r.roomid = %s WHERE u.user = %s",
+					(roomid, user)
+				)
+				return await cursor.fetchone()
+	except Exception as e:
+		logger.error(f"fetch_password_hashes error: {e}")
+		return None
+
+async def _fetch_hashes(query: str, keys: list):
+	# {key: password_hash} for the keys that still exist, None on a db error
+	found = {}
+	try:
+		p = await get_pool()
+		async with p.acquire() as conn:
+			async with conn.cursor() as cursor:
+				for i in range(0, len(keys), 500):
+					chunk = keys[i:i + 500]
+					await cursor.execute(query.format(",".join(["%s"] * len(chunk))), chunk)
+					found.update(await cursor.fetchall())
+		return found
+	except Exception as e:
+		logger.error(f"_fetch_hashes error: {e}")
+		return None
+
+async def fetch_user_hashes(users: list):
+	return await _fetch_hashes("SELECT user, password_hash FROM users WHERE user IN ({})", users)
+
+async def fetch_room_hashes(roomids: list):
+	return await _fetch_hashes("SELECT roomid, password_hash FROM rooms WHERE roomid IN ({})", roomids)
+
 async def get_user_image(username: str) -> str:
 	if not username:
 		return ""
@@ -148,27 +189,30 @@ async def add_to_history(roomid: str, user: str, url: str, success: bool):
 		logger.error(f"add_to_history error: {e}")
 		return None
 
+async def fetch_video_history(roomid: str, limit: int = 15):
+	p = await get_pool()
+	async with p.acquire() as conn:
+		async with conn.cursor() as cursor:
+			await cursor.execute(
+				"SELECT id, user, link, success, created_at FROM room_history WHERE roomid = %s ORDER BY created_at DESC LIMIT %s",
+				(roomid, limit)
+			)
+			results = await cursor.fetchall()
+			history = []
+			for row in results:
+				entry = {
+					"id": row[0],
+					"user": row[1],
+					"url": row[2],
+					"success": bool(row[3]),
+					"date": row[4].strftime("%Y-%m-%d %H:%M") if row[4] else ""
+				}
+				history.append(entry)
+			return history
+
 async def get_video_history(roomid: str, limit: int = 15):
 	try:
-		p = await get_pool()
-		async with p.acquire() as conn:
-			async with conn.cursor() as cursor:
-				await cursor.execute(
-					"SELECT id, user, link, success, created_at FROM room_history WHERE roomid = %s ORDER BY created_at DESC LIMIT %s",
-					(roomid, limit)
-				)
-				results = await cursor.fetchall()
-				history = []
-				for row in results:
-					entry = {
-						"id": row[0],
-						"user": row[1],
-						"url": row[2],
-						"success": bool(row[3]),
-						"date": row[4].strftime("%Y-%m-%d %H:%M") if row[4] else ""
-					}
-					history.append(entry)
-				return history
+		return await fetch_video_history(roomid, limit)
 	except Exception as e:
 		logger.error(f"get_video_history error: {e}")
 		return []
@@ -187,15 +231,62 @@ async def insert_message(roomid: str, user: str, message: str, message_type: str
 		logger.error(f"insert_message error: {e}")
 		return None
 
-async def get_message_by_id(message_id: int):
+async def insert_messages(rows) -> bool:
+	# rows: [(id, roomid, user, message, message_type, reply_to)], one multi-row INSERT
+	if not rows:
+		return True
 	try:
 		p = await get_pool()
 		async with p.acquire() as conn:
 			async with conn.cursor() as cursor:
+				placeholders = ','.join(['(%s, %s, %s, %s, %s, %s)'] * len(rows))
 				await cursor.execute(
-					"SELECT user, message, removed FROM messages WHERE id = %s",
-					(message_id,)
+					f"INSERT INTO messages (id, roomid, user, message, message_type, reply_to) VALUES {placeholders}",
+					[value for row in rows for value in row]
 				)
+				return True
+	except Exception as e:
+		logger.error(f"insert_messages error: {e}")
+		return False
+
+async def init_message_ids():
+	# ids come from a counter row, not MAX(id), so several writers never hand out the same
+	# one. rows written before the counter existed (or by auto increment) stay below it
+	p = await get_pool()
+	async with p.acquire() as conn:
+		async with conn.cursor() as cursor:
+			await cursor.execute("CREATE TABLE IF NOT EXISTS id_counters (name VARCHAR(32) PRIMARY KEY, next_id BIGINT UNSIGNED NOT NULL)")
+			await cursor.execute(
+				"INSERT INTO id_counters (name, next_id) SELECT 'messages', m.next_id FROM (SELECT COALESCE(MAX(id), 0) + 1 AS next_id FROM messages) AS m "
+				"ON DUPLICATE KEY UPDATE next_id = GREATEST(id_counters.next_id, m.next_id)"
+			)
+
+async def reserve_message_ids(count: int) -> int:
+	# moves the counter past count ids in one statement and returns the first of them;
+	# LAST_INSERT_ID(expr) is per connection, so the SELECT sees this UPDATE's value
+	p = await get_pool()
+	async with p.acquire() as conn:
+		async with conn.cursor() as cursor:
+			await cursor.execute("UPDATE id_counters SET next_id = LAST_INSERT_ID(next_id + %s) WHERE name = 'messages'", (count,))
+			await cursor.execute("SELECT LAST_INSERT_ID()")
+			result = await cursor.fetchone()
+			return int(result[0]) - count
+
+async def get_message_by_id(message_id: int, roomid: str = None):
+	try:
+		p = await get_pool()
+		async with p.acquire() as conn:
+			async with conn.cursor() as cursor:
+				if roomid is None:
+					await cursor.execute(
+						"SELECT user, message, removed FROM messages WHERE id = %s",
+						(message_id,)
+					)
+				else:
+					await cursor.execute(
+						"SELECT user, message, removed FROM messages WHERE id = %s AND roomid = %s",
+						(message_id, roomid)
+					)
 				return await cursor.fetchone()
 	except Exception as e:
 		logger.error(f"get_message_by_id error: {e}")
@@ -241,12 +332,15 @@ async def get_existing_reaction(roomid: str, user: str, reply_to: int):
 		logger.error(f"get_existing_reaction error: {e}")
 		return None
 
-async def update_reaction(reaction_id: int, emoji = None, removed = None):
+async def update_reaction(reaction_id: int, emoji = None, removed = None, date: float = None):
+	# date (unix time) moves the reaction's timestamp along with a re-set emoji
 	try:
 		p = await get_pool()
 		async with p.acquire() as conn:
 			async with conn.cursor() as cursor:
-				if emoji is not None and removed is not None:
+				if emoji is not None and removed is not None and date is not None:
+					await cursor.execute("UPDATE messages SET message = %s, removed = %s, date = FROM_UNIXTIME(%s) WHERE id = %s", (emoji, removed, date, reaction_id))
+				elif emoji is not None and removed is not None:
 					await cursor.execute("UPDATE messages SET message = %s, removed = %s WHERE id = %s", (emoji, removed, reaction_id))
 				elif removed is not None:
 					await cursor.execute("UPDATE messages SET removed = %s WHERE id = %s", (removed, reaction_id))
@@ -255,104 +349,186 @@ async def update_reaction(reaction_id: int, emoji = None, removed = None):
 		logger.error(f"update_reaction error: {e}")
 		return False
 
-async def get_messages_history(roomid: str, last_message_date: float = 0, before_message_id = None, limit: int = 15):
+def _reply_data(reply_id: int, target):
+	user, message, removed = target
+	if removed:
+		return {"id": reply_id, "user": user, "message": None, "is_deleted": True}
+	return {"id": reply_id, "user": user, "message": message, "is_deleted": False}
+
+async def _fetch_reply_targets(cursor, message_ids) -> dict:
+	message_ids = list(message_ids)
+	placeholders = ','.join(['%s'] * len(message_ids))
+	await cursor.execute(
+		f"SELECT id, user, message, removed FROM messages WHERE id IN ({placeholders})",
+		message_ids
+	)
+	return {row[0]: (row[1], row[2], row[3]) for row in await cursor.fetchall()}
+
+def encode_history_cursor(message_id: int) -> str:
+	return urlsafe_b64encode(f"m{message_id}".encode()).decode("ascii").rstrip("=")
+
+def decode_history_cursor(cursor: str):
 	try:
-		p = await get_pool()
-		async with p.acquire() as conn:
-			async with conn.cursor() as cursor:
-				if last_message_date > 0:
-					await cursor.execute(
-						"SELECT id, user, message, message_type, date, reply_to, removed FROM messages WHERE roomid = %s AND UNIX_TIMESTAMP(date) > %s ORDER BY id ASC",
-						(roomid, last_message_date)
-					)
-				elif before_message_id:
-					await cursor.execute(
-						"SELECT id, user, message, message_type, date, reply_to, removed FROM messages WHERE roomid = %s AND id < %s AND message_type = 'new_message' ORDER BY id DESC LIMIT %s",
-						(roomid, before_message_id, limit)
-					)
-				else:
-					await cursor.execute(
-						"SELECT id, user, message, message_type, date, reply_to, removed FROM messages WHERE roomid = %s AND message_type = 'new_message' ORDER BY id DESC LIMIT %s",
-						(roomid, limit)
-					)
-				message_rows = await cursor.fetchall()
-				
-				reaction_rows = []
-				if message_rows:
-					message_ids = [str(row[0]) for row in message_rows]
-					if message_ids:
-						placeholders = ','.join(['%s'] * len(message_ids))
-						await cursor.execute(
-							f"SELECT id, user, message, message_type, date, reply_to, removed FROM messages WHERE roomid = %s AND message_type = 'new_reaction' AND reply_to IN ({placeholders})",
-							[roomid] + message_ids
-						)
-						reaction_rows = await cursor.fetchall()
-				
-				all_rows = list(message_rows) + list(reaction_rows)
-				all_rows.sort(key=lambda x: x[0])
-				
-				if before_message_id:
-					all_rows = list(reversed(all_rows))
-				
-				messages = []
-				for row in all_rows:
-					thedate = row[4].timestamp() if row[4] else 0
-					reply_to_data = None
-					
-					if row[5]:
-						await cursor.execute("SELECT user, message, removed FROM messages WHERE id = %s", (row[5],))
-						reply_result = await cursor.fetchone()
-						if reply_result:
-							if reply_result[2]:
-								reply_to_data = {"id": row[5], "user": reply_result[0], "message": None, "is_deleted": True}
-							else:
-								reply_to_data = {"id": row[5], "user": reply_result[0], "message": reply_result[1], "is_deleted": False}
-					
-					messages.append({
-						"id": row[0],
-						"user": row[1],
-						"message": row[2],
-						"message_type": row[3],
-						"date": thedate,
-						"reply_to": reply_to_data if not bool(row[6]) else None,
-						"is_deleted": bool(row[6])
-					})
-				
-				has_more = False
-				if limit and len(message_rows) == limit:
-					oldest_id = min(row[0] for row in message_rows)
+		raw = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("ascii")
+		if not raw.startswith("m"):
+			return None
+		message_id = int(raw[1:])
+		return message_id if message_id > 0 else None
+	except (ValueError, UnicodeError, BinasciiError):
+		return None
+
+async def _build_messages(cursor, rows) -> list:
+	# reply targets: rows already in the page resolve in memory, the rest in one query
+	targets = {row[0]: (row[1], row[2], row[6]) for row in rows}
+	missing_ids = {row[5] for row in rows if row[5] and not row[6] and row[5] not in targets}
+	if missing_ids:
+		targets.update(await _fetch_reply_targets(cursor, missing_ids))
+	
+	messages = []
+	for row in rows:
+		thedate = row[4].timestamp() if row[4] else 0
+		reply_to_data = None
+		
+		if row[5] and not row[6] and row[5] in targets:
+			reply_to_data = _reply_data(row[5], targets[row[5]])
+		
+		messages.append({
+			"id": row[0],
+			"user": row[1],
+			"message": row[2],
+			"message_type": row[3],
+			"date": thedate,
+			"reply_to": reply_to_data,
+			"is_deleted": bool(row[6])
+		})
+	return messages
+
+async def fetch_messages_history(roomid: str, before_message_id = None, limit: int = 15):
+	p = await get_pool()
+	async with p.acquire() as conn:
+		async with conn.cursor() as cursor:
+			# one extra row tells us if there is an older page, no COUNT(*) over the index range
+			if before_message_id:
+				await cursor.execute(
+					"SELECT id, user, message, message_type, date, reply_to, removed FROM messages WHERE roomid = %s AND id < %s AND message_type = 'new_message' ORDER BY id DESC LIMIT %s",
+					(roomid, before_message_id, limit + 1)
+				)
+			else:
+				await cursor.execute(
+					"SELECT id, user, message, message_type, date, reply_to, removed FROM messages WHERE roomid = %s AND message_type = 'new_message' ORDER BY id DESC LIMIT %s",
+					(roomid, limit + 1)
+				)
+			message_rows = await cursor.fetchall()
+			
+			has_more = False
+			next_cursor = None
+			if len(message_rows) > limit:
+				message_rows = message_rows[:limit]
+				has_more = True
+			if has_more and message_rows:
+				next_cursor = encode_history_cursor(min(row[0] for row in message_rows))
+			
+			reaction_rows = []
+			if message_rows:
+				message_ids = [str(row[0]) for row in message_rows]
+				if message_ids:
+					placeholders = ','.join(['%s'] * len(message_ids))
 					await cursor.execute(
-						"SELECT COUNT(*) FROM messages WHERE roomid = %s AND id < %s AND message_type = 'new_message'",
-						(roomid, oldest_id)
+						f"SELECT id, user, message, message_type, date, reply_to, removed FROM messages WHERE roomid = %s AND message_type = 'new_reaction' AND reply_to IN ({placeholders})",
+						[roomid] + message_ids
 					)
-					count_result = await cursor.fetchone()
-					has_more = count_result[0] > 0 if count_result else False
-				
-				return messages, has_more, before_message_id is not None
+					reaction_rows = await cursor.fetchall()
+			
+			all_rows = list(message_rows) + list(reaction_rows)
+			all_rows.sort(key=lambda x: x[0])
+			
+			if before_message_id:
+				all_rows = list(reversed(all_rows))
+			
+			messages = await _build_messages(cursor, all_rows)
+			return messages, has_more, before_message_id is not None, next_cursor
+
+async def get_messages_history(roomid: str, before_message_id = None, limit: int = 15):
+	try:
+		return await fetch_messages_history(roomid, before_message_id, limit)
 	except Exception as e:
 		logger.error(f"get_messages_history error: {e}")
-		return [], False, False
+		return [], False, False, None
 
-async def save_room_state(roomid: str, url: str, time_val: int, is_playing: bool, subtitle_exist: bool):
+async def get_messages_after(roomid: str, after_id: int, limit: int):
+	# catch-up read over the (roomid, id) range, messages and reactions in id order
 	try:
 		p = await get_pool()
 		async with p.acquire() as conn:
 			async with conn.cursor() as cursor:
-				await cursor.execute("""
-					INSERT INTO plyr_status (roomid, url, time, is_playing, subtitle_exist)
-					VALUES (%s, %s, %s, %s, %s)
-					ON DUPLICATE KEY UPDATE url=%s, time=%s, is_playing=%s, subtitle_exist=%s
-				""", (roomid, url, time_val, is_playing, subtitle_exist, url, time_val, is_playing, subtitle_exist))
+				await cursor.execute(
+					"SELECT id, user, message, message_type, date, reply_to, removed FROM messages WHERE roomid = %s AND id > %s ORDER BY id ASC LIMIT %s",
+					(roomid, after_id, limit + 1)
+				)
+				rows = await cursor.fetchall()
+				has_more = len(rows) > limit
+				rows = rows[:limit]
+				messages = await _build_messages(cursor, rows)
+				return messages, has_more
 	except Exception as e:
-		logger.error(f"save_room_state error: {e}")
+		logger.error(f"get_messages_after error: {e}")
+		return [], False
 
-async def load_all_room_states():
+async def count_messages_after(roomid: str, after_id: int, cap: int) -> int:
+	# bounded count, stops scanning once cap rows are seen
 	try:
 		p = await get_pool()
 		async with p.acquire() as conn:
 			async with conn.cursor() as cursor:
-				await cursor.execute("SELECT roomid, url, time, is_playing, subtitle_exist FROM plyr_status")
-				return await cursor.fetchall()
+				await cursor.execute(
+					"SELECT COUNT(*) FROM (SELECT id FROM messages WHERE roomid = %s AND id > %s ORDER BY id ASC LIMIT %s) AS t",
+					(roomid, after_id, cap)
+				)
+				result = await cursor.fetchone()
+				return result[0] if result else 0
 	except Exception as e:
-		logger.error(f"load_all_room_states error: {e}")
-		return []
+		logger.error(f"count_messages_after error: {e}")
+		return 0
+
+async def get_last_message_id_before(roomid: str, date: float) -> int:
+	# maps a legacy lastMessageDate to a message id so catch-up can use the id range
+	try:
+		p = await get_pool()
+		async with p.acquire() as conn:
+			async with conn.cursor() as cursor:
+				await cursor.execute(
+					"SELECT id FROM messages WHERE roomid = %s AND date <= FROM_UNIXTIME(%s) ORDER BY id DESC LIMIT 1",
+					(roomid, date)
+				)
+				result = await cursor.fetchone()
+				return result[0] if result else 0
+	except Exception as e:
+		logger.error(f"get_last_message_id_before error: {e}")
+		return 0
+
+async def save_room_states(rows) -> bool:
+	# rows: [(roomid, url, time, is_playing, subtitle_exist)], one multi-row upsert
+	if not rows:
+		return True
+	try:
+		p = await get_pool()
+		async with p.acquire() as conn:
+			async with conn.cursor() as cursor:
+				placeholders = ','.join(['(%s, %s, %s, %s, %s)'] * len(rows))
+				await cursor.execute(
+					f"""INSERT INTO plyr_status (roomid, url, time, is_playing, subtitle_exist) VALUES {placeholders}
+					ON DUPLICATE KEY UPDATE url=VALUES(url), time=VALUES(time), is_playing=VALUES(is_playing), subtitle_exist=VALUES(subtitle_exist)""",
+					[value for row in rows for value in row]
+				)
+				return True
+	except Exception as e:
+		logger.error(f"save_room_states error: {e}")
+		return False
+
+async def fetch_room_state(roomid: str):
+	# raises on db errors so a failed load isn't mistaken for a new room
+	p = await get_pool()
+	async with p.acquire() as conn:
+		async with conn.cursor() as cursor:
+			await cursor.execute("SELECT roomid, url, time, is_playing, subtitle_exist FROM plyr_status WHERE roomid = %s", (roomid,))
+			return await cursor.fetchone()
@@ -0,0 +1,106 @@
+# BinaryProtocol encode/decode against the old per-call struct.pack / if-elif codec
+# (bench/old_codec.py): checks both produce the same frames and decoded fields, then
+# times each call
+#   python test_server/bench/codec.py [iterations]
+import logging
+import random
+import sys
+import timeit
+
+from old_codec import OldBinaryProtocol
+import videoSyncBinary
+from videoSyncBinary import BinaryProtocol, OP, PlayerState
+
+logging.disable(logging.CRITICAL)
+
+
+def auth_frame(*fields, version=None):
+	frame = bytes((OP.AUTH,))
+	for field in fields:
+		raw = field.encode("utf-8")
+		frame += bytes((len(raw),)) + raw
+	return frame + (bytes((version,)) if version else b"")
+
+
+def encode_cases(state):
+	# [(label, method, args)]
+	cases = []
+	for version in (1, 2):
+		cases += [
+			(f"encode_time v{version}", "encode_time", (12.7, 5, True, version, 9)),
+			(f"encode_state v{version}", "encode_state", (True, 99.5, 3, version, 4)),
+			(f"encode_init v{version}", "encode_init", (state, 7, version, 11))
+		]
+	return cases + [
+		("encode_url", "encode_url", ("https://example.com/video/ü" * 4, 3)),
+		("encode_ack", "encode_ack", (True, 2)),
+		("encode_ack error", "encode_ack", (False, 2, "not authorized")),
+		("encode_ack auth", "encode_ack", (True, 0, None, 2)),
+		("encode_ping", "encode_ping", (5,)),
+		("encode_pong", "encode_pong", (5, 6)),
+		("encode_rate", "encode_rate", (0.95, 3.2)),
+		("encode_subtitle_flag", "encode_subtitle_flag", (True, 1))
+	]
+
+
+def decode_frames(encoded):
+	frames = list(encoded) + [
+		auth_frame("user", "password", "room", "roompassword"),
+		auth_frame("user", "password", "room", "roompassword", version=2),
+		bytes((OP.AUTH_TOKEN, 0, 3)) + b"abc\x02",
+		bytes((OP.SYNC_REQ, 5)),
+		bytes((OP.UPTODATE, 5))
+	]
+	rnd = random.Random(1)
+	for frame in list(frames):
+		frames += [frame[:cut] for cut in range(len(frame))]
+	for _ in range(5000):
+		frame = bytearray(rnd.choice(frames[:20]))
+		if frame:
+			frame[rnd.randrange(len(frame))] = rnd.randrange(256)
+		frames.append(bytes(frame))
+	return frames
+
+
+def same_decode(old, new):
+	# newer decoders may add fields (sync_req/uptodate 'seen'), the old ones must match
+	if old is None or new is None:
+		return old is new
+	return all(new.get(k) == v for k, v in old.items())
+
+
+def timed(fn, iterations):
+	# best of five, the machine's noise only ever adds time
+	return min(timeit.repeat(fn, number=iterations, repeat=5)) / iterations * 1e6
+
+
+def main(iterations):
+	# fixed server timestamp so v2 frames compare byte for byte
+	videoSyncBinary.wall_time = lambda: 1700000000.123
+	state = PlayerState(url="https://example.com/video/ü", subtitle_exist=True)
+	state.anchor(123.456, is_playing=False)
+	cases = encode_cases(state)
+	encoded = []
+	for _, name, args in cases:
+		frame = getattr(BinaryProtocol, name)(*args)
+		assert frame == getattr(OldBinaryProtocol, name)(*args), name
+		encoded.append(frame)
+	frames = decode_frames(encoded)
+	mismatches = sum(
+		1 for frame in frames for version in (1, 2)
+		if not same_decode(OldBinaryProtocol.decode(frame, version), BinaryProtocol.decode(frame, version))
+	)
+	print(f"{len(cases)} encodes identical, {len(frames) * 2} decodes with {mismatches} mismatches")
+	print(f"{'call':>28} {'old us':>8} {'new us':>8} {'speedup':>8}")
+	for label, name, args in cases:
+		old = timed(lambda: getattr(OldBinaryProtocol, name)(*args), iterations)
+		new = timed(lambda: getattr(BinaryProtocol, name)(*args), iterations)
+		print(f"{label:>28} {old:>8.2f} {new:>8.2f} {old / new:>7.2f}x")
+	for label, frame in (("decode time", encoded[0]), ("decode state", encoded[1]), ("decode auth", frames[len(encoded) + 1])):
+		old = timed(lambda: OldBinaryProtocol.decode(frame), iterations)
+		new = timed(lambda: BinaryProtocol.decode(frame), iterations)
+		print(f"{label:>28} {old:>8.2f} {new:>8.2f} {old / new:>7.2f}x")
+
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
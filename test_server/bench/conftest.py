@@ -0,0 +1,7 @@
+# lets the pytest-benchmark tests import the bench helpers and the server modules the
+# same way the scripts do when run directly
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.abspath(__file__)))
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
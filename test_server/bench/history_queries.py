@@ -0,0 +1,71 @@
+# queries per chat history page: the current loader against the old one that looked up
+# every reply target with its own SELECT and probed for older pages with COUNT(*)
+#   python test_server/bench/history_queries.py
+import asyncio
+import random
+from time import perf_counter
+
+from sqlite_pool import SQLitePool, install
+
+ROOM = "bench"
+PAGE_SIZES = (15, 50, 100)
+
+
+async def baseline_history(pool, roomid, limit):
+	async with pool.acquire() as conn:
+		async with conn.cursor() as cursor:
+			await cursor.execute(
+				"SELECT id, user, message, message_type, date, reply_to, removed FROM messages WHERE roomid = %s AND message_type = 'new_message' ORDER BY id DESC LIMIT %s",
+				(roomid, limit)
+			)
+			message_rows = await cursor.fetchall()
+			placeholders = ','.join(['%s'] * len(message_rows))
+			await cursor.execute(
+				f"SELECT id, user, message, message_type, date, reply_to, removed FROM messages WHERE roomid = %s AND message_type = 'new_reaction' AND reply_to IN ({placeholders})",
+				[roomid] + [row[0] for row in message_rows]
+			)
+			all_rows = sorted(list(message_rows) + list(await cursor.fetchall()), key=lambda x: x[0])
+			for row in all_rows:
+				if row[5]:
+					await cursor.execute("SELECT user, message, removed FROM messages WHERE id = %s", (row[5],))
+					await cursor.fetchone()
+			if len(message_rows) == limit:
+				await cursor.execute(
+					"SELECT COUNT(*) FROM messages WHERE roomid = %s AND id < %s AND message_type = 'new_message'",
+					(roomid, min(row[0] for row in message_rows))
+				)
+				await cursor.fetchone()
+
+
+def populate(pool, count=2000):
+	random.seed(1)
+	ids = []
+	for i in range(count):
+		# a third of messages reply to an earlier one, half get a reaction
+		reply_to = random.choice(ids) if ids and random.random() < 0.33 else None
+		message_id = pool.add_message(ROOM, f"user{i % 7}", f"message {i}", reply_to=reply_to)
+		ids.append(message_id)
+		if random.random() < 0.5:
+			pool.add_message(ROOM, f"user{(i + 3) % 7}", "👍", "new_reaction", message_id)
+
+
+async def main():
+	pool = SQLitePool()
+	populate(pool)
+	async_db = install(pool)
+	print(f"{'page':>6} {'old queries':>12} {'new queries':>12} {'old ms':>8} {'new ms':>8}")
+	for limit in PAGE_SIZES:
+		pool.queries = 0
+		started = perf_counter()
+		await baseline_history(pool, ROOM, limit)
+		old_ms, old_queries = (perf_counter() - started) * 1000, pool.queries
+		pool.queries = 0
+		started = perf_counter()
+		messages, has_more, _, _ = await async_db.fetch_messages_history(ROOM, None, limit)
+		new_ms, new_queries = (perf_counter() - started) * 1000, pool.queries
+		assert has_more and messages
+		print(f"{limit:>6} {old_queries:>12} {new_queries:>12} {old_ms:>8.2f} {new_ms:>8.2f}")
+
+
+if __name__ == "__main__":
+	asyncio.run(main())
@@ -0,0 +1,231 @@
+# BinaryProtocol as it was before the table-driven decoder and precompiled Structs,
+# kept only so bench/codec.py can compare against it. format strings are built per
+# call and decode walks an if/elif chain over slices of the frame
+import logging
+import struct
+import sys
+from os import path
+from typing import Optional
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from videoSyncBinary import OP, PlayerState, ACK_SUCCESS, ACK_FAIL, MAX_URL_LENGTH, MAX_TIME, MAX_CRED_LENGTH, MAX_TOKEN_LENGTH, to_ms, server_ts
+
+logger = logging.getLogger("videoSyncBinary")
+
+
+class OldBinaryProtocol:
+    # convert values to raw bytes for network transmission - pack values into bytes
+    @staticmethod
+    def encode_time(time: float, request_id: int = 0, passive: bool = False, version: int = 1, seq: int = 0) -> bytes:
+        # bits 0-6 store request_id (max 127), bit 7 stores passive flag
+        flags = (request_id & 0x7F) | (0x80 if passive else 0) 
+        if version >= 2:
+            # [opcode:1B][flags:1B][time ms:4B][server ts ms:8B][seq:4B] = 18 bytes
+            return struct.pack('>BBLQL', OP.TIME, flags, to_ms(time), server_ts(), seq)
+        return struct.pack('>BBL', OP.TIME, flags, int(time)) # [opcode:1B][flags:1B][time:4B] = 6 bytes
+    
+    @staticmethod
+    def encode_state(is_playing: bool, time: float, request_id: int = 0, version: int = 1, seq: int = 0) -> bytes:
+        if version >= 2:
+            # >BBBLQL = 1B opcode, 1B req_id, 1B playing, 4B time ms, 8B server ts ms, 4B seq
+            return struct.pack('>BBBLQL', OP.STATE, request_id & 0x7F, 1 if is_playing else 0, to_ms(time), server_ts(), seq)
+        # >BBBL = 1B opcode, 1B req_id, 1B playing, 4B time
+        return struct.pack('>BBBL', OP.STATE, request_id & 0x7F, 1 if is_playing else 0, int(time))
+    
+    @staticmethod
+    def encode_url(url: str, request_id: int = 0) -> bytes:
+        url_bytes = url.encode('utf-8')
+        # >BBH{n}s = 1B opcode, 1B req_id, 2B url_len, nB url
+        return struct.pack(f'>BBH{len(url_bytes)}s', OP.URL, request_id & 0x7F, len(url_bytes), url_bytes)
+    
+    @staticmethod
+    def encode_init(state: PlayerState, request_id: int = 0, version: int = 1, seq: int = 0, at: Optional[float] = None) -> bytes:
+        # at: monotonic time the position is computed for, defaults to now
+        url_bytes = state.url.encode('utf-8')
+        if version >= 2:
+            # >BBH{n}sLBBQL = 1B op, 1B req_id, 2B url_len, nB url, 4B time ms, 1B playing, 1B subtitle, 8B server ts ms, 4B seq
+            return struct.pack(
+                f'>BBH{len(url_bytes)}sLBBQL',
+                OP.INIT,
+                request_id & 0x7F,
+                len(url_bytes),
+                url_bytes,
+                to_ms(state.position(at)),
+                1 if state.is_playing else 0,
+                1 if state.subtitle_exist else 0,
+                server_ts(),
+                seq
+            )
+        # >BBH{n}sLBB = 1B op, 1B req_id, 2B url_len, nB url, 4B time, 1B playing, 1B subtitle
+        return struct.pack(
+            f'>BBH{len(url_bytes)}sLBB',
+            OP.INIT,
+            request_id & 0x7F,
+            len(url_bytes),
+            url_bytes,
+            int(state.position(at)),
+            1 if state.is_playing else 0,
+            1 if state.subtitle_exist else 0
+        )
+    
+    @staticmethod
+    def encode_ack(success: bool, request_id: int = 0, error: Optional[str] = None, protocol_version: Optional[int] = None) -> bytes:
+        if protocol_version is not None:
+            # auth ack for clients that asked for a version: 1B op, 1B req_id, 1B status, 1B negotiated version
+            return struct.pack('>BBBB', OP.ACK, request_id & 0x7F, ACK_SUCCESS, protocol_version)
+        if error:
+            err_bytes = error.encode('utf-8')[:255]
+            # with error: 1B op, 1B req_id, 1B status, 1B err_len, nB err
+            return struct.pack(f'>BBBB{len(err_bytes)}s', OP.ACK, request_id & 0x7F, ACK_FAIL, len(err_bytes), err_bytes)
+        # no error: 1B op, 1B req_id, 1B status
+        return struct.pack('>BBB', OP.ACK, request_id & 0x7F, ACK_SUCCESS if success else ACK_FAIL)
+    
+    @staticmethod
+    def encode_ping(ts: int) -> bytes:
+        # >BBQ = 1B opcode, 1B flags, 8B sender timestamp ms
+        return struct.pack('>BBQ', OP.PING, 0, ts)
+    
+    @staticmethod
+    def encode_pong(echo: int, ts: int) -> bytes:
+        # >BBQQ = 1B opcode, 1B flags, 8B echoed ping timestamp, 8B responder timestamp ms
+        return struct.pack('>BBQQ', OP.PONG, 0, echo, ts)
+    
+    @staticmethod
+    def encode_rate(rate: float, duration: float, request_id: int = 0) -> bytes:
+        # >BBHL = 1B opcode, 1B req_id, 2B rate in thousandths (1000 = normal), 4B duration ms
+        # v2 only: play at rate for duration, then go back to 1.0
+        return struct.pack('>BBHL', OP.RATE, request_id & 0x7F, min(max(0, int(round(rate * 1000))), 0xFFFF), min(max(0, int(duration * 1000)), MAX_TIME))
+    
+    @staticmethod
+    def encode_subtitle_flag(exists: bool, request_id: int = 0) -> bytes:
+        return struct.pack('>BBB', OP.SUBTITLE_FLAG, request_id & 0x7F, 1 if exists else 0)
+    
+    # convert raw bytes back to values - unpacks bytes to values
+    @staticmethod
+    def decode(data: bytes, version: int = 1) -> Optional[dict]:
+        # version is the connection's negotiated protocol, times are returned in seconds
+        # data[i] reads single byte
+        if len(data) < 2:
+            return None
+        opcode = data[0]
+        flags = data[1]
+        # 0x7F = 01111111, masks out bit 7, keeps bits 0-6
+        # 0x80 = 10000000, checks if bit 7 is set
+        request_id = flags & 0x7F
+        timeout_pass = bool(flags & 0x80)
+        
+        try:
+            if opcode == OP.TIME:
+                if len(data) < 6:
+                    return None
+                # >L = 4B unsigned long (v1 seconds, v2 milliseconds)
+                time = struct.unpack('>L', data[2:6])[0]
+                if version >= 2:
+                    time /= 1000
+                return {'type': 'time', 'request_id': request_id, 'time': time, 'timeout_pass': timeout_pass}
+            
+            elif opcode == OP.STATE:
+                if len(data) < 7:
+                    return None
+                is_playing = data[2] == 1
+                time = struct.unpack('>L', data[3:7])[0]
+                if version >= 2:
+                    time /= 1000
+                return {'type': 'state', 'request_id': request_id, 'is_playing': is_playing, 'time': time}
+            
+            elif opcode == OP.URL:
+                if len(data) < 4:
+                    return None
+                # >H = 2B unsigned short (url length)
+                url_len = struct.unpack('>H', data[2:4])[0]
+                if url_len > MAX_URL_LENGTH:
+                    logger.warn(f"URL too long: {url_len}")
+                    return None
+                if len(data) < 4 + url_len:
+                    return None
+                try:
+                    url = data[4:4+url_len].decode('utf-8', errors='strict')
+                except UnicodeDecodeError:
+                    logger.warn("Invalid UTF-8 in URL")
+                    return None
+                return {'type': 'url', 'request_id': request_id, 'url': url}
+            
+            elif opcode == OP.SYNC_REQ:
+                return {'type': 'sync_req', 'request_id': request_id}
+            
+            elif opcode == OP.UPTODATE:
+                return {'type': 'uptodate', 'request_id': request_id}
+            
+            elif opcode == OP.PING:
+                if len(data) < 10:
+                    return None
+                return {'type': 'ping', 'ts': struct.unpack('>Q', data[2:10])[0]}
+            
+            elif opcode == OP.PONG:
+                if len(data) < 18:
+                    return None
+                echo, ts = struct.unpack('>QQ', data[2:18])
+                return {'type': 'pong', 'echo': echo, 'ts': ts}
+            
+            elif opcode == OP.AUTH:
+                # AUTH: 1B op, 1B userLen, nB user, 1B pswLen, nB psw, 1B roomLen, nB room, 1B roomPswLen, nB roomPsw
+                offset = 1
+                if len(data) < offset + 1:
+                    return None
+                user_len = data[offset]; offset += 1
+                if user_len > MAX_CRED_LENGTH or len(data) < offset + user_len:
+                    return None
+                try:
+                    user = data[offset:offset+user_len].decode('utf-8', errors='strict'); offset += user_len
+                except UnicodeDecodeError:
+                    return None
+                if len(data) < offset + 1:
+                    return None
+                psw_len = data[offset]; offset += 1
+                if psw_len > MAX_CRED_LENGTH or len(data) < offset + psw_len:
+                    return None
+                try:
+                    psw = data[offset:offset+psw_len].decode('utf-8', errors='strict'); offset += psw_len
+                except UnicodeDecodeError:
+                    return None
+                if len(data) < offset + 1:
+                    return None
+                room_len = data[offset]; offset += 1
+                if room_len > MAX_CRED_LENGTH or len(data) < offset + room_len:
+                    return None
+                try:
+                    roomid = data[offset:offset+room_len].decode('utf-8', errors='strict'); offset += room_len
+                except UnicodeDecodeError:
+                    return None
+                if len(data) < offset + 1:
+                    return None
+                roompsw_len = data[offset]; offset += 1
+                if roompsw_len > MAX_CRED_LENGTH or len(data) < offset + roompsw_len:
+                    return None
+                try:
+                    roompsw = data[offset:offset+roompsw_len].decode('utf-8', errors='strict'); offset += roompsw_len
+                except UnicodeDecodeError:
+                    return None
+                # optional trailing 1B requested protocol version, v1 clients don't send it
+                requested = data[offset] if len(data) > offset else 1
+                return {'type': 'auth', 'user': user, 'psw': psw, 'roomid': roomid, 'roompsw': roompsw, 'version': requested}
+            
+            elif opcode == OP.AUTH_TOKEN:
+                # AUTH_TOKEN: 1B op, 2B tokenLen, nB token (session token issued by /session_token), optional 1B version
+                if len(data) < 3:
+                    return None
+                token_len = struct.unpack('>H', data[1:3])[0]
+                if token_len > MAX_TOKEN_LENGTH or len(data) < 3 + token_len:
+                    return None
+                try:
+                    token = data[3:3+token_len].decode('ascii', errors='strict')
+                except UnicodeDecodeError:
+                    return None
+                requested = data[3+token_len] if len(data) > 3 + token_len else 1
+                return {'type': 'auth_token', 'token': token, 'version': requested}
+            
+            else:
+                return None
+        except Exception as e:
+            logger.error(f"Decode error: {e}")
+            return None
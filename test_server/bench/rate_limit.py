@@ -0,0 +1,77 @@
+# RateLimiter microbenchmark: is_allowed calls/s and traced memory at N live keys, and
+# the expiry sweep, against the old per-key timestamp lists
+#   python test_server/bench/rate_limit.py [keys]
+import asyncio
+import random
+import sys
+import tracemalloc
+from collections import defaultdict
+from os import path
+from time import monotonic, perf_counter, time
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from rate_limit import RateLimiter
+
+CALLS = 500000
+
+
+class OldRateLimiter:
+	def __init__(self, max_requests: int = 30, window_seconds: int = 60):
+		self.max_requests = max_requests
+		self.window_seconds = window_seconds
+		self.requests = defaultdict(list)
+
+	def is_allowed(self, key: str) -> bool:
+		now = time()
+		self.requests[key] = [t for t in self.requests[key] if now - t < self.window_seconds]
+		if len(self.requests[key]) >= self.max_requests:
+			return False
+		self.requests[key].append(now)
+		return True
+
+
+def fill(limiter, keys):
+	tracemalloc.start()
+	for key in keys:
+		limiter.is_allowed(key)
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return size
+
+
+def calls_per_sec(limiter, keys):
+	sample = random.choices(keys, k=CALLS)
+	started = perf_counter()
+	for key in sample:
+		limiter.is_allowed(key)
+	return CALLS / (perf_counter() - started)
+
+
+async def sweep(count):
+	limiter = RateLimiter(max_requests=100, window_seconds=10, max_keys=count)
+	for n in range(count):
+		limiter.is_allowed(f"ws:user{n}:room")
+	# every other key expired, spread through lru order so a cleanup that stops at
+	# the first live key would free none of them
+	now = monotonic()
+	for n, key in enumerate(limiter.tats):
+		limiter.tats[key] = now - 1 if n % 2 else now + 60
+	started = perf_counter()
+	removed = await limiter.sweep()
+	return removed, perf_counter() - started
+
+
+def main(count):
+	random.seed(1)
+	keys = [f"ws:user{n}:room{n % 1000}" for n in range(count)]
+	print(f"{count} keys, {CALLS} calls")
+	for name, limiter in (("old lists", OldRateLimiter(100, 10)), ("gcra", RateLimiter(100, 10, max_keys=count))):
+		size = fill(limiter, keys)
+		rate = calls_per_sec(limiter, keys)
+		print(f"{name:10} {rate / 1e6:6.2f}M calls/s {size / 1e6:8.1f} MB traced ({size / count:.0f} B/key)")
+	removed, elapsed = asyncio.run(sweep(count))
+	print(f"sweep      removed {removed} expired keys in {elapsed * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+	main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,135 @@
+# concurrent scrubbers in one room: frames and bytes sent to the room, and how many
+# clients end up with a view that differs from the room state. compares immediate
+# broadcasts, the tick with the last writer always excluded (before the fix), and the
+# tick as it is now (a writer is excluded only when the whole tick was theirs)
+#   python test_server/bench/scrubbers.py [viewers] [rounds]
+import asyncio
+import logging
+import random
+import sys
+from os import path
+from time import monotonic
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+logging.disable(logging.CRITICAL)
+import videoSyncBinary
+import wssvideoSync
+from videoSyncBinary import OP, PendingBroadcast, TIME_V1, TIME_V2, STATE_V2
+
+SCRUBBERS = (1, 3, 8)
+ROUND_GAP = 0.01
+TICK = 0.05
+TOLERANCE = 0.3
+
+
+class Socket:
+	class State:
+		value = 1
+
+	def __init__(self):
+		self.client_state = self.application_state = Socket.State()
+		# [(monotonic, frame)]
+		self.frames = []
+
+	async def send_bytes(self, data):
+		self.frames.append((monotonic(), bytes(data)))
+
+	async def send_text(self, text):
+		pass
+
+	async def close(self, code=1000, reason=""):
+		pass
+
+
+class LastWriterBroadcast(PendingBroadcast):
+	def add(self, user, kind, passive=False, v1_only=False):
+		super().add(user, kind, passive, v1_only)
+		self.exclude_user = user
+
+
+def view_of(actions, frames):
+	# the client's idea of (position, playing, at) from its own writes and what it received
+	events = list(actions)
+	for at, frame in frames:
+		if frame[0] == OP.TIME and len(frame) == TIME_V2.size:
+			events.append((at, TIME_V2.unpack(frame)[2] / 1000, None))
+		elif frame[0] == OP.STATE and len(frame) == STATE_V2.size:
+			_, _, playing, ms, _, _ = STATE_V2.unpack(frame)
+			events.append((at, ms / 1000, playing == 1))
+	position, playing, seen_at = 0.0, False, 0.0
+	for at, pos, is_playing in sorted(events, key=lambda e: e[0]):
+		if is_playing is not None:
+			playing = is_playing
+		position, seen_at = pos, at
+	return position, playing, seen_at
+
+
+async def run(mode, viewers, scrubbers, rounds):
+	random.seed(scrubbers)
+	wssvideoSync.BROADCAST_TICK = 0 if mode == "immediate" else TICK
+	videoSyncBinary.PendingBroadcast = LastWriterBroadcast if mode == "tick, last writer" else PendingBroadcast
+	handler = wssvideoSync.VideoSyncHandler()
+	handler.start()
+	roomid = f"bench-{mode}-{scrubbers}"
+	sockets = {}
+	for n in range(viewers + scrubbers):
+		user = f"s{n}" if n < scrubbers else f"v{n}"
+		sockets[user] = Socket()
+		await handler.handle_connect(sockets[user], user, roomid, 2)
+	room = handler.room_manager.get_room(roomid)
+	room.timeout_secs = 0
+	await asyncio.sleep(0.05)
+	start = monotonic()
+	for socket in sockets.values():
+		socket.frames.clear()
+	actions = {user: [] for user in sockets}
+	for _ in range(rounds):
+		for n in range(scrubbers):
+			user = f"s{n}"
+			conn = room.get_connection(user)
+			conn.is_uptodate = True
+			conn.last_action_time.clear()
+			position = random.uniform(0, 3000)
+			if random.random() < 0.2:
+				playing = not room.state.is_playing
+				frame = bytes((OP.STATE, 1, 1 if playing else 0)) + (int(position * 1000)).to_bytes(4, "big")
+			else:
+				playing = None
+				# clients send TIME in the v1 layout, the u32 is milliseconds on v2
+				frame = TIME_V1.pack(OP.TIME, 1, int(position * 1000))
+			actions[user].append((monotonic(), position, playing))
+			await handler.handle_message(sockets[user], frame, user, roomid)
+		await asyncio.sleep(ROUND_GAP)
+	await asyncio.sleep(TICK * 3)
+	await handler.stop()
+	elapsed = monotonic() - start
+	now = monotonic()
+	expected = room.state.position(now)
+	frames = sent = stale = 0
+	for user, socket in sockets.items():
+		updates = [(at, frame) for at, frame in socket.frames if frame[0] in (OP.TIME, OP.STATE)]
+		frames += len(updates)
+		sent += sum(len(frame) for _, frame in updates)
+		position, playing, at = view_of(actions[user], updates)
+		if playing:
+			position += now - at
+		if playing != room.state.is_playing or abs(position - expected) > TOLERANCE:
+			stale += 1
+	return frames / elapsed, sent / elapsed, stale
+
+
+async def main(viewers, rounds):
+	print(f"{viewers} viewers, {rounds} rounds {ROUND_GAP * 1000:.0f}ms apart, tick {TICK * 1000:.0f}ms")
+	print(f"{'scrubbers':>9} {'mode':>18} {'frames/s':>10} {'bytes/s':>10} {'stale views':>12}")
+	for scrubbers in SCRUBBERS:
+		for mode in ("immediate", "tick, last writer", "tick"):
+			frames, sent, stale = await run(mode, viewers, scrubbers, rounds)
+			print(f"{scrubbers:>9} {mode:>18} {frames:>10.0f} {sent:>10.0f} {stale:>12}")
+
+
+if __name__ == "__main__":
+	wssvideoSync.room_manager.loader = None
+	wssvideoSync.room_manager.saver = None
+	viewers = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+	rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+	asyncio.run(main(viewers, rounds))
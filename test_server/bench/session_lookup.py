@@ -0,0 +1,69 @@
+# websocket -> (user, room) lookups with 10k open connections: SessionRegistry against
+# the old {roomid: [{"websocket", "username"}]} lists that every lookup scanned
+#   python test_server/bench/session_lookup.py [connections] [per_room]
+import asyncio
+import random
+import sys
+from os import path
+from time import perf_counter
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from chat_sessions import SessionRegistry
+
+LOOKUPS = 2000
+
+
+class Socket:
+	__slots__ = ("n",)
+
+	def __init__(self, n):
+		self.n = n
+
+
+def old_user(active_rooms, websocket):
+	for room_data in active_rooms.values():
+		for user_data in room_data:
+			if user_data["websocket"] == websocket:
+				return user_data["username"]
+	return None
+
+
+def old_room(active_rooms, websocket):
+	for roomid, room_data in active_rooms.items():
+		for user_data in room_data:
+			if user_data["websocket"] == websocket:
+				return roomid
+	return None
+
+
+def per_lookup_us(lookup, sockets):
+	started = perf_counter()
+	for websocket in sockets:
+		lookup(websocket)
+	return (perf_counter() - started) / len(sockets) * 1e6
+
+
+async def main(connections, per_room):
+	random.seed(1)
+	sockets = [Socket(n) for n in range(connections)]
+	active_rooms = {}
+	registry = SessionRegistry()
+	for n, websocket in enumerate(sockets):
+		roomid, user = f"room{n // per_room}", f"user{n}"
+		active_rooms.setdefault(roomid, []).append({"websocket": websocket, "username": user})
+		registry.add(websocket, user, roomid)
+	# handle_message resolves both the user and the room of the sender
+	sample = random.choices(sockets, k=LOOKUPS)
+	old = per_lookup_us(lambda ws: (old_user(active_rooms, ws), old_room(active_rooms, ws)), sample)
+	new = per_lookup_us(lambda ws: (registry.get(ws).user, registry.get(ws).roomid), sample)
+	print(f"{connections} connections in {len(active_rooms)} rooms, {LOOKUPS} sender lookups")
+	print(f"old scan   {old:10.2f} us/message")
+	print(f"registry   {new:10.2f} us/message")
+	for websocket in sockets:
+		registry.remove(websocket)
+
+
+if __name__ == "__main__":
+	connections = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+	per_room = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+	asyncio.run(main(connections, per_room))
@@ -0,0 +1,86 @@
+# stand-in for the aiomysql pool used by async_db, backed by an in-memory sqlite db.
+# runs the real queries (placeholders translated) and counts them
+import sqlite3
+import sys
+from datetime import datetime
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+SCHEMA = """
+CREATE TABLE messages (
+	id INTEGER PRIMARY KEY,
+	roomid TEXT,
+	user TEXT,
+	message TEXT,
+	message_type TEXT,
+	date TIMESTAMP,
+	reply_to INTEGER,
+	removed INTEGER DEFAULT 0
+);
+CREATE INDEX messages_room_id ON messages (roomid, id);
+"""
+
+
+class Cursor:
+	def __init__(self, pool):
+		self.pool = pool
+		self.cursor = pool.db.cursor()
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *exc):
+		self.cursor.close()
+
+	async def execute(self, sql, params=()):
+		self.pool.queries += 1
+		self.cursor.execute(sql.replace("%s", "?"), tuple(params))
+
+	async def fetchall(self):
+		return self.cursor.fetchall()
+
+	async def fetchone(self):
+		return self.cursor.fetchone()
+
+	@property
+	def lastrowid(self):
+		return self.cursor.lastrowid
+
+
+class Connection:
+	def __init__(self, pool):
+		self.pool = pool
+
+	async def __aenter__(self):
+		return self
+
+	async def __aexit__(self, *exc):
+		pass
+
+	def cursor(self):
+		return Cursor(self.pool)
+
+
+class SQLitePool:
+	def __init__(self):
+		self.db = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES)
+		self.db.executescript(SCHEMA)
+		self.queries = 0
+
+	def acquire(self):
+		return Connection(self)
+
+	def add_message(self, roomid, user, message, message_type="new_message", reply_to=None):
+		cur = self.db.execute(
+			"INSERT INTO messages (roomid, user, message, message_type, date, reply_to) VALUES (?, ?, ?, ?, ?, ?)",
+			(roomid, user, message, message_type, datetime.now(), reply_to)
+		)
+		return cur.lastrowid
+
+
+def install(pool):
+	# points async_db at the sqlite pool
+	import async_db
+	async_db.pool = pool
+	return async_db
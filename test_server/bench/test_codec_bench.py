@@ -0,0 +1,52 @@
+# pytest-benchmark version of bench/codec.py: every encode/decode case is checked
+# against the old codec, then timed for both so the two show up side by side
+#   python -m pytest test_server/bench/test_codec_bench.py --benchmark-group-by=param:label
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+from codec import encode_cases, decode_frames, same_decode
+from old_codec import OldBinaryProtocol
+import videoSyncBinary
+from videoSyncBinary import BinaryProtocol, PlayerState
+
+CODECS = {"old": OldBinaryProtocol, "new": BinaryProtocol}
+
+
+def make_state():
+	state = PlayerState(url="https://example.com/video/ü", subtitle_exist=True)
+	state.anchor(123.456, is_playing=False)
+	return state
+
+
+@pytest.fixture(autouse=True)
+def fixed_wall_time(monkeypatch):
+	# fixed server timestamp so v2 frames compare byte for byte
+	monkeypatch.setattr(videoSyncBinary, "wall_time", lambda: 1700000000.123)
+
+
+CASES = encode_cases(make_state())
+
+
+@pytest.mark.parametrize("codec", CODECS)
+@pytest.mark.parametrize("label,name,args", CASES, ids=[case[0] for case in CASES])
+def test_encode(benchmark, codec, label, name, args):
+	benchmark.group = label
+	frame = benchmark(getattr(CODECS[codec], name), *args)
+	assert frame == getattr(OldBinaryProtocol, name)(*args)
+
+
+@pytest.mark.parametrize("codec", CODECS)
+@pytest.mark.parametrize("label,index", [("decode time", 0), ("decode state", 1), ("decode init", 4)])
+def test_decode(benchmark, codec, label, index):
+	benchmark.group = label
+	frame = getattr(BinaryProtocol, CASES[index][1])(*CASES[index][2])
+	fields = benchmark(CODECS[codec].decode, frame, 2)
+	assert same_decode(OldBinaryProtocol.decode(frame, 2), fields)
+
+
+def test_decode_matches_old():
+	encoded = [getattr(BinaryProtocol, name)(*args) for _, name, args in CASES]
+	for frame in decode_frames(encoded):
+		for version in (1, 2):
+			assert same_decode(OldBinaryProtocol.decode(frame, version), BinaryProtocol.decode(frame, version)), frame
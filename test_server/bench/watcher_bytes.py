@@ -0,0 +1,79 @@
+# outbound watcher traffic per room: per-tick versioned deltas against the old full
+# watchers_update snapshot broadcast to every member on every report. simulated time,
+# every watcher reports every REPORT_INTERVAL seconds like the client does
+#   python test_server/bench/watcher_bytes.py
+import sys
+from json import dumps
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from watcher_state import WatcherState, WATCHER_TICK
+
+REPORT_INTERVAL = 4.0
+SECONDS = 60
+ROOM_SIZES = (5, 20, 100)
+
+
+def report(user, now):
+	return {
+		"username": user,
+		"current_time": round(now, 3),
+		"is_playing": True,
+		"is_uptodate": True,
+		"is_idle": False
+	}
+
+
+def reports(watchers):
+	# (time, user) in time order, reports spread evenly over the interval
+	events = []
+	for n in range(watchers):
+		offset = REPORT_INTERVAL * n / watchers
+		t = offset
+		while t < SECONDS:
+			events.append((t, f"user{n}"))
+			t += REPORT_INTERVAL
+	events.sort()
+	return events
+
+
+def old_bytes(watchers):
+	room = {}
+	sent = 0
+	for now, user in reports(watchers):
+		room[user] = report(user, now)
+		sent += len(dumps({"type": "watchers_update", "watchers": list(room.values())})) * watchers
+	return sent
+
+
+def new_bytes(watchers):
+	sent = 0
+
+	def on_delta(roomid, payload):
+		nonlocal sent
+		sent += len(dumps(payload)) * watchers
+
+	state = WatcherState()
+	state.on_delta = on_delta
+	events = reports(watchers)
+	tick = WATCHER_TICK
+	for now, user in events:
+		while tick <= now:
+			state.flush()
+			tick += WATCHER_TICK
+		state.update("bench", user, report(user, now))
+	state.flush()
+	return sent
+
+
+def main():
+	print(f"{SECONDS}s, one report per watcher every {REPORT_INTERVAL}s, tick {WATCHER_TICK}s")
+	print(f"{'watchers':>8} {'old B/s':>12} {'new B/s':>12} {'ratio':>8}")
+	for watchers in ROOM_SIZES:
+		old = old_bytes(watchers) / SECONDS
+		new = new_bytes(watchers) / SECONDS
+		print(f"{watchers:>8} {old:>12.0f} {new:>12.0f} {old / new:>8.1f}")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,283 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from os import getenv
+from time import monotonic
+import async_db
+
+logger = logging.getLogger("chatHistoryCache")
+
+CHAT_HISTORY_ROOM_LIMIT = int(getenv("CHAT_HISTORY_ROOM_LIMIT", "100"))
+CHAT_HISTORY_GLOBAL_LIMIT = int(getenv("CHAT_HISTORY_GLOBAL_LIMIT", "50000"))
+VIDEO_HISTORY_LIMIT = 15
+# room_history is also written by the video sync server, so it is only cached briefly
+VIDEO_HISTORY_TTL = float(getenv("VIDEO_HISTORY_TTL", "5"))
+
+
+def _as_id(value):
+	try:
+		return int(value)
+	except (TypeError, ValueError):
+		return None
+
+
+class RoomHistory:
+	def __init__(self):
+		# {message_id: message} new_message rows, ascending id
+		self.messages = OrderedDict()
+		# {parent_id: {reaction_id: reaction}}
+		self.reactions = {}
+		# {reaction_id: parent_id}
+		self.reaction_parent = {}
+		# True when older messages exist in the db that are not in the buffer
+		self.has_more_before = False
+		self.size = 0
+
+	def add_message(self, message: dict):
+		if message["id"] in self.messages:
+			return
+		if self.messages and message["id"] < next(reversed(self.messages)):
+			# out of order insert, rebuild ordering
+			self.messages[message["id"]] = message
+			self.messages = OrderedDict(sorted(self.messages.items()))
+		else:
+			self.messages[message["id"]] = message
+		self.size += 1
+
+	def add_reaction(self, reaction: dict):
+		parent_id = reaction["reply_to_id"]
+		if parent_id not in self.messages:
+			return
+		reactions = self.reactions.setdefault(parent_id, {})
+		if reaction["id"] not in reactions:
+			self.size += 1
+		reactions[reaction["id"]] = reaction
+		self.reaction_parent[reaction["id"]] = parent_id
+
+	def update_reaction(self, reaction_id: int, emoji: str, date: float):
+		parent_id = self.reaction_parent.get(reaction_id)
+		if parent_id is None:
+			return
+		reaction = self.reactions[parent_id][reaction_id]
+		reaction["message"] = emoji
+		reaction["date"] = date
+		reaction["is_deleted"] = False
+
+	def remove(self, message_id: int):
+		parent_id = self.reaction_parent.get(message_id)
+		if parent_id is not None:
+			self.reactions[parent_id][message_id]["is_deleted"] = True
+			return
+		message = self.messages.get(message_id)
+		if not message:
+			return
+		message["is_deleted"] = True
+		message["reply_to"] = None
+		for reaction in self.reactions.get(message_id, {}).values():
+			reaction["is_deleted"] = True
+		for other in self.messages.values():
+			reply = other.get("reply_to")
+			if reply and reply["id"] == message_id:
+				other["reply_to"] = {"id": message_id, "user": reply["user"], "message": None, "is_deleted": True}
+
+	def trim(self, limit: int) -> int:
+		freed = 0
+		while len(self.messages) > limit:
+			message_id, _ = self.messages.popitem(last=False)
+			reactions = self.reactions.pop(message_id, {})
+			for reaction_id in reactions:
+				self.reaction_parent.pop(reaction_id, None)
+			freed += 1 + len(reactions)
+			self.has_more_before = True
+		self.size -= freed
+		return freed
+
+	def _reaction_row(self, reaction: dict) -> dict:
+		reply_to = None
+		if not reaction["is_deleted"]:
+			parent = self.messages[reaction["reply_to_id"]]
+			reply_to = {
+				"id": parent["id"],
+				"user": parent["user"],
+				"message": None if parent["is_deleted"] else parent["message"],
+				"is_deleted": parent["is_deleted"]
+			}
+		return {
+			"id": reaction["id"],
+			"user": reaction["user"],
+			"message": reaction["message"],
+			"message_type": "new_reaction",
+			"date": reaction["date"],
+			"reply_to": reply_to,
+			"is_deleted": reaction["is_deleted"]
+		}
+
+	def page(self, limit: int):
+		ids = list(self.messages)[-limit:]
+		rows = []
+		for message_id in ids:
+			rows.append(dict(self.messages[message_id]))
+			for reaction in self.reactions.get(message_id, {}).values():
+				rows.append(self._reaction_row(reaction))
+		rows.sort(key=lambda x: x["id"])
+		has_more = self.has_more_before or len(self.messages) > limit
+		next_cursor = async_db.encode_history_cursor(ids[0]) if has_more and ids else None
+		return rows, has_more, next_cursor
+
+
+class HistoryCache:
+	def __init__(self, room_limit: int = CHAT_HISTORY_ROOM_LIMIT, global_limit: int = CHAT_HISTORY_GLOBAL_LIMIT, video_ttl: float = VIDEO_HISTORY_TTL):
+		self.room_limit = room_limit
+		self.global_limit = global_limit
+		self.video_ttl = video_ttl
+		# {roomid: RoomHistory} least recently used first
+		self.rooms = OrderedDict()
+		# {roomid: future} rooms currently loading from the db
+		self.warming = {}
+		# {roomid: [callable]} mutations seen while the room was loading
+		self.pending = {}
+		# {roomid: (expires_at, entries)} room_history rows as read from the db
+		self.video_history = {}
+		self.total = 0
+		self.hits = 0
+		self.misses = 0
+
+	def _touch(self, roomid: str):
+		self.rooms.move_to_end(roomid)
+
+	def _enforce_global_limit(self, keep: str):
+		while self.total > self.global_limit and len(self.rooms) > 1:
+			roomid = next(iter(self.rooms))
+			if roomid == keep:
+				self._touch(roomid)
+				continue
+			evicted = self.rooms.pop(roomid)
+			self.total -= evicted.size
+			logger.debug(f"evicted history buffer: roomid`{roomid}` size`{evicted.size}`")
+
+	def _apply(self, roomid: str, mutation):
+		if roomid in self.warming:
+			self.pending.setdefault(roomid, []).append(mutation)
+			return
+		room = self.rooms.get(roomid)
+		if room is None:
+			return
+		before = room.size
+		mutation(room)
+		room.trim(self.room_limit)
+		self.total += room.size - before
+		self._enforce_global_limit(roomid)
+
+	async def _warm(self, roomid: str, page_size: int) -> RoomHistory:
+		# fetch_* raise on db errors so a failed load is never cached as an empty room
+		room = RoomHistory()
+		rows, has_more, _, _ = await async_db.fetch_messages_history(roomid, None, page_size)
+		room.has_more_before = has_more
+		for row in rows:
+			if row["message_type"] == "new_message":
+				room.add_message(dict(row))
+		for row in rows:
+			if row["message_type"] == "new_reaction" and row["reply_to"]:
+				room.add_reaction({
+					"id": row["id"],
+					"user": row["user"],
+					"message": row["message"],
+					"date": row["date"],
+					"reply_to_id": row["reply_to"]["id"],
+					"is_deleted": row["is_deleted"]
+				})
+		return room
+
+	async def get_room(self, roomid: str, page_size: int) -> RoomHistory:
+		room = self.rooms.get(roomid)
+		if room is not None:
+			self.hits += 1
+			self._touch(roomid)
+			return room
+		future = self.warming.get(roomid)
+		if future is not None:
+			return await asyncio.shield(future)
+
+		self.misses += 1
+		future = asyncio.get_running_loop().create_future()
+		self.warming[roomid] = future
+		try:
+			room = await self._warm(roomid, page_size)
+			for mutation in self.pending.pop(roomid, []):
+				mutation(room)
+			room.trim(self.room_limit)
+			self.rooms[roomid] = room
+			self.total += room.size
+			self._enforce_global_limit(roomid)
+			future.set_result(room)
+			return room
+		except asyncio.CancelledError:
+			future.cancel()
+			raise
+		except Exception as e:
+			future.set_exception(e)
+			# waiters re-raise it, mark it retrieved for the case where there are none
+			future.exception()
+			raise
+		finally:
+			self.warming.pop(roomid, None)
+			self.pending.pop(roomid, None)
+
+	async def get_page(self, roomid: str, limit: int):
+		room = await self.get_room(roomid, limit)
+		return room.page(limit)
+
+	def is_warm(self, roomid: str) -> bool:
+		return roomid in self.rooms
+
+	async def get_video_history(self, roomid: str, limit: int = VIDEO_HISTORY_LIMIT):
+		cached = self.video_history.get(roomid)
+		if cached is not None and cached[0] > monotonic():
+			return list(cached[1][:limit])
+		history = await async_db.fetch_video_history(roomid, VIDEO_HISTORY_LIMIT)
+		self.video_history[roomid] = (monotonic() + self.video_ttl, history)
+		return list(history[:limit])
+
+	def add_message(self, roomid: str, data: dict):
+		message = {
+			"id": data["id"],
+			"user": data["user"],
+			"message": data["message"],
+			"message_type": "new_message",
+			"date": data["date"],
+			"reply_to": data.get("reply_to"),
+			"is_deleted": False
+		}
+		self._apply(roomid, lambda room: room.add_message(message))
+
+	def add_reaction(self, roomid: str, data: dict):
+		reaction = {
+			"id": data["id"],
+			"user": data["user"],
+			"message": data["message"],
+			"date": data["date"],
+			"reply_to_id": _as_id(data["reply_to"]),
+			"is_deleted": False
+		}
+		self._apply(roomid, lambda room: room.add_reaction(reaction))
+
+	def update_reaction(self, roomid: str, reaction_id: int, emoji: str, date: float):
+		reaction_id = _as_id(reaction_id)
+		self._apply(roomid, lambda room: room.update_reaction(reaction_id, emoji, date))
+
+	def remove_message(self, roomid: str, message_id: int):
+		message_id = _as_id(message_id)
+		self._apply(roomid, lambda room: room.remove(message_id))
+
+	def invalidate_video_history(self, roomid: str):
+		# entries relayed by clients are not trusted, the next read goes to the db
+		self.video_history.pop(roomid, None)
+
+	def drop(self, roomid: str):
+		self.video_history.pop(roomid, None)
+		room = self.rooms.pop(roomid, None)
+		if room:
+			self.total -= room.size
+
+	def stats(self) -> dict:
+		return {"rooms": len(self.rooms), "entries": self.total, "hits": self.hits, "misses": self.misses, "video_rooms": len(self.video_history)}
@@ -0,0 +1,57 @@
+from typing import Optional
+from fastapi import WebSocket
+from send_queue import SendQueue
+
+
+class ChatSession:
+	__slots__ = ("websocket", "user", "roomid", "queue")
+
+	def __init__(self, websocket: WebSocket, user: str, roomid: str):
+		self.websocket = websocket
+		self.user = user
+		self.roomid = roomid
+		# outbound frames, drained by the queue's writer task
+		self.queue = SendQueue(websocket, name=f"{user}@{roomid}")
+
+
+class SessionRegistry:
+	def __init__(self):
+		# {websocket: ChatSession}
+		self.by_socket = {}
+		# {roomid: {username: ChatSession}}
+		self.rooms = {}
+
+	def add(self, websocket: WebSocket, user: str, roomid: str) -> ChatSession:
+		session = ChatSession(websocket, user, roomid)
+		session.queue.start()
+		self.by_socket[websocket] = session
+		self.rooms.setdefault(roomid, {})[user] = session
+		return session
+
+	def remove(self, websocket: WebSocket) -> Optional[ChatSession]:
+		session = self.by_socket.pop(websocket, None)
+		if session is None:
+			return None
+		session.queue.stop()
+		members = self.rooms.get(session.roomid)
+		if members is not None and members.get(session.user) is session:
+			del members[session.user]
+			if not members:
+				del self.rooms[session.roomid]
+		return session
+
+	def get(self, websocket: WebSocket) -> Optional[ChatSession]:
+		return self.by_socket.get(websocket)
+
+	def member(self, roomid: str, user: str) -> Optional[ChatSession]:
+		members = self.rooms.get(roomid)
+		return members.get(user) if members else None
+
+	def members(self, roomid: str) -> dict:
+		return self.rooms.get(roomid, {})
+
+	def has_room(self, roomid: str) -> bool:
+		return roomid in self.rooms
+
+	def __len__(self):
+		return len(self.by_socket)
@@ -0,0 +1,132 @@
+import asyncio
+import hmac
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from os import getenv, urandom
+from time import monotonic
+from bcrypt import checkpw
+
+logger = logging.getLogger("credentials")
+
+BCRYPT_WORKERS = int(getenv("BCRYPT_WORKERS", "2"))
+CRED_CACHE_TTL = float(getenv("CRED_CACHE_TTL", "300"))
+CRED_CACHE_MAX = int(getenv("CRED_CACHE_MAX", "4096"))
+
+
+class CredentialVerifier:
+	def __init__(self, workers: int = BCRYPT_WORKERS, ttl: float = CRED_CACHE_TTL, max_entries: int = CRED_CACHE_MAX):
+		self.ttl = ttl
+		self.max_entries = max_entries
+		self._executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="bcrypt")
+		# bounds queued work so a reconnect storm can't pile up thousands of bcrypt jobs
+		self._slots = asyncio.Semaphore(max(1, workers) * 4)
+		# per-process key, cached secrets never sit in memory in plain or unsalted form
+		self._digest_key = urandom(32)
+		# {(principal, secret_digest, stored_hash): expires_at}
+		self._cache = OrderedDict()
+		# {principal: {key in _cache}} so dropping a principal's entries doesn't scan the cache
+		self._keys = {}
+		# {principal: (stored_hash, expires_at)} last hash seen, used to drop entries when it
+		# changes. bounded like _cache, an expired entry can't have live cache entries behind it
+		self._hashes = OrderedDict()
+		# {(principal, secret_digest, stored_hash): future} dedupes concurrent checks of the same secret
+		self._inflight = {}
+		# callables(principal, stored_hash) told when a verify sees a hash other than the last one
+		self.listeners = []
+		self.hits = 0
+		self.misses = 0
+
+	def _secret_digest(self, secret: str) -> bytes:
+		return hmac.new(self._digest_key, secret.encode(), sha256).digest()
+
+	def invalidate(self, principal: str):
+		self._hashes.pop(principal, None)
+		for key in self._keys.pop(principal, ()):
+			self._cache.pop(key, None)
+
+	def _cache_drop(self, key):
+		self._cache.pop(key, None)
+		keys = self._keys.get(key[0])
+		if keys is not None:
+			keys.discard(key)
+			if not keys:
+				del self._keys[key[0]]
+
+	def _cache_get(self, key) -> bool:
+		expires_at = self._cache.get(key)
+		if expires_at is None:
+			return False
+		if expires_at < monotonic():
+			self._cache_drop(key)
+			return False
+		self._cache.move_to_end(key)
+		return True
+
+	def _cache_put(self, key):
+		self._cache[key] = monotonic() + self.ttl
+		self._cache.move_to_end(key)
+		self._keys.setdefault(key[0], set()).add(key)
+		while len(self._cache) > self.max_entries:
+			self._cache_drop(next(iter(self._cache)))
+
+	def _known_hash(self, principal: str):
+		entry = self._hashes.get(principal)
+		if entry is None or entry[1] < monotonic():
+			return None
+		return entry[0]
+
+	def _remember_hash(self, principal: str, stored_hash: str):
+		self._hashes[principal] = (stored_hash, monotonic() + self.ttl)
+		self._hashes.move_to_end(principal)
+		while len(self._hashes) > self.max_entries:
+			self._hashes.popitem(last=False)
+
+	async def verify(self, principal: str, secret: str, stored_hash: str) -> bool:
+		if not secret or not stored_hash:
+			return False
+		if self._known_hash(principal) != stored_hash:
+			self.invalidate(principal)
+			for listener in self.listeners:
+				listener(principal, stored_hash)
+		self._remember_hash(principal, stored_hash)
+		key = (principal, self._secret_digest(secret), stored_hash)
+		if self._cache_get(key):
+			self.hits += 1
+			return True
+		self.misses += 1
+
+		pending = self._inflight.get(key)
+		if pending is not None:
+			return await asyncio.shield(pending)
+
+		loop = asyncio.get_running_loop()
+		future = loop.create_future()
+		self._inflight[key] = future
+		try:
+			async with self._slots:
+				ok = await loop.run_in_executor(self._executor, checkpw, secret.encode(), stored_hash.encode())
+			if ok and self._known_hash(principal) == stored_hash:
+				self._cache_put(key)
+			future.set_result(ok)
+			return ok
+		except Exception as e:
+			logger.error(f"verify error: {e}")
+			return False
+		finally:
+			if not future.done():
+				future.set_result(False)
+			self._inflight.pop(key, None)
+
+	def stats(self) -> dict:
+		return {"size": len(self._cache), "principals": len(self._hashes), "hits": self.hits, "misses": self.misses}
+
+	def shutdown(self):
+		self._executor.shutdown(wait=False)
+		self._cache.clear()
+		self._keys.clear()
+		self._hashes.clear()
+
+
+verifier = CredentialVerifier()
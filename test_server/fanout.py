@@ -0,0 +1,94 @@
+import logging
+from json import dumps
+from time import perf_counter
+from starlette.websockets import WebSocketState
+
+logger = logging.getLogger("fanout")
+
+
+def is_connected(websocket) -> bool:
+	try:
+		return (
+			websocket.client_state == WebSocketState.CONNECTED and
+			websocket.application_state == WebSocketState.CONNECTED
+		)
+	except:
+		return False
+
+
+class Delivery:
+	# one broadcast across its recipients' queues, recorded when the last of them
+	# has sent or dropped its frame
+	__slots__ = ("fanout", "label", "started", "pending", "delivered")
+
+	def __init__(self, fanout, label: str):
+		self.fanout = fanout
+		self.label = label
+		self.started = perf_counter()
+		# held at one until every frame is queued
+		self.pending = 1
+		self.delivered = 0
+
+	def finish(self, sent: bool):
+		if sent:
+			self.delivered += 1
+		self.pending -= 1
+		if self.pending == 0 and self.delivered:
+			self.fanout._record(perf_counter() - self.started, self.delivered, self.label)
+
+
+class FanOut:
+	# hands frames to each session's SendQueue, the per-connection writer tasks
+	# do the actual sends concurrently with their own timeouts. latency is from the
+	# broadcast call until the last recipient's send completed
+	def __init__(self, slow_broadcast_secs: float = 0.25):
+		self.slow_broadcast_secs = slow_broadcast_secs
+		self.broadcasts = 0
+		self.sends = 0
+		self.dropped = 0
+		self.last_latency = 0.0
+		self.max_latency = 0.0
+		self.avg_latency = 0.0
+
+	def send_many(self, pairs, label: str = "broadcast", key: str | None = None) -> int:
+		# pairs: [(session, text)], returns the number of frames queued
+		delivery = Delivery(self, label)
+		queued = 0
+		for session, text in pairs:
+			if not is_connected(session.websocket):
+				continue
+			delivery.pending += 1
+			if session.queue.put(text, key, delivery):
+				queued += 1
+			else:
+				self.dropped += 1
+		delivery.finish(False)
+		return queued
+
+	def broadcast(self, sessions, payload, exclude_user: str | None = None, label: str = "broadcast", key: str | None = None) -> int:
+		# serializes once, sessions is any iterable of ChatSession
+		text = payload if isinstance(payload, str) else dumps(payload)
+		return self.send_many(
+			[(session, text) for session in list(sessions) if session.user != exclude_user],
+			label,
+			key
+		)
+
+	def _record(self, latency: float, recipients: int, label: str):
+		self.broadcasts += 1
+		self.sends += recipients
+		self.last_latency = latency
+		self.max_latency = max(self.max_latency, latency)
+		self.avg_latency += (latency - self.avg_latency) * 0.05
+		if latency > self.slow_broadcast_secs:
+			logger.warning(f"{label}: slow broadcast {latency * 1000:.1f}ms to {recipients} recipients")
+
+	def stats(self) -> dict:
+		return {
+			"broadcasts": self.broadcasts,
+			"sends": self.sends,
+			"dropped": self.dropped,
+			"last_latency_ms": round(self.last_latency * 1000, 3),
+			"avg_latency_ms": round(self.avg_latency * 1000, 3),
+			"max_latency_ms": round(self.max_latency * 1000, 3)
+		}
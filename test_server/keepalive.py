@@ -0,0 +1,112 @@
+import asyncio
+import logging
+from json import dumps
+from os import getenv
+from time import monotonic, time
+from traceback import print_exc
+
+logger = logging.getLogger("keepalive")
+
+KEEPALIVE_INTERVAL = float(getenv("KEEPALIVE_INTERVAL", "20"))
+KEEPALIVE_TIMEOUT = float(getenv("KEEPALIVE_TIMEOUT", "50"))
+KEEPALIVE_BUCKETS = int(getenv("KEEPALIVE_BUCKETS", "20"))
+
+
+class KeepaliveScheduler:
+	# one task for every socket: connections are spread over buckets and each wakeup
+	# sweeps one bucket, so every socket is visited once per interval
+	def __init__(self, interval: float = KEEPALIVE_INTERVAL, timeout: float = KEEPALIVE_TIMEOUT, buckets: int = KEEPALIVE_BUCKETS, close_timeout: float = 5):
+		self.interval = interval
+		self.timeout = timeout
+		self.close_timeout = close_timeout
+		self.buckets = [set() for _ in range(max(1, buckets))]
+		# {websocket: (bucket index, monotonic time of last pong)}
+		self.entries = {}
+		self.next_bucket = 0
+		self.cursor = 0
+		self.task = None
+		self.send = None
+		self.close = None
+		self.pings = 0
+		self.timeouts = 0
+
+	def start(self, send, close):
+		# send(websocket, text) queues a frame, close(websocket) is awaited for dead sockets
+		self.send = send
+		self.close = close
+		if self.task is None:
+			self.task = asyncio.create_task(self._run())
+
+	async def stop(self):
+		if self.task:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
+
+	def add(self, websocket):
+		index = self.next_bucket
+		self.next_bucket = (self.next_bucket + 1) % len(self.buckets)
+		self.buckets[index].add(websocket)
+		self.entries[websocket] = (index, monotonic())
+
+	def remove(self, websocket):
+		entry = self.entries.pop(websocket, None)
+		if entry is not None:
+			self.buckets[entry[0]].discard(websocket)
+
+	def touch(self, websocket):
+		entry = self.entries.get(websocket)
+		if entry is not None:
+			self.entries[websocket] = (entry[0], monotonic())
+
+	async def sweep(self):
+		bucket = self.buckets[self.cursor]
+		self.cursor = (self.cursor + 1) % len(self.buckets)
+		if not bucket:
+			return
+		now = monotonic()
+		dead = []
+		# one ping payload per sweep, shared by the whole bucket
+		ping = dumps({"type": "server_ping", "ts": time()})
+		for websocket in list(bucket):
+			if now - self.entries[websocket][1] > self.timeout:
+				dead.append(websocket)
+				continue
+			try:
+				self.send(websocket, ping)
+				self.pings += 1
+			except:
+				print_exc()
+		for websocket in dead:
+			self.remove(websocket)
+		if dead:
+			self.timeouts += len(dead)
+			logger.debug(f"keepalive timeout: closing {len(dead)} sockets")
+			await asyncio.gather(*(self._close(websocket) for websocket in dead))
+
+	async def _close(self, websocket):
+		try:
+			await asyncio.wait_for(self.close(websocket), self.close_timeout)
+		except:
+			pass
+
+	async def _run(self):
+		step = self.interval / len(self.buckets)
+		while True:
+			await asyncio.sleep(step)
+			try:
+				await self.sweep()
+			except asyncio.CancelledError:
+				raise
+			except:
+				print_exc()
+
+	def stats(self) -> dict:
+		return {
+			"connections": len(self.entries),
+			"pings": self.pings,
+			"timeouts": self.timeouts
+		}
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+from os import getenv
+from time import monotonic
+import async_db
+
+logger = logging.getLogger("messageWriter")
+
+MESSAGE_BATCH_SIZE = int(getenv("MESSAGE_BATCH_SIZE", "100"))
+MESSAGE_FLUSH_INTERVAL = float(getenv("MESSAGE_FLUSH_INTERVAL", "0.05"))
+MESSAGE_QUEUE_SIZE = int(getenv("MESSAGE_QUEUE_SIZE", "5000"))
+MESSAGE_ID_BLOCK = int(getenv("MESSAGE_ID_BLOCK", "1000"))
+
+
+class MessageWriter:
+	# ids are reserved from the db counter in blocks, so other writers of the messages
+	# table get disjoint ranges; ids left in a block at shutdown are just a gap
+	def __init__(self, batch_size: int = MESSAGE_BATCH_SIZE, flush_interval: float = MESSAGE_FLUSH_INTERVAL, max_queue: int = MESSAGE_QUEUE_SIZE, id_block: int = MESSAGE_ID_BLOCK):
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.queue = asyncio.Queue(maxsize=max_queue)
+		self.id_block = id_block
+		self.next_id = 0
+		self.block_end = 0
+		self.id_lock = asyncio.Lock()
+		# id -> reply_to of rows submitted but not written yet
+		self.pending = {}
+		# reply_to -> number of pending rows pointing at it (replies, reactions)
+		self.pending_refs = {}
+		# async callback(rows) for rows that could not be written at all
+		self.on_dropped = None
+		self.task = None
+		self.submitted = 0
+		self.persisted = 0
+		# [(sequence, future)] callers of flush() waiting for a sequence to be written
+		self.waiters = []
+		self.batches = 0
+		self.failed = 0
+		self.retries = 3
+
+	async def start(self):
+		if self.task:
+			return
+		await async_db.init_message_ids()
+		self.task = asyncio.create_task(self._run())
+		logger.info("message writer started")
+
+	async def allocate_id(self) -> int:
+		if self.next_id >= self.block_end:
+			async with self.id_lock:
+				# whoever held the lock may already have reserved a fresh block
+				if self.next_id >= self.block_end:
+					first = await async_db.reserve_message_ids(self.id_block)
+					self.next_id, self.block_end = first, first + self.id_block
+		message_id = self.next_id
+		self.next_id += 1
+		return message_id
+
+	async def submit(self, roomid: str, user: str, message: str, message_type: str, reply_to=None):
+		if self.task is None or self.task.done():
+			# not running (startup failed or shutting down), write through
+			try:
+				message_id = await self.allocate_id()
+			except Exception as e:
+				logger.error(f"submit: could not reserve an id: {e}")
+				return None
+			return message_id if await async_db.insert_messages([(message_id, roomid, user, message, message_type, reply_to)]) else None
+		message_id = await self.allocate_id()
+		self.submitted += 1
+		self.pending[message_id] = reply_to
+		if reply_to:
+			self.pending_refs[reply_to] = self.pending_refs.get(reply_to, 0) + 1
+		# blocks the sender when the queue is full, that is the backpressure
+		await self.queue.put((message_id, roomid, user, message, message_type, reply_to))
+		return message_id
+
+	def is_pending(self, message_id: int) -> bool:
+		# the row itself or a reply/reaction to it is still queued
+		return message_id in self.pending or message_id in self.pending_refs
+
+	async def flush(self, message_id: int = None):
+		# waits until everything submitted so far is in the db, used before reads that must
+		# see it. with a message_id only if that message or a row pointing at it is queued
+		if self.persisted >= self.submitted or self.task is None or self.task.done():
+			return
+		if message_id is not None and not self.is_pending(message_id):
+			return
+		future = asyncio.get_running_loop().create_future()
+		self.waiters.append((self.submitted, future))
+		await future
+
+	def _wake_waiters(self):
+		still_waiting = []
+		for sequence, future in self.waiters:
+			if sequence <= self.persisted:
+				if not future.done():
+					future.set_result(None)
+			else:
+				still_waiting.append((sequence, future))
+		self.waiters = still_waiting
+
+	async def _collect(self) -> list:
+		batch = [await self.queue.get()]
+		deadline = monotonic() + self.flush_interval
+		while len(batch) < self.batch_size:
+			try:
+				batch.append(self.queue.get_nowait())
+				continue
+			except asyncio.QueueEmpty:
+				pass
+			remaining = deadline - monotonic()
+			if remaining <= 0:
+				break
+			try:
+				batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+			except asyncio.TimeoutError:
+				break
+		return batch
+
+	async def _write(self, batch: list):
+		for attempt in range(self.retries):
+			if await async_db.insert_messages(batch):
+				self.batches += 1
+				break
+			await asyncio.sleep(0.2 * (attempt + 1))
+		else:
+			# one bad row fails the whole INSERT, write them one by one so only it is lost
+			dropped = [row for row in batch if not await async_db.insert_messages([row])]
+			if dropped:
+				self.failed += len(dropped)
+				logger.error(f"dropping {len(dropped)} of {len(batch)} messages after {self.retries} failed batch inserts: ids`{[row[0] for row in dropped]}`")
+				if self.on_dropped:
+					try:
+						await self.on_dropped(dropped)
+					except Exception as e:
+						logger.error(f"on_dropped error: {e}")
+		for row in batch:
+			reply_to = self.pending.pop(row[0], None)
+			if reply_to:
+				count = self.pending_refs.get(reply_to, 0) - 1
+				if count > 0:
+					self.pending_refs[reply_to] = count
+				else:
+					self.pending_refs.pop(reply_to, None)
+		self.persisted += len(batch)
+		for _ in batch:
+			self.queue.task_done()
+		self._wake_waiters()
+
+	async def _run(self):
+		while True:
+			batch = await self._collect()
+			await self._write(batch)
+
+	async def stop(self, timeout: float = 10):
+		if not self.task:
+			return
+		try:
+			await asyncio.wait_for(self.queue.join(), timeout)
+		except asyncio.TimeoutError:
+			logger.error(f"message writer stop timed out, {self.queue.qsize()} messages not written")
+		self.task.cancel()
+		try:
+			await self.task
+		except asyncio.CancelledError:
+			pass
+		self.task = None
+		for _, future in self.waiters:
+			if not future.done():
+				future.set_result(None)
+		self.waiters = []
+
+	def stats(self) -> dict:
+		return {
+			"queued": self.queue.qsize(),
+			"pending": len(self.pending),
+			"submitted": self.submitted,
+			"persisted": self.persisted,
+			"batches": self.batches,
+			"failed": self.failed
+		}
@@ -0,0 +1,103 @@
+import asyncio
+import logging
+from collections import OrderedDict
+from os import getenv
+from time import monotonic
+
+logger = logging.getLogger("rateLimit")
+
+RATE_LIMIT_MAX_KEYS = int(getenv("RATE_LIMIT_MAX_KEYS", "1000000"))
+# keys checked per slice of the periodic sweep before yielding to the loop
+RATE_LIMIT_SWEEP_CHUNK = 10000
+
+
+class RateLimiter:
+	# GCRA: each key is one float, its theoretical arrival time (tat). a request is
+	# allowed while tat is less than a window ahead of now, each allowed request
+	# pushes tat forward by window/max_requests. a key whose tat is in the past is
+	# indistinguishable from an unseen one, so it can be dropped
+	def __init__(self, max_requests: int = 30, window_seconds: float = 60, max_keys: int = RATE_LIMIT_MAX_KEYS):
+		self.max_requests = max_requests
+		self.window_seconds = window_seconds
+		self.interval = window_seconds / max_requests
+		# how far ahead tat may run and still admit a request, epsilon for float drift
+		self.tolerance = window_seconds - self.interval + 1e-9
+		self.max_keys = max_keys
+		# {key: tat}, least recently used first
+		self.tats = OrderedDict()
+		self.task = None
+		self.limited = 0
+		self.evicted = 0
+
+	def is_allowed(self, key: str, cost: int = 1) -> bool:
+		# cost > 1 takes several requests' worth at once (batched frames)
+		now = monotonic()
+		increment = self.interval * cost
+		tat = self.tats.get(key)
+		if tat is None or tat < now:
+			tat = now
+		if tat - now > self.tolerance - increment + self.interval:
+			if key in self.tats:
+				self.tats.move_to_end(key)
+			self.limited += 1
+			return False
+		self.tats[key] = tat + increment
+		self.tats.move_to_end(key)
+		if len(self.tats) > self.max_keys:
+			# over the cap the least recently seen key forgets its history
+			self.tats.popitem(last=False)
+			self.evicted += 1
+		return True
+
+	def _expire(self, keys, now: float) -> int:
+		# lru order says nothing about expiry, every key is checked against its own tat
+		removed = 0
+		for key in keys:
+			tat = self.tats.get(key)
+			if tat is not None and tat <= now:
+				del self.tats[key]
+				removed += 1
+		return removed
+
+	def cleanup(self) -> int:
+		# drops every expired key in one pass
+		return self._expire(list(self.tats), monotonic())
+
+	async def sweep(self, chunk: int = RATE_LIMIT_SWEEP_CHUNK) -> int:
+		# same as cleanup, in slices so a million keys don't stall the loop. keys touched
+		# between slices have a tat past the sweep's now and are kept
+		now = monotonic()
+		keys = list(self.tats)
+		removed = 0
+		for start in range(0, len(keys), chunk):
+			removed += self._expire(keys[start:start + chunk], now)
+			await asyncio.sleep(0)
+		return removed
+
+	def start(self, every: float | None = None):
+		if self.task is None:
+			self.task = asyncio.create_task(self._run(every or self.window_seconds))
+		return self
+
+	async def stop(self):
+		if self.task:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
+
+	async def _run(self, every: float):
+		while True:
+			await asyncio.sleep(every)
+			removed = await self.sweep()
+			if removed:
+				logger.debug(f"rate limiter cleanup: removed {removed} idle keys, {len(self.tats)} left")
+
+	def stats(self) -> dict:
+		return {
+			"keys": len(self.tats),
+			"limited": self.limited,
+			"evicted": self.evicted
+		}
@@ -0,0 +1,192 @@
+import asyncio
+import logging
+from collections import deque
+from os import getenv
+from time import monotonic, perf_counter
+
+logger = logging.getLogger("sendQueue")
+
+SEND_QUEUE_MAX = int(getenv("SEND_QUEUE_MAX", "256"))
+SEND_QUEUE_HIGH_WATER = int(getenv("SEND_QUEUE_HIGH_WATER", "64"))
+SEND_QUEUE_HIGH_WATER_SECS = float(getenv("SEND_QUEUE_HIGH_WATER_SECS", "10"))
+SEND_TIMEOUT = float(getenv("SEND_TIMEOUT", "10"))
+# close code sent to consumers that can't keep up, distinct from 1008/1011
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+
+class SendQueue:
+	evictions = 0
+
+	def __init__(self, websocket, name: str = "", max_size: int = SEND_QUEUE_MAX, high_water: int = SEND_QUEUE_HIGH_WATER, high_water_secs: float = SEND_QUEUE_HIGH_WATER_SECS, send_timeout: float = SEND_TIMEOUT):
+		self.websocket = websocket
+		self.name = name
+		self.max_size = max_size
+		self.high_water = high_water
+		self.high_water_secs = high_water_secs
+		self.send_timeout = send_timeout
+		# [key, payload, alive, delivery] entries, superseded ones stay in place with alive=False
+		# until the next compaction
+		self.entries = deque()
+		# {key: entry} latest queued entry per coalescing key
+		self.keyed = {}
+		self.depth = 0
+		self.max_depth = 0
+		self.over_since = None
+		self.wakeup = asyncio.Event()
+		self.closed = False
+		self.evicted = False
+		self.task = None
+		self.sent = 0
+		self.coalesced = 0
+		self.dropped = 0
+		self.send_latency = 0.0
+
+	def start(self):
+		self.task = asyncio.create_task(self._run())
+		return self
+
+	def put(self, payload, key: str | None = None, delivery=None) -> bool:
+		# payload is str (send_text) or bytes (send_bytes); a key makes it latest-wins.
+		# delivery.finish(sent) is called once the frame is sent or dropped
+		if self.closed:
+			self.dropped += 1
+			if delivery is not None:
+				delivery.finish(False)
+			return False
+		if key is not None:
+			old = self.keyed.get(key)
+			if old is not None and old[2]:
+				self._discard(old)
+				self.depth -= 1
+				self.coalesced += 1
+				if len(self.entries) > 2 * self.depth + 16:
+					# superseded entries count against memory too, keep them at most as many as live ones
+					self.entries = deque(entry for entry in self.entries if entry[2])
+		entry = [key, payload, True, delivery]
+		self.entries.append(entry)
+		if key is not None:
+			self.keyed[key] = entry
+		self.depth += 1
+		if self.depth > self.max_depth:
+			self.max_depth = self.depth
+		self._check_pressure()
+		self.wakeup.set()
+		return not self.closed
+
+	def _check_pressure(self):
+		if self.depth >= self.max_size:
+			self.evict(f"queue full ({self.depth})")
+		elif self.depth > self.high_water:
+			now = monotonic()
+			if self.over_since is None:
+				self.over_since = now
+			elif now - self.over_since > self.high_water_secs:
+				self.evict(f"over high water for {now - self.over_since:.1f}s")
+		else:
+			self.over_since = None
+
+	def evict(self, reason: str):
+		if self.closed:
+			return
+		logger.warning(f"evicting slow consumer {self.name}: {reason}")
+		SendQueue.evictions += 1
+		self.evicted = True
+		self._drop_all()
+		asyncio.create_task(self._close("Slow consumer"))
+
+	async def _close(self, reason: str):
+		try:
+			await asyncio.wait_for(self.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE, reason=reason), self.send_timeout)
+		except:
+			pass
+		self.stop()
+
+	def _discard(self, entry):
+		entry[2] = False
+		if entry[3] is not None:
+			entry[3].finish(False)
+
+	def _drop_all(self):
+		self.closed = True
+		self.dropped += self.depth
+		for entry in self.entries:
+			if entry[2]:
+				self._discard(entry)
+		self.entries.clear()
+		self.keyed.clear()
+		self.depth = 0
+		self.wakeup.set()
+
+	async def _run(self):
+		try:
+			while not self.closed:
+				if not self.entries:
+					self.wakeup.clear()
+					await self.wakeup.wait()
+					continue
+				entry = self.entries.popleft()
+				key, payload, alive, delivery = entry
+				if not alive:
+					continue
+				if key is not None and self.keyed.get(key) is entry:
+					del self.keyed[key]
+				self.depth -= 1
+				if self.depth <= self.high_water:
+					self.over_since = None
+				start = perf_counter()
+				try:
+					if isinstance(payload, bytes):
+						await asyncio.wait_for(self.websocket.send_bytes(payload), self.send_timeout)
+					else:
+						await asyncio.wait_for(self.websocket.send_text(payload), self.send_timeout)
+				except asyncio.TimeoutError:
+					if delivery is not None:
+						delivery.finish(False)
+					self.evict(f"send timed out after {self.send_timeout}s")
+					return
+				except Exception as e:
+					logger.debug(f"send failed for {self.name}: {e}")
+					if delivery is not None:
+						delivery.finish(False)
+					self._drop_all()
+					return
+				self.sent += 1
+				self.send_latency += (perf_counter() - start - self.send_latency) * 0.05
+				if delivery is not None:
+					delivery.finish(True)
+		except asyncio.CancelledError:
+			pass
+
+	def stop(self):
+		if not self.closed:
+			self._drop_all()
+		if self.task and not self.task.done() and self.task is not asyncio.current_task():
+			self.task.cancel()
+
+	def stats(self) -> dict:
+		return {
+			"depth": self.depth,
+			"max_depth": self.max_depth,
+			"sent": self.sent,
+			"coalesced": self.coalesced,
+			"dropped": self.dropped,
+			"send_latency_ms": round(self.send_latency * 1000, 3)
+		}
+
+
+def aggregate_stats(queues) -> dict:
+	depths = []
+	totals = {"sent": 0, "coalesced": 0, "dropped": 0}
+	for queue in queues:
+		depths.append(queue.depth)
+		totals["sent"] += queue.sent
+		totals["coalesced"] += queue.coalesced
+		totals["dropped"] += queue.dropped
+	return {
+		"connections": len(depths),
+		"total_depth": sum(depths),
+		"max_depth": max(depths, default=0),
+		"over_high_water": sum(1 for d in depths if d > SEND_QUEUE_HIGH_WATER),
+		"evictions": SendQueue.evictions,
+		**totals
+	}
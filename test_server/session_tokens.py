@@ -0,0 +1,157 @@
+import asyncio
+import hmac
+import logging
+from collections import OrderedDict
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+from hashlib import sha256
+from os import getenv, urandom
+from time import monotonic, time
+from typing import Optional
+from dotenv import load_dotenv
+import async_db
+from credentials import verifier
+
+load_dotenv()
+
+logger = logging.getLogger("session_tokens")
+
+SESSION_TOKEN_TTL = int(getenv("SESSION_TOKEN_TTL", str(12 * 3600)))
+# a login that sees a new password hash revokes tokens at once; a change nobody logs in
+# with is picked up by the background re-read of all cached hashes, at most this late
+TOKEN_EPOCH_SWEEP = float(getenv("TOKEN_EPOCH_SWEEP", "60"))
+TOKEN_EPOCH_MAX = int(getenv("TOKEN_EPOCH_MAX", "4096"))
+MAX_TOKEN_LENGTH = 1024
+TOKEN_VERSION = "2"
+
+_secret = getenv("SESSION_TOKEN_SECRET")
+if _secret:
+	_key = _secret.encode()
+else:
+	# tokens won't survive a restart or be shared between wsschat and wssvideoSync
+	logger.warning("SESSION_TOKEN_SECRET not set, using a per-process key")
+	_key = urandom(32)
+
+
+def _b64encode(data: bytes) -> str:
+	return urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+def _b64decode(data: str) -> bytes:
+	return urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+def _sign(payload: str) -> str:
+	return _b64encode(hmac.new(_key, payload.encode("ascii"), sha256).digest())
+
+def password_epoch(user_hash: str, room_hash: str) -> str:
+	# changes whenever either password does, without putting the hashes in the token
+	return _b64encode(hmac.new(_key, f"epoch\0{user_hash}\0{room_hash}".encode(), sha256).digest()[:9])
+
+# token: {version}.{b64 user}.{b64 roomid}.{b64 room name}.{epoch}.{expires}.{b64 hmac}
+def issue_token(user: str, roomid: str, room_name: str, epoch: str, ttl: int = SESSION_TOKEN_TTL) -> str:
+	expires = int(time()) + ttl
+	payload = f"{TOKEN_VERSION}.{_b64encode(user.encode())}.{_b64encode(roomid.encode())}.{_b64encode(room_name.encode())}.{epoch}.{expires}"
+	return f"{payload}.{_sign(payload)}"
+
+def verify_token(token: str) -> Optional[tuple[str, str, str, str]]:
+	# signature and expiry only, returns (user, roomid, room_name, epoch); check_token also
+	# checks the epoch against the current passwords
+	if not token or len(token) > MAX_TOKEN_LENGTH:
+		return None
+	try:
+		payload, sig = token.rsplit(".", 1)
+		version, user_b64, roomid_b64, name_b64, epoch, expires = payload.split(".")
+		if version != TOKEN_VERSION:
+			return None
+		if not hmac.compare_digest(sig, _sign(payload)):
+			return None
+		if int(expires) < time():
+			return None
+		user = _b64decode(user_b64).decode("utf-8")
+		roomid = _b64decode(roomid_b64).decode("utf-8")
+		room_name = _b64decode(name_b64).decode("utf-8")
+	except (ValueError, UnicodeError, BinasciiError):
+		return None
+	if not user or not roomid:
+		return None
+	return user, roomid, room_name, epoch
+
+def token_expires_at(token: str) -> int:
+	try:
+		return int(token.rsplit(".", 2)[1])
+	except (ValueError, IndexError):
+		return 0
+
+# password hashes behind the epochs, least recently used first. kept until a change is
+# seen, so check_token only reads the db for a user or room it hasn't seen yet
+_user_hashes = OrderedDict()
+_room_hashes = OrderedDict()
+_next_sweep = 0.0
+_sweep_task = None
+
+def _remember(table: OrderedDict, key: str, stored_hash: str):
+	table[key] = stored_hash
+	table.move_to_end(key)
+	while len(table) > TOKEN_EPOCH_MAX:
+		table.popitem(last=False)
+
+def password_seen(principal: str, stored_hash: str):
+	# verifier callback, a password login read this hash from the db just now
+	kind, _, name = principal.partition(":")
+	table = _user_hashes if kind == "user" else _room_hashes if kind == "room" else None
+	if table is not None and name in table and table[name] != stored_hash:
+		logger.info(f"password changed: {principal}, revoking its session tokens")
+		table[name] = stored_hash
+
+verifier.listeners.append(password_seen)
+
+async def _sweep():
+	for table, fetch in ((_user_hashes, async_db.fetch_user_hashes), (_room_hashes, async_db.fetch_room_hashes)):
+		fresh = await fetch(list(table))
+		if fresh is None:
+			continue
+		for key in list(table):
+			stored_hash = fresh.get(key)
+			if stored_hash is None:
+				# deleted
+				table.pop(key, None)
+			elif table.get(key) != stored_hash:
+				table[key] = stored_hash
+
+def _schedule_sweep():
+	global _next_sweep, _sweep_task
+	now = monotonic()
+	if now < _next_sweep or (_sweep_task and not _sweep_task.done()):
+		return
+	_next_sweep = now + TOKEN_EPOCH_SWEEP
+	_sweep_task = asyncio.create_task(_sweep())
+
+async def current_epoch(user: str, roomid: str, refresh: bool = False) -> Optional[str]:
+	_schedule_sweep()
+	user_hash = _user_hashes.get(user)
+	room_hash = _room_hashes.get(roomid)
+	if refresh or user_hash is None or room_hash is None:
+		hashes = await async_db.fetch_password_hashes(user, roomid)
+		if not hashes:
+			return None
+		user_hash, room_hash = hashes
+	_remember(_user_hashes, user, user_hash)
+	_remember(_room_hashes, roomid, room_hash)
+	return password_epoch(user_hash, room_hash)
+
+async def issue_session_token(user: str, roomid: str, room_name: str) -> Optional[str]:
+	# called right after a password login, so the epoch is read fresh
+	epoch = await current_epoch(user, roomid, refresh=True)
+	if epoch is None:
+		return None
+	return issue_token(user, roomid, room_name, epoch)
+
+async def check_token(token: str) -> Optional[tuple[str, str, str]]:
+	# (user, roomid, room_name) for a valid token whose passwords haven't changed since
+	claims = verify_token(token)
+	if not claims:
+		return None
+	user, roomid, room_name, epoch = claims
+	current = await current_epoch(user, roomid)
+	if current is None or not hmac.compare_digest(epoch, current):
+		return None
+	return user, roomid, room_name
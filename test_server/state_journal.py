@@ -0,0 +1,188 @@
+import asyncio
+import logging
+import os
+from json import dumps, loads
+from os import getenv
+from time import monotonic, time
+from traceback import print_exc
+
+logger = logging.getLogger("stateJournal")
+
+JOURNAL_FLUSH_INTERVAL = float(getenv("JOURNAL_FLUSH_INTERVAL", "0.2"))
+JOURNAL_SNAPSHOT_INTERVAL = float(getenv("JOURNAL_SNAPSHOT_INTERVAL", "60"))
+JOURNAL_MAX_BYTES = int(getenv("JOURNAL_MAX_BYTES", str(4 * 1024 * 1024)))
+
+
+def room_record(room, kind: str) -> list:
+	# [roomid, kind, url, anchor position, is_playing, subtitle_exist, wall time of the anchor]
+	state = room.state
+	anchored = time() - (monotonic() - state.anchor_at)
+	return [room.roomid, kind, state.url, state.anchor_position, state.is_playing, state.subtitle_exist, anchored]
+
+
+class StateJournal:
+	# append-only log of room state changes plus a periodic snapshot, so a restart can
+	# rebuild rooms without the db. one record per change holds the room's whole state,
+	# replay keeps the last one per room. disabled (every call a no-op) without a directory
+	def __init__(self, directory: str | None, flush_interval: float = JOURNAL_FLUSH_INTERVAL, snapshot_interval: float = JOURNAL_SNAPSHOT_INTERVAL, max_bytes: int = JOURNAL_MAX_BYTES):
+		self.directory = directory
+		self.flush_interval = flush_interval
+		self.snapshot_interval = snapshot_interval
+		self.max_bytes = max_bytes
+		self.journal_path = os.path.join(directory, "state.journal") if directory else None
+		self.snapshot_path = os.path.join(directory, "state.snapshot") if directory else None
+		self.pending = []
+		self.file = None
+		self.size = 0
+		self.last_snapshot = monotonic()
+		self.task = None
+		self.closing = False
+		self.snapshot_source = None
+		self.records = 0
+		self.flushes = 0
+		self.snapshots = 0
+
+	@property
+	def enabled(self) -> bool:
+		return self.directory is not None
+
+	def replay(self, limit: int | None = None) -> dict:
+		# {roomid: (url, position, is_playing, subtitle_exist)} from snapshot plus journal tail,
+		# positions of playing rooms are carried forward to now. with a limit only the rooms
+		# changed most recently come back
+		if not self.enabled:
+			return {}
+		started = monotonic()
+		latest = {}
+		try:
+			with open(self.snapshot_path, encoding="utf-8") as f:
+				for record in loads(f.read()):
+					latest[record[0]] = record
+		except FileNotFoundError:
+			pass
+		except:
+			print_exc()
+		try:
+			with open(self.journal_path, encoding="utf-8") as f:
+				for line in f:
+					try:
+						record = loads(line)
+					except ValueError:
+						# torn line from a crash mid-write
+						continue
+					# moved to the end, so the dict stays in order of last change
+					latest.pop(record[0], None)
+					latest[record[0]] = record
+		except FileNotFoundError:
+			pass
+		now = time()
+		rooms = {}
+		records = list(latest.values())
+		if limit is not None and len(records) > limit:
+			logger.warning(f"journal holds {len(records)} rooms, replaying the {limit} changed last")
+			records = records[-limit:] if limit > 0 else []
+		for roomid, _, url, position, is_playing, subtitle_exist, anchored in records:
+			if is_playing:
+				position += max(0.0, now - anchored)
+			rooms[roomid] = (url, position, is_playing, subtitle_exist)
+		logger.info(f"replayed {len(rooms)} rooms from journal in {(monotonic() - started) * 1000:.1f}ms")
+		return rooms
+
+	def record(self, room, kind: str):
+		if not self.enabled:
+			return
+		self.pending.append(room_record(room, kind))
+		self.records += 1
+
+	def start(self, snapshot_source):
+		# snapshot_source() returns the rooms a snapshot should hold
+		if not self.enabled or self.task is not None:
+			return
+		os.makedirs(self.directory, exist_ok=True)
+		self.snapshot_source = snapshot_source
+		self.file = open(self.journal_path, "a+", encoding="utf-8")
+		self.size = self.file.tell()
+		if self.size:
+			self.file.seek(self.size - 1)
+			if self.file.read(1) != "\n":
+				# keep a torn record on its own line so it can't swallow the next one
+				self.file.write("\n")
+				self.size += 1
+		self.task = asyncio.create_task(self._run())
+
+	async def stop(self):
+		if self.task is None:
+			return
+		# not cancelled, a write running in a thread must finish before the final snapshot
+		self.closing = True
+		await self.task
+		self.task = None
+		try:
+			# a final snapshot leaves an empty journal for the next start to replay
+			await self.snapshot()
+		except:
+			print_exc()
+		await asyncio.to_thread(self.file.close)
+		self.file = None
+
+	async def flush(self):
+		if not self.pending:
+			return
+		batch, self.pending = self.pending, []
+		data = "".join(dumps(record, separators=(",", ":")) + "\n" for record in batch)
+		try:
+			await asyncio.to_thread(self._append, data)
+		except:
+			# put the batch back ahead of anything recorded meanwhile, the next flush retries it
+			self.pending = batch + self.pending
+			raise
+		self.size += len(data)
+		self.flushes += 1
+
+	def _append(self, data: str):
+		self.file.write(data)
+		self.file.flush()
+		os.fsync(self.file.fileno())
+
+	async def snapshot(self):
+		# the snapshot is taken on the loop after everything pending is written, so every
+		# journal record is covered by it and the journal can start over
+		await self.flush()
+		records = [room_record(room, "snapshot") for room in self.snapshot_source()]
+		data = dumps(records, separators=(",", ":"))
+		await asyncio.to_thread(self._replace, data)
+		self.size = 0
+		self.last_snapshot = monotonic()
+		self.snapshots += 1
+
+	def _replace(self, data: str):
+		tmp_path = self.snapshot_path + ".tmp"
+		with open(tmp_path, "w", encoding="utf-8") as f:
+			f.write(data)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_path, self.snapshot_path)
+		self.file.truncate(0)
+		self.file.seek(0)
+		os.fsync(self.file.fileno())
+
+	async def _run(self):
+		while not self.closing:
+			await asyncio.sleep(self.flush_interval)
+			try:
+				if self.size >= self.max_bytes or monotonic() - self.last_snapshot >= self.snapshot_interval:
+					await self.snapshot()
+				else:
+					await self.flush()
+			except:
+				print_exc()
+
+	def stats(self) -> dict:
+		return {
+			"enabled": self.enabled,
+			"records": self.records,
+			"pending": len(self.pending),
+			"flushes": self.flushes,
+			"snapshots": self.snapshots,
+			"journal_bytes": self.size
+		}
@@ -0,0 +1,94 @@
+import asyncio
+from math import ceil
+from os import getenv
+from traceback import print_exc
+
+TYPING_TICK = float(getenv("TYPING_TICK", "0.25"))
+TYPING_TTL = float(getenv("TYPING_TTL", "10"))
+
+
+class TypingPresence:
+	# typers expire through one shared timer wheel, rooms whose typer set changed
+	# get a single aggregated callback per tick
+	def __init__(self, tick: float = TYPING_TICK, ttl: float = TYPING_TTL):
+		self.tick = tick
+		self.ttl_ticks = max(1, ceil(ttl / tick))
+		# one slot per tick of the ttl, each holds (roomid, user) due in that slot
+		self.wheel = [set() for _ in range(self.ttl_ticks + 1)]
+		self.current = 0
+		# {roomid: {user: expiry tick}}
+		self.typing = {}
+		self.dirty = set()
+		self.task = None
+		self.on_change = None
+		self.expired = 0
+		self.frames = 0
+
+	def start(self, on_change):
+		# on_change(roomid, typers) is called once per tick for each changed room
+		self.on_change = on_change
+		if self.task is None:
+			self.task = asyncio.create_task(self._run())
+
+	async def stop(self):
+		if self.task:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
+
+	def start_typing(self, roomid: str, user: str):
+		typers = self.typing.setdefault(roomid, {})
+		expiry = self.current + self.ttl_ticks
+		if user not in typers:
+			self.dirty.add(roomid)
+		typers[user] = expiry
+		# a refreshed typer leaves its old slot entry behind, it is skipped when that slot fires
+		self.wheel[expiry % len(self.wheel)].add((roomid, user))
+
+	def stop_typing(self, roomid: str, user: str):
+		typers = self.typing.get(roomid)
+		if typers is None or typers.pop(user, None) is None:
+			return
+		if not typers:
+			del self.typing[roomid]
+		self.dirty.add(roomid)
+
+	def drop(self, roomid: str):
+		self.typing.pop(roomid, None)
+		self.dirty.discard(roomid)
+
+	def typers(self, roomid: str) -> list:
+		return list(self.typing.get(roomid, ()))
+
+	def advance(self):
+		self.current += 1
+		slot = self.wheel[self.current % len(self.wheel)]
+		for roomid, user in slot:
+			typers = self.typing.get(roomid)
+			if typers is not None and typers.get(user) == self.current:
+				self.expired += 1
+				self.stop_typing(roomid, user)
+		slot.clear()
+		dirty, self.dirty = self.dirty, set()
+		for roomid in dirty:
+			self.frames += 1
+			try:
+				self.on_change(roomid, self.typers(roomid))
+			except:
+				print_exc()
+
+	async def _run(self):
+		while True:
+			await asyncio.sleep(self.tick)
+			self.advance()
+
+	def stats(self) -> dict:
+		return {
+			"rooms": len(self.typing),
+			"typers": sum(len(t) for t in self.typing.values()),
+			"expired": self.expired,
+			"frames": self.frames
+		}
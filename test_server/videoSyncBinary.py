@@ -1,16 +1,31 @@
+import asyncio
 import struct
 from enum import IntEnum
 from dataclasses import dataclass, field
 from datetime import datetime, timedelta
 from typing import Optional
+from time import monotonic, time as wall_time
 from fastapi import WebSocket
 import logging
+from send_queue import SendQueue
+from traceback import print_exc
 
 logger = logging.getLogger("videoSyncBinary")
 
 MAX_URL_LENGTH = 2048
 MAX_TIME = 0xFFFFFFFF
 MAX_CRED_LENGTH = 255
+MAX_TOKEN_LENGTH = 1024
+# BATCH limits, sub-ops can't be AUTH/AUTH_TOKEN or another BATCH
+MAX_BATCH_OPS = 16
+BATCH_OPS_ALLOWED = {0x01, 0x02, 0x03, 0x04, 0x07, 0x0B, 0x0C}
+# v1: whole seconds. v2: millisecond positions plus server timestamp and room sequence
+# in TIME/STATE/INIT, the sequence also trails URL, SUBTITLE_FLAG and successful update
+# ACKs, and may trail SYNC_REQ/UPTODATE from the client.
+# clients ask for a version with a trailing byte on AUTH/AUTH_TOKEN
+PROTOCOL_VERSION = 2
+# smoothing factor for rtt/offset samples, same as tcp's srtt
+CLOCK_ALPHA = 0.125
 
 # opcodes
 class OP(IntEnum):
@@ -23,6 +38,11 @@ class OP(IntEnum):
     UPTODATE = 0x07
     SUBTITLE_FLAG = 0x08
     AUTH = 0x09
+    AUTH_TOKEN = 0x0A
+    PING = 0x0B
+    PONG = 0x0C
+    RATE = 0x0D
+    BATCH = 0x0E
 
 ACK_SUCCESS = 1
 ACK_FAIL = 0
@@ -30,12 +50,63 @@ ACK_FAIL = 0
 @dataclass
 class PlayerState:
     url: str = ""
-    time: int = 0
     is_playing: bool = False
     subtitle_exist: bool = False
     url_user: str = ""
     time_user: str = ""
     playing_user: str = ""
+    # playback anchor: position in seconds at anchor_at (monotonic), advances at rate while playing
+    anchor_position: float = 0.0
+    anchor_at: float = field(default_factory=monotonic)
+    rate: float = 1.0
+    # bumped by every change to what plyr_status stores, compared against the saved revision
+    revision: int = 0
+    
+    def position(self, now: Optional[float] = None) -> float:
+        if not self.is_playing:
+            return self.anchor_position
+        if now is None:
+            now = monotonic()
+        return min(max(0.0, self.anchor_position + (now - self.anchor_at) * self.rate), MAX_TIME)
+    
+    def anchor(self, position: float, is_playing: Optional[bool] = None, rate: Optional[float] = None, now: Optional[float] = None):
+        # re-anchor on every change so the position never jumps when play state or rate flips
+        self.anchor_position = min(max(0.0, float(position)), MAX_TIME)
+        self.anchor_at = monotonic() if now is None else now
+        if is_playing is not None:
+            self.is_playing = is_playing
+        if rate is not None:
+            self.rate = rate
+        self.revision += 1
+    
+    def set_playing(self, is_playing: bool):
+        self.anchor(self.position(), is_playing=is_playing)
+    
+    def set_subtitle_exist(self, exist: bool) -> bool:
+        if self.subtitle_exist != exist:
+            self.subtitle_exist = exist
+            self.revision += 1
+            return True
+        return False
+    
+    @property
+    def time(self) -> int:
+        # current position, extrapolated from the anchor
+        return int(self.position())
+    
+    @time.setter
+    def time(self, value: float):
+        self.anchor(value)
+    
+    def restore(self, url, time_val, is_playing, subtitle_exist):
+        # applies a plyr_status row or journal record, tolerating the loose column types of old rows
+        self.url = url or ""
+        try:
+            position = float(time_val) if time_val else 0
+        except (ValueError, TypeError):
+            position = 0
+        self.anchor(position, is_playing=bool(is_playing))
+        self.subtitle_exist = bool(subtitle_exist)
 
 @dataclass
 class Connection:
@@ -43,6 +114,55 @@ class Connection:
     user: str
     is_uptodate: bool = False
     last_action_time: dict = field(default_factory=dict)
+    queue: Optional[SendQueue] = None
+    version: int = 1
+    # while a BATCH is handled, replies collect here and leave as one BATCH frame
+    replies: Optional[list] = None
+    # smoothed round trip and client clock minus server clock, seconds
+    rtt: float = 0.0
+    clock_offset: float = 0.0
+    rtt_samples: int = 0
+    # last reported position minus the room clock, seconds (positive = ahead)
+    drift: float = 0.0
+    # monotonic time of the last drift seek sent to this client
+    hard_seek_at: Optional[float] = None
+    
+    @property
+    def one_way(self) -> float:
+        return self.rtt / 2
+    
+    def record_clock_sample(self, rtt: float, offset: float):
+        if self.rtt_samples == 0:
+            self.rtt = rtt
+            self.clock_offset = offset
+        else:
+            self.rtt += (rtt - self.rtt) * CLOCK_ALPHA
+            self.clock_offset += (offset - self.clock_offset) * CLOCK_ALPHA
+        self.rtt_samples += 1
+
+@dataclass
+class PendingBroadcast:
+    # TIME/STATE changes accepted since the last tick, flushed as one frame
+    state: bool = False
+    passive: bool = True
+    # only v1 connections need it (drift reports from v2 clients)
+    v1_only: bool = True
+    # "" when the tick's events came from more than one user
+    exclude_user: str = ""
+    events: int = 0
+    
+    def add(self, user: str, kind: str, passive: bool = False, v1_only: bool = False):
+        if kind == 'state':
+            self.state = True
+        self.passive = self.passive and passive
+        self.v1_only = self.v1_only and v1_only
+        # a sole writer already has the final state; once two users wrote in the same
+        # tick nobody is skipped, the earlier one's change was overridden
+        if self.events == 0:
+            self.exclude_user = user
+        elif user != self.exclude_user:
+            self.exclude_user = ""
+        self.events += 1
 
 class Room:
     def __init__(self, roomid: str):
@@ -50,17 +170,79 @@ class Room:
         self.state = PlayerState()
         self.connections: dict[str, Connection] = {}
         self.timeout_secs = 0.5
+        # state version: bumped on every state change, sent to v2 clients so they can drop
+        # frames older than what they have and tell the server what they last saw
+        self.seq = 0
+        # seq of the last url or subtitle change, clients older than this need a full INIT
+        self.reset_seq = 0
+        self.pending: Optional[PendingBroadcast] = None
+        # monotonic time the last connection left, None while anyone is connected
+        self.empty_since: Optional[float] = monotonic()
+        # state.revision and time of the last successful write to plyr_status
+        self.saved_revision = 0
+        self.saved_at = monotonic()
+    
+    def needs_save(self, max_age: float = 0) -> bool:
+        if self.state.revision != self.saved_revision:
+            return True
+        # a playing room's stored position falls behind without any change
+        return self.state.is_playing and monotonic() - self.saved_at >= max_age
+    
+    def mark_saved(self, revision: int):
+        self.saved_revision = revision
+        self.saved_at = monotonic()
+    
+    def schedule(self, user: str, kind: str, passive: bool = False, v1_only: bool = False):
+        if self.pending is None:
+            self.pending = PendingBroadcast()
+        self.pending.add(user, kind, passive, v1_only)
     
-    def add_connection(self, user: str, websocket: WebSocket) -> Optional[Connection]:
+    def next_seq(self, reset: bool = False) -> int:
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+        if reset:
+            self.reset_seq = self.seq
+        return self.seq
+    
+    def add_connection(self, user: str, websocket: WebSocket, version: int = 1) -> Optional[Connection]:
         existing = self.connections.get(user)
         if existing:
             return existing
-        conn = Connection(websocket=websocket, user=user, is_uptodate=False)
+        conn = Connection(websocket=websocket, user=user, is_uptodate=False, version=version)
+        conn.queue = SendQueue(websocket, name=f"{user}@{self.roomid}").start()
         self.connections[user] = conn
+        self.empty_since = None
         return None
     
-    def remove_connection(self, user: str):
-        self.connections.pop(user, None)
+    def replace_websocket(self, user: str, websocket: WebSocket, version: int = 1):
+        conn = self.connections[user]
+        if conn.queue:
+            conn.queue.stop()
+        conn.websocket = websocket
+        conn.version = version
+        conn.queue = SendQueue(websocket, name=f"{user}@{self.roomid}").start()
+        conn.is_uptodate = False
+    
+    def remove_connection(self, user: str, websocket: Optional[WebSocket] = None):
+        conn = self.connections.get(user)
+        if not conn:
+            return
+        # a kicked socket disconnecting late must not remove its replacement
+        if websocket is not None and conn.websocket is not websocket:
+            return
+        if conn.queue:
+            conn.queue.stop()
+        del self.connections[user]
+        if not self.connections:
+            self.empty_since = monotonic()
+    
+    def send(self, user: str, data: bytes, key: Optional[str] = None) -> bool:
+        conn = self.connections.get(user)
+        if not conn or not conn.queue:
+            return False
+        if conn.replies is not None:
+            conn.replies.append(data)
+            return True
+        return conn.queue.put(data, key)
     
     def get_connection(self, user: str) -> Optional[Connection]:
         return self.connections.get(user)
@@ -87,154 +269,333 @@ class Room:
             conn.last_action_time[action] = now
         return True
 
+def to_ms(time: float) -> int:
+    return min(max(0, int(round(time * 1000))), MAX_TIME)
+
+def seq_before(a: int, b: int) -> bool:
+    # serial number comparison, room seq wraps at 32 bits
+    return 0 < ((b - a) & 0xFFFFFFFF) < 0x80000000
+
+def server_ts() -> int:
+    # wall clock ms, v2 clients compare it against their own clock
+    return int(wall_time() * 1000)
+
+# compiled once, the format strings are never rebuilt per frame
+TIME_V1 = struct.Struct('>BBL')       # [opcode][flags][time s]
+TIME_V2 = struct.Struct('>BBLQL')     # [opcode][flags][time ms][server ts ms][seq]
+STATE_V1 = struct.Struct('>BBBL')     # [opcode][req_id][playing][time s]
+STATE_V2 = struct.Struct('>BBBLQL')   # [opcode][req_id][playing][time ms][server ts ms][seq]
+URL_HEAD = struct.Struct('>BBH')      # [opcode][req_id][url_len], url follows
+INIT_TAIL_V1 = struct.Struct('>LBB')  # after the url: [time s][playing][subtitle]
+INIT_TAIL_V2 = struct.Struct('>LBBQL')  # after the url: [time ms][playing][subtitle][server ts ms][seq]
+ACK = struct.Struct('>BBB')           # [opcode][req_id][status]
+ACK_EXT = struct.Struct('>BBBB')      # [opcode][req_id][status][err_len or negotiated version]
+ACK_SEQ = struct.Struct('>BBBL')      # v2 update ack: [opcode][req_id][status][seq]
+PING = struct.Struct('>BBQ')          # [opcode][flags][sender ts ms]
+PONG = struct.Struct('>BBQQ')         # [opcode][flags][echoed ts][responder ts ms]
+RATE = struct.Struct('>BBHL')         # [opcode][req_id][rate thousandths][duration ms]
+FLAG = struct.Struct('>BBB')          # [opcode][req_id][flag]
+FLAG_V2 = struct.Struct('>BBBL')      # [opcode][req_id][flag][seq]
+BATCH_HEAD = struct.Struct('>BBB')    # [opcode][req_id][count], then count x [2B len][sub-frame]
+U16 = struct.Struct('>H')
+U32 = struct.Struct('>L')
+U64 = struct.Struct('>Q')
+QQ = struct.Struct('>QQ')
+
+# one preallocated buffer per fixed-size layout, filled with pack_into and copied out as
+# owned bytes; reused for every frame since encoding never yields to the event loop
+TIME_V1_BUF = bytearray(TIME_V1.size)
+TIME_V2_BUF = bytearray(TIME_V2.size)
+STATE_V1_BUF = bytearray(STATE_V1.size)
+STATE_V2_BUF = bytearray(STATE_V2.size)
+ACK_BUF = bytearray(ACK.size)
+ACK_EXT_BUF = bytearray(ACK_EXT.size)
+ACK_SEQ_BUF = bytearray(ACK_SEQ.size)
+PING_BUF = bytearray(PING.size)
+PONG_BUF = bytearray(PONG.size)
+RATE_BUF = bytearray(RATE.size)
+FLAG_BUF = bytearray(FLAG.size)
+FLAG_V2_BUF = bytearray(FLAG_V2.size)
+
+def _pack_with_url(head_op: int, request_id: int, url_bytes: bytes, tail: Optional[struct.Struct] = None, *tail_values) -> bytes:
+    # url frames are variable length, so there is no buffer to reuse; concatenate the
+    # packed header and tail into owned bytes
+    head = URL_HEAD.pack(head_op, request_id & 0x7F, len(url_bytes))
+    if tail:
+        return head + url_bytes + tail.pack(*tail_values)
+    return head + url_bytes
+
 class BinaryProtocol:
 		# convert values to raw bytes for network transmission - pack values into bytes
     @staticmethod
-    def encode_time(time: int, request_id: int = 0, passive: bool = False) -> bytes:
+    def encode_time(time: float, request_id: int = 0, passive: bool = False, version: int = 1, seq: int = 0) -> bytes:
         # bits 0-6 store request_id (max 127), bit 7 stores passive flag
         flags = (request_id & 0x7F) | (0x80 if passive else 0) 
-        return struct.pack('>BBL', OP.TIME, flags, int(time)) # [opcode:1B][flags:1B][time:4B] = 6 bytes
+        if version >= 2:
+            TIME_V2.pack_into(TIME_V2_BUF, 0, OP.TIME, flags, to_ms(time), server_ts(), seq) # 18 bytes
+            return bytes(TIME_V2_BUF)
+        TIME_V1.pack_into(TIME_V1_BUF, 0, OP.TIME, flags, int(time)) # 6 bytes
+        return bytes(TIME_V1_BUF)
     
     @staticmethod
-    def encode_state(is_playing: bool, time: int, request_id: int = 0) -> bytes:
-        # >BBBL = 1B opcode, 1B req_id, 1B playing, 4B time
-        return struct.pack('>BBBL', OP.STATE, request_id & 0x7F, 1 if is_playing else 0, int(time))
+    def encode_state(is_playing: bool, time: float, request_id: int = 0, version: int = 1, seq: int = 0) -> bytes:
+        if version >= 2:
+            STATE_V2.pack_into(STATE_V2_BUF, 0, OP.STATE, request_id & 0x7F, 1 if is_playing else 0, to_ms(time), server_ts(), seq)
+            return bytes(STATE_V2_BUF)
+        STATE_V1.pack_into(STATE_V1_BUF, 0, OP.STATE, request_id & 0x7F, 1 if is_playing else 0, int(time))
+        return bytes(STATE_V1_BUF)
     
     @staticmethod
-    def encode_url(url: str, request_id: int = 0) -> bytes:
-        url_bytes = url.encode('utf-8')
-        # >BBH{n}s = 1B opcode, 1B req_id, 2B url_len, nB url
-        return struct.pack(f'>BBH{len(url_bytes)}s', OP.URL, request_id & 0x7F, len(url_bytes), url_bytes)
+    def encode_url(url: str, request_id: int = 0, version: int = 1, seq: int = 0) -> bytes:
+        # 1B opcode, 1B req_id, 2B url_len, nB url, v2 adds 4B seq
+        if version >= 2:
+            return _pack_with_url(OP.URL, request_id, url.encode('utf-8'), U32, seq)
+        return _pack_with_url(OP.URL, request_id, url.encode('utf-8'))
     
     @staticmethod
-    def encode_init(state: PlayerState, request_id: int = 0) -> bytes:
+    def encode_init(state: PlayerState, request_id: int = 0, version: int = 1, seq: int = 0, at: Optional[float] = None) -> bytes:
+        # at: monotonic time the position is computed for, defaults to now
+        # 1B op, 1B req_id, 2B url_len, nB url, then the version's tail
         url_bytes = state.url.encode('utf-8')
-        # >BBH{n}sLBB = 1B op, 1B req_id, 2B url_len, nB url, 4B time, 1B playing, 1B subtitle
-        return struct.pack(
-            f'>BBH{len(url_bytes)}sLBB',
-            OP.INIT,
-            request_id & 0x7F,
-            len(url_bytes),
-            url_bytes,
-            int(state.time),
-            1 if state.is_playing else 0,
-            1 if state.subtitle_exist else 0
-        )
+        playing = 1 if state.is_playing else 0
+        subtitle = 1 if state.subtitle_exist else 0
+        if version >= 2:
+            return _pack_with_url(OP.INIT, request_id, url_bytes, INIT_TAIL_V2, to_ms(state.position(at)), playing, subtitle, server_ts(), seq)
+        return _pack_with_url(OP.INIT, request_id, url_bytes, INIT_TAIL_V1, int(state.position(at)), playing, subtitle)
     
     @staticmethod
-    def encode_ack(success: bool, request_id: int = 0, error: Optional[str] = None) -> bytes:
+    def encode_ack(success: bool, request_id: int = 0, error: Optional[str] = None, protocol_version: Optional[int] = None, seq: Optional[int] = None) -> bytes:
+        if seq is not None and success:
+            # v2 ack of an accepted update or an unchanged SYNC_REQ: 1B op, 1B req_id, 1B status, 4B seq
+            ACK_SEQ.pack_into(ACK_SEQ_BUF, 0, OP.ACK, request_id & 0x7F, ACK_SUCCESS, seq)
+            return bytes(ACK_SEQ_BUF)
+        if protocol_version is not None:
+            # auth ack for clients that asked for a version: 1B op, 1B req_id, 1B status, 1B negotiated version
+            ACK_EXT.pack_into(ACK_EXT_BUF, 0, OP.ACK, request_id & 0x7F, ACK_SUCCESS, protocol_version)
+            return bytes(ACK_EXT_BUF)
         if error:
-            err_bytes = error.encode('utf-8')[:255]
             # with error: 1B op, 1B req_id, 1B status, 1B err_len, nB err
-            return struct.pack(f'>BBBB{len(err_bytes)}s', OP.ACK, request_id & 0x7F, ACK_FAIL, len(err_bytes), err_bytes)
+            err_bytes = error.encode('utf-8')[:255]
+            return ACK_EXT.pack(OP.ACK, request_id & 0x7F, ACK_FAIL, len(err_bytes)) + err_bytes
         # no error: 1B op, 1B req_id, 1B status
-        return struct.pack('>BBB', OP.ACK, request_id & 0x7F, ACK_SUCCESS if success else ACK_FAIL)
+        ACK.pack_into(ACK_BUF, 0, OP.ACK, request_id & 0x7F, ACK_SUCCESS if success else ACK_FAIL)
+        return bytes(ACK_BUF)
     
     @staticmethod
-    def encode_subtitle_flag(exists: bool, request_id: int = 0) -> bytes:
-        return struct.pack('>BBB', OP.SUBTITLE_FLAG, request_id & 0x7F, 1 if exists else 0)
+    def encode_ping(ts: int) -> bytes:
+        PING.pack_into(PING_BUF, 0, OP.PING, 0, ts)
+        return bytes(PING_BUF)
+    
+    @staticmethod
+    def encode_pong(echo: int, ts: int) -> bytes:
+        PONG.pack_into(PONG_BUF, 0, OP.PONG, 0, echo, ts)
+        return bytes(PONG_BUF)
+    
+    @staticmethod
+    def encode_rate(rate: float, duration: float, request_id: int = 0) -> bytes:
+        # v2 only: play at rate (thousandths, 1000 = normal) for duration, then go back to 1.0
+        RATE.pack_into(RATE_BUF, 0, OP.RATE, request_id & 0x7F, min(max(0, int(round(rate * 1000))), 0xFFFF), min(max(0, int(duration * 1000)), MAX_TIME))
+        return bytes(RATE_BUF)
+    
+    @staticmethod
+    def encode_subtitle_flag(exists: bool, request_id: int = 0, version: int = 1, seq: int = 0) -> bytes:
+        if version >= 2:
+            FLAG_V2.pack_into(FLAG_V2_BUF, 0, OP.SUBTITLE_FLAG, request_id & 0x7F, 1 if exists else 0, seq)
+            return bytes(FLAG_V2_BUF)
+        FLAG.pack_into(FLAG_BUF, 0, OP.SUBTITLE_FLAG, request_id & 0x7F, 1 if exists else 0)
+        return bytes(FLAG_BUF)
+    
+    @staticmethod
+    def encode_batch(frames: list, request_id: int = 0) -> bytes:
+        # v2 only: several complete frames in one, each keeps its own opcode and request_id
+        # sized up front and filled with pack_into, so no per-frame header bytes are built
+        buffer = bytearray(BATCH_HEAD.size + U16.size * len(frames) + sum(map(len, frames)))
+        BATCH_HEAD.pack_into(buffer, 0, OP.BATCH, request_id & 0x7F, len(frames))
+        offset = BATCH_HEAD.size
+        for frame in frames:
+            U16.pack_into(buffer, offset, len(frame))
+            offset += U16.size
+            buffer[offset:offset + len(frame)] = frame
+            offset += len(frame)
+        return bytes(buffer)
+    
+    @staticmethod
+    def batch_size(data: bytes) -> int:
+        # ops a frame counts as for rate limiting, read before decoding
+        if len(data) >= 3 and data[0] == OP.BATCH:
+            return max(1, min(data[2], MAX_BATCH_OPS))
+        return 1
     
 		# convert raw bytes back to values - unpacks bytes to values
     @staticmethod
-    def decode(data: bytes) -> Optional[dict]:
-        # data[i] reads single byte
+    def decode(data: bytes, version: int = 1) -> Optional[dict]:
+        # version is the connection's negotiated protocol, times are returned in seconds
         if len(data) < 2:
             return None
-        opcode = data[0]
-        flags = data[1]
+        view = memoryview(data)
+        decoder = DECODERS.get(view[0])
+        if decoder is None:
+            return None
         # 0x7F = 01111111, masks out bit 7, keeps bits 0-6
         # 0x80 = 10000000, checks if bit 7 is set
-        request_id = flags & 0x7F
-        timeout_pass = bool(flags & 0x80)
-        
+        flags = view[1]
         try:
-            if opcode == OP.TIME:
-                if len(data) < 6:
-                    return None
-                # >L = 4B unsigned long (time in seconds)
-                time = struct.unpack('>L', data[2:6])[0]
-                return {'type': 'time', 'request_id': request_id, 'time': time, 'timeout_pass': timeout_pass}
-            
-            elif opcode == OP.STATE:
-                if len(data) < 7:
-                    return None
-                is_playing = data[2] == 1
-                time = struct.unpack('>L', data[3:7])[0]
-                return {'type': 'state', 'request_id': request_id, 'is_playing': is_playing, 'time': time}
-            
-            elif opcode == OP.URL:
-                if len(data) < 4:
-                    return None
-                # >H = 2B unsigned short (url length)
-                url_len = struct.unpack('>H', data[2:4])[0]
-                if url_len > MAX_URL_LENGTH:
-                    logger.warn(f"URL too long: {url_len}")
-                    return None
-                if len(data) < 4 + url_len:
-                    return None
-                try:
-                    url = data[4:4+url_len].decode('utf-8', errors='strict')
-                except UnicodeDecodeError:
-                    logger.warn("Invalid UTF-8 in URL")
-                    return None
-                return {'type': 'url', 'request_id': request_id, 'url': url}
-            
-            elif opcode == OP.SYNC_REQ:
-                return {'type': 'sync_req', 'request_id': request_id}
-            
-            elif opcode == OP.UPTODATE:
-                return {'type': 'uptodate', 'request_id': request_id}
-            
-            elif opcode == OP.AUTH:
-                # AUTH: 1B op, 1B userLen, nB user, 1B pswLen, nB psw, 1B roomLen, nB room, 1B roomPswLen, nB roomPsw
-                offset = 1
-                if len(data) < offset + 1:
-                    return None
-                user_len = data[offset]; offset += 1
-                if user_len > MAX_CRED_LENGTH or len(data) < offset + user_len:
-                    return None
-                try:
-                    user = data[offset:offset+user_len].decode('utf-8', errors='strict'); offset += user_len
-                except UnicodeDecodeError:
-                    return None
-                if len(data) < offset + 1:
-                    return None
-                psw_len = data[offset]; offset += 1
-                if psw_len > MAX_CRED_LENGTH or len(data) < offset + psw_len:
-                    return None
-                try:
-                    psw = data[offset:offset+psw_len].decode('utf-8', errors='strict'); offset += psw_len
-                except UnicodeDecodeError:
-                    return None
-                if len(data) < offset + 1:
-                    return None
-                room_len = data[offset]; offset += 1
-                if room_len > MAX_CRED_LENGTH or len(data) < offset + room_len:
-                    return None
-                try:
-                    roomid = data[offset:offset+room_len].decode('utf-8', errors='strict'); offset += room_len
-                except UnicodeDecodeError:
-                    return None
-                if len(data) < offset + 1:
-                    return None
-                roompsw_len = data[offset]; offset += 1
-                if roompsw_len > MAX_CRED_LENGTH or len(data) < offset + roompsw_len:
-                    return None
-                try:
-                    roompsw = data[offset:offset+roompsw_len].decode('utf-8', errors='strict')
-                except UnicodeDecodeError:
-                    return None
-                return {'type': 'auth', 'user': user, 'psw': psw, 'roomid': roomid, 'roompsw': roompsw}
-            
-            else:
-                return None
+            return decoder(view, flags & 0x7F, bool(flags & 0x80), version)
         except Exception as e:
             logger.error(f"Decode error: {e}")
             return None
 
+# decoders get (view, request_id, flag bit 7, version) and never copy more than the strings they return
+
+def _decode_time(view: memoryview, request_id: int, timeout_pass: bool, version: int) -> Optional[dict]:
+    if len(view) < 6:
+        return None
+    # v1 seconds, v2 milliseconds
+    time = U32.unpack_from(view, 2)[0]
+    if version >= 2:
+        time /= 1000
+    return {'type': 'time', 'request_id': request_id, 'time': time, 'timeout_pass': timeout_pass}
+
+def _decode_state(view: memoryview, request_id: int, timeout_pass: bool, version: int) -> Optional[dict]:
+    if len(view) < 7:
+        return None
+    time = U32.unpack_from(view, 3)[0]
+    if version >= 2:
+        time /= 1000
+    return {'type': 'state', 'request_id': request_id, 'is_playing': view[2] == 1, 'time': time}
+
+def _decode_url(view: memoryview, request_id: int, timeout_pass: bool, version: int) -> Optional[dict]:
+    if len(view) < 4:
+        return None
+    url_len = U16.unpack_from(view, 2)[0]
+    if url_len > MAX_URL_LENGTH:
+        logger.warn(f"URL too long: {url_len}")
+        return None
+    if len(view) < 4 + url_len:
+        return None
+    try:
+        url = str(view[4:4+url_len], 'utf-8', 'strict')
+    except UnicodeDecodeError:
+        logger.warn("Invalid UTF-8 in URL")
+        return None
+    return {'type': 'url', 'request_id': request_id, 'url': url}
+
+def _seen_seq(view: memoryview, version: int) -> Optional[int]:
+    # v2 SYNC_REQ/UPTODATE may carry the last seq the client applied
+    if version >= 2 and len(view) >= 6:
+        return U32.unpack_from(view, 2)[0]
+    return None
+
+def _decode_sync_req(view: memoryview, request_id: int, timeout_pass: bool, version: int) -> Optional[dict]:
+    return {'type': 'sync_req', 'request_id': request_id, 'seen': _seen_seq(view, version)}
+
+def _decode_uptodate(view: memoryview, request_id: int, timeout_pass: bool, version: int) -> Optional[dict]:
+    return {'type': 'uptodate', 'request_id': request_id, 'seen': _seen_seq(view, version)}
+
+def _decode_ping(view: memoryview, request_id: int, timeout_pass: bool, version: int) -> Optional[dict]:
+    if len(view) < 10:
+        return None
+    return {'type': 'ping', 'ts': U64.unpack_from(view, 2)[0]}
+
+def _decode_pong(view: memoryview, request_id: int, timeout_pass: bool, version: int) -> Optional[dict]:
+    if len(view) < 18:
+        return None
+    echo, ts = QQ.unpack_from(view, 2)
+    return {'type': 'pong', 'echo': echo, 'ts': ts}
+
+def _decode_auth(view: memoryview, request_id: int, timeout_pass: bool, version: int) -> Optional[dict]:
+    # AUTH: 1B op, then user, psw, room, roomPsw as 1B len + nB utf-8 each, optional 1B version
+    # there is no flags byte, the first length sits at offset 1
+    fields = []
+    offset = 1
+    for _ in range(4):
+        if len(view) < offset + 1:
+            return None
+        length = view[offset]; offset += 1
+        if length > MAX_CRED_LENGTH or len(view) < offset + length:
+            return None
+        try:
+            fields.append(str(view[offset:offset+length], 'utf-8', 'strict'))
+        except UnicodeDecodeError:
+            return None
+        offset += length
+    # optional trailing 1B requested protocol version, v1 clients don't send it
+    requested = view[offset] if len(view) > offset else 1
+    user, psw, roomid, roompsw = fields
+    return {'type': 'auth', 'user': user, 'psw': psw, 'roomid': roomid, 'roompsw': roompsw, 'version': requested}
+
+def _decode_auth_token(view: memoryview, request_id: int, timeout_pass: bool, version: int) -> Optional[dict]:
+    # AUTH_TOKEN: 1B op, 2B tokenLen, nB token (session token issued by /session_token), optional 1B version
+    if len(view) < 3:
+        return None
+    token_len = U16.unpack_from(view, 1)[0]
+    if token_len > MAX_TOKEN_LENGTH or len(view) < 3 + token_len:
+        return None
+    try:
+        token = str(view[3:3+token_len], 'ascii', 'strict')
+    except UnicodeDecodeError:
+        return None
+    requested = view[3+token_len] if len(view) > 3 + token_len else 1
+    return {'type': 'auth_token', 'token': token, 'version': requested}
+
+def _decode_batch(view: memoryview, request_id: int, timeout_pass: bool, version: int) -> Optional[dict]:
+    if version < 2 or len(view) < 3:
+        return None
+    count = view[2]
+    if count == 0 or count > MAX_BATCH_OPS:
+        logger.warn(f"Bad batch size: {count}")
+        return None
+    ops = []
+    offset = 3
+    for _ in range(count):
+        if len(view) < offset + 2:
+            return None
+        length = U16.unpack_from(view, offset)[0]; offset += 2
+        if length < 2 or len(view) < offset + length:
+            return None
+        sub = view[offset:offset+length]; offset += length
+        if sub[0] not in BATCH_OPS_ALLOWED:
+            return None
+        flags = sub[1]
+        msg = DECODERS[sub[0]](sub, flags & 0x7F, bool(flags & 0x80), version)
+        if msg is None:
+            return None
+        ops.append(msg)
+    return {'type': 'batch', 'request_id': request_id, 'ops': ops}
+
+DECODERS = {
+    OP.TIME: _decode_time,
+    OP.STATE: _decode_state,
+    OP.URL: _decode_url,
+    OP.SYNC_REQ: _decode_sync_req,
+    OP.UPTODATE: _decode_uptodate,
+    OP.AUTH: _decode_auth,
+    OP.AUTH_TOKEN: _decode_auth_token,
+    OP.PING: _decode_ping,
+    OP.PONG: _decode_pong,
+    OP.BATCH: _decode_batch,
+}
+
 class RoomManager:
-    def __init__(self):
+    # rooms live in memory only while in use: a room nobody is connected to is saved and
+    # dropped after idle_ttl, and loaded back from the db on the next access.
+    # changed rooms are checkpointed every checkpoint_interval so a crash loses at most that much.
+    # loader(roomid) returns a plyr_status row or None and raises on db errors,
+    # saver(rooms) writes a list of rooms and returns False when it could not
+    def __init__(self, loader=None, saver=None, idle_ttl: float = 300, checkpoint_interval: float = 10):
         self.rooms: dict[str, Room] = {}
+        self.loader = loader
+        self.saver = saver
+        self.idle_ttl = idle_ttl
+        self.checkpoint_interval = checkpoint_interval
+        # {roomid: future} for loads in flight, concurrent callers share one query
+        self.loading: dict[str, asyncio.Future] = {}
+        self.task = None
+        self.loads = 0
+        self.evictions = 0
+        self.checkpoints = 0
+        self.rooms_saved = 0
+        self.save_failures = 0
     
     def get_or_create_room(self, roomid: str) -> Room:
         if roomid not in self.rooms:
@@ -244,8 +605,127 @@ class RoomManager:
     def get_room(self, roomid: str) -> Optional[Room]:
         return self.rooms.get(roomid)
     
-    def cleanup_empty_rooms(self):
-        pass
+    async def load_room(self, roomid: str) -> Room:
+        room = self.rooms.get(roomid)
+        if room is not None:
+            return room
+        future = self.loading.get(roomid)
+        if future is not None:
+            return await asyncio.shield(future)
+        future = asyncio.get_running_loop().create_future()
+        self.loading[roomid] = future
+        try:
+            row = await self.loader(roomid) if self.loader else None
+            room = self.rooms.get(roomid)
+            if room is None:
+                room = Room(roomid)
+                if row:
+                    room.state.restore(*row[1:])
+                    room.mark_saved(room.state.revision)
+                self.rooms[roomid] = room
+                self.loads += 1
+            future.set_result(room)
+            return room
+        except BaseException as e:
+            # waiters see the same failure, the next access retries
+            if isinstance(e, asyncio.CancelledError):
+                future.cancel()
+            else:
+                future.set_exception(e)
+                future.exception()
+            raise
+        finally:
+            self.loading.pop(roomid, None)
+    
+    def active_count(self) -> int:
+        return sum(1 for room in self.rooms.values() if room.connections)
+    
+    async def save(self, rooms: list) -> int:
+        # writes the rooms as they are now, a room changed during the write stays dirty
+        if not rooms:
+            return 0
+        revisions = [room.state.revision for room in rooms]
+        if self.saver and not await self.saver(rooms):
+            self.save_failures += 1
+            return 0
+        for room, revision in zip(rooms, revisions):
+            room.mark_saved(revision)
+        self.rooms_saved += len(rooms)
+        return len(rooms)
+    
+    async def checkpoint(self, max_age: float | None = None) -> int:
+        if max_age is None:
+            max_age = self.checkpoint_interval
+        dirty = [room for room in self.rooms.values() if room.needs_save(max_age)]
+        self.checkpoints += 1
+        return await self.save(dirty)
+    
+    async def cleanup_empty_rooms(self) -> int:
+        now = monotonic()
+        idle = [
+            room for room in self.rooms.values()
+            if room.empty_since is not None and now - room.empty_since >= self.idle_ttl
+        ]
+        if not idle:
+            return 0
+        revisions = {room.roomid: room.state.revision for room in idle}
+        # one write for all idle rooms that still have unsaved changes
+        dirty = [room for room in idle if room.needs_save()]
+        if dirty and not await self.save(dirty):
+            return 0
+        evicted = 0
+        for room in idle:
+            # anything that touched the room while it was being saved keeps it loaded
+            if room.connections or room.pending or self.rooms.get(room.roomid) is not room:
+                continue
+            if room.state.revision != revisions[room.roomid]:
+                continue
+            del self.rooms[room.roomid]
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+    
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._run())
+        return self
+    
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+    
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.checkpoint_interval)
+            try:
+                saved = await self.checkpoint()
+                if saved:
+                    logger.debug(f"Checkpointed {saved} rooms")
+                evicted = await self.cleanup_empty_rooms()
+                if evicted:
+                    logger.info(f"Evicted {evicted} idle rooms, {len(self.rooms)} loaded")
+            except asyncio.CancelledError:
+                raise
+            except:
+                print_exc()
     
     def get_all_states(self) -> dict:
         return {rid: room.state for rid, room in self.rooms.items()}
+    
+    def stats(self) -> dict:
+        return {
+            "loaded": len(self.rooms),
+            "active": self.active_count(),
+            "loading": len(self.loading),
+            "loads": self.loads,
+            "evictions": self.evictions,
+            "dirty": sum(1 for room in self.rooms.values() if room.state.revision != room.saved_revision),
+            "checkpoints": self.checkpoints,
+            "rooms_saved": self.rooms_saved,
+            "save_failures": self.save_failures
+        }
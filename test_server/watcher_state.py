@@ -0,0 +1,129 @@
+import asyncio
+from os import getenv
+from traceback import print_exc
+
+WATCHER_TICK = float(getenv("WATCHER_TICK", "0.25"))
+
+
+class RoomWatchers:
+	def __init__(self):
+		# {username: watcher}
+		self.watchers = {}
+		self.version = 0
+		self.changed = set()
+		self.removed = set()
+
+	def snapshot(self) -> dict:
+		return {
+			"type": "watchers_update",
+			"version": self.version,
+			"watchers": list(self.watchers.values())
+		}
+
+	def delta(self):
+		if not self.changed and not self.removed:
+			return None
+		self.version += 1
+		payload = {
+			"type": "watchers_delta",
+			"version": self.version,
+			"changed": [self.watchers[u] for u in self.changed if u in self.watchers],
+			"removed": [u for u in self.removed if u not in self.watchers]
+		}
+		self.changed.clear()
+		self.removed.clear()
+		return payload
+
+
+class WatcherState:
+	# merges watcher reports per room and emits one delta per room per tick
+	def __init__(self, tick: float = WATCHER_TICK):
+		self.tick = tick
+		# {roomid: RoomWatchers}
+		self.rooms = {}
+		# rooms with unsent changes
+		self.dirty = set()
+		self.task = None
+		self.on_delta = None
+		self.deltas_sent = 0
+
+	def start(self, on_delta):
+		# on_delta(roomid, payload) is called for each dirty room once per tick
+		self.on_delta = on_delta
+		if self.task is None:
+			self.task = asyncio.create_task(self._run())
+
+	async def stop(self):
+		if self.task:
+			self.task.cancel()
+			try:
+				await self.task
+			except asyncio.CancelledError:
+				pass
+			self.task = None
+
+	def _room(self, roomid: str) -> RoomWatchers:
+		room = self.rooms.get(roomid)
+		if room is None:
+			room = self.rooms[roomid] = RoomWatchers()
+		return room
+
+	def update(self, roomid: str, user: str, watcher: dict):
+		room = self._room(roomid)
+		if room.watchers.get(user) == watcher:
+			return
+		room.watchers[user] = watcher
+		room.changed.add(user)
+		room.removed.discard(user)
+		self.dirty.add(roomid)
+
+	def join(self, roomid: str, user: str):
+		room = self._room(roomid)
+		if user in room.watchers:
+			return
+		self.update(roomid, user, {
+			"username": user,
+			"current_time": 0,
+			"is_playing": False,
+			"is_uptodate": False,
+			"is_idle": True
+		})
+
+	def leave(self, roomid: str, user: str):
+		room = self.rooms.get(roomid)
+		if room is None or room.watchers.pop(user, None) is None:
+			return
+		room.changed.discard(user)
+		room.removed.add(user)
+		self.dirty.add(roomid)
+
+	def drop(self, roomid: str):
+		self.rooms.pop(roomid, None)
+		self.dirty.discard(roomid)
+
+	def snapshot(self, roomid: str) -> dict:
+		return self._room(roomid).snapshot()
+
+	def flush(self):
+		dirty, self.dirty = self.dirty, set()
+		for roomid in dirty:
+			room = self.rooms.get(roomid)
+			if room is None:
+				continue
+			payload = room.delta()
+			if payload is None:
+				continue
+			self.deltas_sent += 1
+			try:
+				self.on_delta(roomid, payload)
+			except:
+				print_exc()
+
+	async def _run(self):
+		while True:
+			await asyncio.sleep(self.tick)
+			if self.dirty:
+				self.flush()
+
+	def stats(self) -> dict:
+		return {"rooms": len(self.rooms), "deltas_sent": self.deltas_sent}
@@ -2,13 +2,22 @@ import logging
 from traceback import print_exc
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Query
 from asyncio import create_task, sleep, CancelledError
-from starlette.websockets import WebSocketState
 from fastapi.middleware.cors import CORSMiddleware
 from json import loads, dumps
 from json import JSONDecodeError
 from time import time
 from dotenv import load_dotenv
 import async_db
+from chat_history_cache import HistoryCache
+from message_writer import MessageWriter
+from chat_sessions import SessionRegistry
+from watcher_state import WatcherState
+from typing_presence import TypingPresence
+from keepalive import KeepaliveScheduler
+from rate_limit import RateLimiter
+from fanout import FanOut, is_connected
+from send_queue import aggregate_stats
+from session_tokens import issue_session_token, check_token
 load_dotenv()
 
 logging.basicConfig(
@@ -23,9 +32,23 @@ app = FastAPI()
 @app.on_event("startup")
 async def startup():
 	await async_db.init_pool()
+	try:
+		await chat.message_writer.start()
+	except:
+		# falls back to one INSERT per message
+		print_exc()
+	chat.watchers.start(chat.send_watchers_delta)
+	chat.typing.start(chat.send_typing_status)
+	chat.keepalive.start(chat.send_server_ping, chat.close_dead_socket)
+	chat.rate_limiter.start()
 
 @app.on_event("shutdown")
 async def shutdown():
+	await chat.watchers.stop()
+	await chat.typing.stop()
+	await chat.keepalive.stop()
+	await chat.rate_limiter.stop()
+	await chat.message_writer.stop()
 	await async_db.close_pool()
 
 app.add_middleware(
@@ -37,20 +60,40 @@ app.add_middleware(
 )
 
 
+def parse_message_id(value):
+	# client supplied message ids, anything but a positive integer is None
+	if isinstance(value, bool):
+		return None
+	try:
+		message_id = int(value)
+	except (TypeError, ValueError):
+		return None
+	return message_id if message_id > 0 else None
+
+
 class ChatApp:
 	def __init__(self):
-		# {roomid: [{"websocket": websocket, "username": username}]}
-		self.active_rooms = {}
-		# {roomid: [{"username": username, "imageurl": imageurl}]}
-		self.room_watchers = {}
-		# {roomid: {username: timestamp}}
-		self.typing_users = {}
+		# websocket <-> (user, roomid), rooms keyed by username
+		self.sessions = SessionRegistry()
+		# serialize-once concurrent sends for every room broadcast
+		self.fanout = FanOut()
+		# watcher reports merged per room, sent as versioned deltas once per tick
+		self.watchers = WatcherState()
+		# typers per room, expired by a shared timer wheel, one typing_status per room per tick
+		self.typing = TypingPresence()
 		self.disconnect_tasks = {}
 		self.presence_grace_seconds = 5
-		self.keepalive_tasks = {}
-		self.last_pong = {}
-		self.keepalive_interval = 20
-		self.keepalive_timeout = 50
+		# one shared task pings every socket and closes the ones that stopped answering
+		self.keepalive = KeepaliveScheduler()
+		# inbound frames per user:room, pings are exempt
+		self.rate_limiter = RateLimiter(max_requests=100, window_seconds=10)
+		self.catchup_chunk_size = 50
+		self.catchup_max_messages = 500
+		# recent messages per room, joins to warm rooms skip mysql
+		self.history_cache = HistoryCache()
+		# batches message inserts, broadcast doesn't wait for mysql
+		self.message_writer = MessageWriter()
+		self.message_writer.on_dropped = self.handle_dropped_messages
 
 	def _disconnect_key(self, roomid, user):
 		return f"{roomid}:{user}"
@@ -72,57 +115,26 @@ class ChatApp:
 		self.disconnect_tasks[key] = create_task(self._delayed_disconnect_notice(roomid, user))
 
 	def start_keepalive(self, websocket):
-		self.last_pong[websocket] = time()
-		self.keepalive_tasks[websocket] = create_task(self._keepalive_loop(websocket))
-		user = self.get_user_from_websocket(websocket)
-		roomid = self.get_room_from_websocket(websocket)
-		logger.debug(f"keepalive started: user`{user}` roomid`{roomid}`")
+		self.keepalive.add(websocket)
 
 	def stop_keepalive(self, websocket):
-		task = self.keepalive_tasks.pop(websocket, None)
-		if task and not task.done():
-			task.cancel()
-		self.last_pong.pop(websocket, None)
+		self.keepalive.remove(websocket)
+
+	def send_server_ping(self, websocket, text):
+		session = self.sessions.get(websocket)
+		if session is not None:
+			session.queue.put(text, "server_ping")
+
+	async def close_dead_socket(self, websocket):
 		user = self.get_user_from_websocket(websocket)
 		roomid = self.get_room_from_websocket(websocket)
-		logger.debug(f"keepalive stopped: user`{user}` roomid`{roomid}`")
-
-	async def _keepalive_loop(self, websocket):
-		try:
-			while True:
-				await sleep(self.keepalive_interval)
-				if not self.is_websocket_connected(websocket):
-					break
-				user = self.get_user_from_websocket(websocket)
-				roomid = self.get_room_from_websocket(websocket)
-				try:
-					await websocket.send_text(dumps({"type": "server_ping", "ts": time()}))
-					# logger.debug(f"server_ping sent: user`{user}` roomid`{roomid}`")
-				except:
-					print_exc()
-					break
-				last_seen = self.last_pong.get(websocket, time())
-				if time() - last_seen > self.keepalive_timeout:
-					try:
-						await websocket.close(code=1011, reason="Server keepalive timeout")
-						logger.debug(f"keepalive timeout close: user`{user}` roomid`{roomid}`")
-					except:
-						print_exc()
-					break
-		except CancelledError:
-			return
-		except:
-			print_exc()
-		finally:
-			self.keepalive_tasks.pop(websocket, None)
-			self.last_pong.pop(websocket, None)
+		logger.debug(f"keepalive timeout close: user`{user}` roomid`{roomid}`")
+		await websocket.close(code=1011, reason="Server keepalive timeout")
 
 	async def _delayed_disconnect_notice(self, roomid, user):
 		try:
 			await sleep(self.presence_grace_seconds)
-			current_users = self.active_rooms.get(roomid, [])
-			still_connected = any(u["username"] == user for u in current_users)
-			if still_connected:
+			if self.sessions.member(roomid, user):
 				return
 			await self.send_message_to_room(roomid, f"{user} left.", no_history=True)
 		except CancelledError:
@@ -134,27 +146,24 @@ class ChatApp:
 			self.disconnect_tasks.pop(key, None)
 
 	def get_user_from_websocket(self, websocket):
-		for room_data in self.active_rooms.values():
-			for user_data in room_data:
-				if user_data["websocket"] == websocket:
-					return user_data["username"]
-		return None
+		session = self.sessions.get(websocket)
+		return session.user if session else None
 
 	def get_room_from_websocket(self, websocket):
-		for roomid, room_data in self.active_rooms.items():
-			for user_data in room_data:
-				if user_data["websocket"] == websocket:
-					return roomid
-		return None
+		session = self.sessions.get(websocket)
+		return session.roomid if session else None
 
 	def is_websocket_connected(self, websocket):
-		try:
-			return (
-				websocket.client_state == WebSocketState.CONNECTED and
-				websocket.application_state == WebSocketState.CONNECTED
-			)
-		except:
-			return False
+		return is_connected(websocket)
+
+	async def send_to_websocket(self, websocket, data):
+		# goes through the session's send queue so it stays ordered with broadcasts
+		text = data if isinstance(data, str) else dumps(data)
+		session = self.sessions.get(websocket)
+		if session:
+			session.queue.put(text)
+		elif self.is_websocket_connected(websocket):
+			await websocket.send_text(text)
 
 	async def handle_watcher_update(self, websocket: WebSocket, data):
 		user = self.get_user_from_websocket(websocket)
@@ -168,169 +177,125 @@ class ChatApp:
 		is_playing = data.get("is_playing", False)
 		is_uptodate = data.get("is_uptodate", False)
 		
-		if roomid not in self.room_watchers:
-			self.room_watchers[roomid] = []
-		
-		self.room_watchers[roomid] = [w for w in self.room_watchers[roomid] if w["username"] != user]
-		
-		self.room_watchers[roomid].append({
+		self.watchers.update(roomid, user, {
 			"username": user,
 			"current_time": current_time,
 			"is_playing": is_playing,
 			"is_uptodate": is_uptodate,
 			"is_idle": not is_watching
 		})
-		
-		await self.send_watchers_to_room(roomid)
 
-	async def send_watchers_to_room(self, roomid):
-		if roomid in self.active_rooms:
-			watchers = self.room_watchers.get(roomid, [])
-			data = {
-				"type": "watchers_update",
-				"watchers": watchers
-			}
+	def send_watchers_delta(self, roomid, data):
+		# deltas are not coalesced, a client that misses one sees a version gap and resyncs
+		if self.sessions.has_room(roomid):
+			self.fanout.broadcast(self.sessions.members(roomid).values(), data, label="watchers_delta")
 
-			for user_data in self.active_rooms[roomid]:
-				websocket = user_data["websocket"]
-				try:
-					if self.is_websocket_connected(websocket):
-						await websocket.send_text(dumps(data))
-				except:
-					print_exc()
-					logger.error(f"Error sending watchers update to {user_data['username']}")
+	async def send_watchers_snapshot(self, websocket: WebSocket, roomid: str):
+		session = self.sessions.get(websocket)
+		if session is not None:
+			# a queued snapshot is superseded by a newer one
+			session.queue.put(dumps(self.watchers.snapshot(roomid)), "watchers")
 
 	async def send_video_history_to_websocket(self, websocket: WebSocket, roomid: str):
-		history = await async_db.get_video_history(roomid)
 		try:
+			history = await self.history_cache.get_video_history(roomid)
 			if self.is_websocket_connected(websocket):
-				await websocket.send_text(dumps({
+				await self.send_to_websocket(websocket, {
 					"type": "video_history",
 					"history": history
-				}))
+				})
 		except:
 			print_exc()
 
 	async def broadcast_video_history_update(self, roomid: str, entry: dict):
 		logger.info(f"broadcast_video_history_update: roomid`{roomid}` entry`{entry}`")
-		if roomid not in self.active_rooms:
+		if not self.sessions.has_room(roomid):
 			logger.warn(f"broadcast_video_history_update: room not active")
 			return
+		self.history_cache.invalidate_video_history(roomid)
 		data = {
 			"type": "video_history_update",
 			"entry": entry
 		}
-		for user_data in self.active_rooms[roomid]:
-			websocket = user_data["websocket"]
-			try:
-				if self.is_websocket_connected(websocket):
-					await websocket.send_text(dumps(data))
-			except:
-				print_exc()
-
-	async def handle_connect(self, websocket: WebSocket, user: str, roomid: str, lastMessageDate: float):
-		if roomid not in self.active_rooms:
-			self.active_rooms[roomid] = []
+		self.fanout.broadcast(self.sessions.members(roomid).values(), data, label="video_history_update")
 
-		logger.debug(f"handle_connect: user`{user}` roomid`{roomid}` lastMessageDate`{lastMessageDate}`")
+	async def handle_connect(self, websocket: WebSocket, user: str, roomid: str, lastMessageDate: float, lastMessageId: int = 0):
+		logger.debug(f"handle_connect: user`{user}` roomid`{roomid}` lastMessageDate`{lastMessageDate}` lastMessageId`{lastMessageId}`")
 		
-		existing_user_data = None
-		for user_data in self.active_rooms[roomid]:
-			if user_data["username"] == user:
-				existing_user_data = user_data
-				break
-
-		was_reconnect = existing_user_data is not None
+		existing = self.sessions.member(roomid, user)
+		was_reconnect = existing is not None
 		
-		if existing_user_data:
+		if existing:
 			logger.info(f"Kicking existing user connection: user'{user}' roomid'{roomid}'")
 			try:
-				await existing_user_data["websocket"].close(code=1008, reason="New connection established")
+				await existing.websocket.close(code=1008, reason="New connection established")
 			except:
 				print_exc()
-			self.stop_keepalive(existing_user_data["websocket"])
-			
-			self.active_rooms[roomid] = [
-				user_data for user_data in self.active_rooms[roomid] 
-				if user_data["username"] != user
-			]
-			
-			if roomid in self.room_watchers:
-				self.room_watchers[roomid] = [
-					w for w in self.room_watchers[roomid] 
-					if w["username"] != user
-				]
+			self.stop_keepalive(existing.websocket)
+			self.sessions.remove(existing.websocket)
+			self.watchers.leave(roomid, user)
 
 		recently_left = self.cancel_pending_disconnect(roomid, user)
 		
-		self.active_rooms[roomid].append({"websocket": websocket, "username": user})
+		self.sessions.add(websocket, user, roomid)
 		self.start_keepalive(websocket)
 		
-		if roomid not in self.room_watchers:
-			self.room_watchers[roomid] = []
-		
-		user_already_in_watchers = any(w["username"] == user for w in self.room_watchers[roomid])
-		if not user_already_in_watchers:
-			self.room_watchers[roomid].append({
-				"username": user,
-				"current_time": 0,
-				"is_playing": False,
-				"is_uptodate": False,
-				"is_idle": True
-			})
+		self.watchers.join(roomid, user)
 		
-		if lastMessageDate > 0:
-			await self.send_history_to_websocket(websocket, roomid, lastMessageDate)
+		if lastMessageId <= 0 and lastMessageDate > 0:
+			lastMessageId = await async_db.get_last_message_id_before(roomid, lastMessageDate)
+		if lastMessageId > 0:
+			await self.send_catchup_to_websocket(websocket, roomid, lastMessageId)
 		else:
 			await self.send_history_to_websocket(websocket, roomid, limit=15)
 		await self.send_video_history_to_websocket(websocket, roomid)
 		if not was_reconnect and not recently_left:
 			await self.send_message_to_room(roomid, f"{user} joined.", no_history=True)
 			logger.debug(f"join broadcast: user`{user}` roomid`{roomid}`")
-		await self.send_watchers_to_room(roomid)
+		# everyone else gets the new entry in the next delta
+		await self.send_watchers_snapshot(websocket, roomid)
 
 	async def handle_disconnect(self, websocket: WebSocket, close_code=None):
-		roomid = self.get_room_from_websocket(websocket)
-		user = self.get_user_from_websocket(websocket)
-		if not user:
-			logger.error(f"handle_disconnect: cant find user. roomid`{roomid}`")
-
-		if roomid is None or roomid not in self.active_rooms:
-			logger.error(f"handle_disconnect: room is not active. user`{user}`")
+		session = self.sessions.get(websocket)
+		if session is None:
+			logger.error("handle_disconnect: cant find session")
 			return
+		roomid = session.roomid
+		user = session.user
 
 		self.stop_keepalive(websocket)
 		logger.debug(f"handle_disconnect: user`{user}` roomid`{roomid}` close_code`{close_code}`")
 			
 		self.schedule_disconnect_notice(roomid, user)
-		if roomid in self.room_watchers:
-			self.room_watchers[roomid] = [w for w in self.room_watchers[roomid] if w["username"] != user]
-
-		self.active_rooms[roomid] = [user_data for user_data in self.active_rooms[roomid] if user_data["websocket"] != websocket]
+		self.watchers.leave(roomid, user)
+		self.typing.stop_typing(roomid, user)
+		self.sessions.remove(websocket)
 		
-		if not self.active_rooms[roomid]:
-			del self.active_rooms[roomid]
-			if roomid in self.room_watchers:
-				del self.room_watchers[roomid]
-		else:
-			await self.send_watchers_to_room(roomid)
+		if not self.sessions.has_room(roomid):
+			self.watchers.drop(roomid)
+			self.typing.drop(roomid)
+			self.history_cache.drop(roomid)
 		
 		logger.info(f"disconnected: user`{user}` roomid`{roomid}` close_code`{close_code}`")
 
 	async def handle_message(self, websocket: WebSocket, data):
 		msg_type = data.get("type")
 		if msg_type == "server_pong" or msg_type == "pong":
-			self.last_pong[websocket] = time()
+			self.keepalive.touch(websocket)
 			return
 		if msg_type == "ping":
-			self.last_pong[websocket] = time()
+			self.keepalive.touch(websocket)
 			try:
-				await websocket.send_text(dumps({"type": "pong", "ts": time()}))
+				await self.send_to_websocket(websocket, {"type": "pong", "ts": time()})
 			except:
 				pass
 			return
 		if msg_type == "watcher_update":
 			await self.handle_watcher_update(websocket, data)
+		elif msg_type == "watchers_resync":
+			roomid = self.get_room_from_websocket(websocket)
+			if roomid:
+				await self.send_watchers_snapshot(websocket, roomid)
 			return
 		elif data.get("type") == "request_user_image":
 			await self.handle_user_image_request(websocket, data)
@@ -344,6 +309,12 @@ class ChatApp:
 		elif data.get("type") == "load_more_messages":
 			await self.handle_load_more_messages(websocket, data)
 			return
+		elif data.get("type") == "catchup_more":
+			roomid = self.get_room_from_websocket(websocket)
+			after_id = parse_message_id(data.get("after_id"))
+			if roomid and after_id:
+				await self.send_catchup_chunk(websocket, roomid, after_id)
+			return
 		elif data.get("type") == "video_history_update":
 			roomid = self.get_room_from_websocket(websocket)
 			entry = data.get("entry")
@@ -377,29 +348,22 @@ class ChatApp:
 		roomid = self.get_room_from_websocket(websocket)
 		if not roomid or not user:
 			return
-		if roomid not in self.typing_users:
-			self.typing_users[roomid] = {}
 		if is_typing:
-			self.typing_users[roomid][user] = time()
+			self.typing.start_typing(roomid, user)
 		else:
-			self.typing_users[roomid].pop(user, None)
-		await self.broadcast_typing_status(roomid, user)
-
-	async def broadcast_typing_status(self, roomid: str, exclude_user: str):
-		if roomid not in self.typing_users:
-			return
-		now = time()
-		active_typers = [u for u, t in self.typing_users[roomid].items() if now - t < 10]
-		self.typing_users[roomid] = {u: t for u, t in self.typing_users[roomid].items() if now - t < 10}
-		for user_data in self.active_rooms.get(roomid, []):
-			if user_data["username"] != exclude_user:
-				try:
-					await user_data["websocket"].send_text(dumps({
-						"type": "typing_status",
-						"users": [u for u in active_typers if u != user_data["username"]]
-					}))
-				except:
-					pass
+			self.typing.stop_typing(roomid, user)
+
+	def send_typing_status(self, roomid: str, typers: list):
+		# non-typers share one payload, typers get the list without themselves
+		shared = dumps({"type": "typing_status", "users": typers})
+		pairs = []
+		for session in list(self.sessions.members(roomid).values()):
+			if session.user in typers:
+				text = dumps({"type": "typing_status", "users": [u for u in typers if u != session.user]})
+			else:
+				text = shared
+			pairs.append((session, text))
+		self.fanout.send_many(pairs, label="typing_status", key="typing")
 
 	async def handle_load_more_messages(self, websocket: WebSocket, data):
 		user = self.get_user_from_websocket(websocket)
@@ -408,7 +372,13 @@ class ChatApp:
 		if not roomid or not user:
 			return
 		
-		before_message_id = data.get("before_message_id")
+		cursor = data.get("cursor")
+		if cursor:
+			before_message_id = async_db.decode_history_cursor(str(cursor))
+		else:
+			# deprecated, clients send back next_cursor; kept for older clients
+			logger.debug(f"load_more_messages: deprecated before_message_id user`{user}` roomid`{roomid}`")
+			before_message_id = parse_message_id(data.get("before_message_id"))
 		if not before_message_id:
 			return
 		
@@ -422,13 +392,20 @@ class ChatApp:
 			return
 			
 		emoji = data.get("emoji")
-		reply_to = data.get("reply_to")
+		reply_to = parse_message_id(data.get("reply_to"))
 		
-		if not emoji or not reply_to:
+		if not emoji or not isinstance(emoji, str) or not reply_to:
 			return
 			
 		try:
+			# a queued reaction by this user or the message itself must be visible below
+			await self.message_writer.flush(reply_to)
+			if not await async_db.get_message_owner(reply_to, roomid):
+				logger.debug(f"handle_reaction: unknown message user`{user}` roomid`{roomid}` reply_to`{reply_to}`")
+				return
 			existing_reaction = await async_db.get_existing_reaction(roomid, user, reply_to)
+			# db, cache and broadcast carry the same timestamp
+			reacted_at = time()
 			
 			if existing_reaction:
 				reaction_id = existing_reaction[0]
@@ -437,6 +414,7 @@ class ChatApp:
 				
 				if existing_emoji == emoji and not is_removed:
 					await async_db.mark_message_removed(reaction_id)
+					self.history_cache.remove_message(roomid, reaction_id)
 					
 					data = {
 						"type": "reaction_removed",
@@ -448,20 +426,15 @@ class ChatApp:
 						"message_type": "reaction_removed"
 					}
 					
-					if roomid in self.active_rooms:
-						for user_data in self.active_rooms[roomid]:
-							websocket_user = user_data["websocket"]
-							try:
-								if self.is_websocket_connected(websocket_user):
-									await websocket_user.send_text(dumps(data))
-							except:
-								print_exc()
-								logger.error(f"Error sending reaction removal to {user_data['username']}")
+					self.fanout.broadcast(self.sessions.members(roomid).values(), data, label="reaction_removed")
 					return
 				else:
-					await async_db.update_reaction(reaction_id, emoji)
+					await async_db.update_reaction(reaction_id, emoji, removed=0, date=reacted_at)
+					self.history_cache.update_reaction(roomid, reaction_id, emoji, reacted_at)
 			else:
-				reaction_id = await async_db.insert_message(roomid, user, emoji, "new_reaction", reply_to)
+				reaction_id = await self.message_writer.submit(roomid, user, emoji, "new_reaction", reply_to)
+				if reaction_id:
+					self.history_cache.add_reaction(roomid, {"id": reaction_id, "user": user, "message": emoji, "reply_to": reply_to, "date": reacted_at})
 			
 			data = {
 				"type": "new_reaction",
@@ -469,22 +442,37 @@ class ChatApp:
 				"user": user,
 				"message": emoji,
 				"reply_to": reply_to,
-				"date": time(),
+				"date": reacted_at,
 				"message_type": "new_reaction"
 			}
 			
-			if roomid in self.active_rooms:
-				for user_data in self.active_rooms[roomid]:
-					websocket_user = user_data["websocket"]
-					try:
-						if self.is_websocket_connected(websocket_user):
-							await websocket_user.send_text(dumps(data))
-					except:
-						print_exc()
-						logger.error(f"Error sending reaction to {user_data['username']}")
+			self.fanout.broadcast(self.sessions.members(roomid).values(), data, label="new_reaction")
 		except:
 			print_exc()
 
+	async def handle_dropped_messages(self, rows):
+		# rows the writer gave up on were already broadcast and cached, take them back
+		for message_id, roomid, user, message, message_type, reply_to in rows:
+			self.history_cache.remove_message(roomid, message_id)
+			if message_type == "new_reaction":
+				data = {
+					"type": "reaction_removed",
+					"id": message_id,
+					"user": user,
+					"message": message,
+					"reply_to": reply_to,
+					"date": time(),
+					"message_type": "reaction_removed"
+				}
+			else:
+				data = {
+					"type": "message_deleted",
+					"message_id": message_id,
+					"user": user,
+					"date": time()
+				}
+			self.fanout.broadcast(self.sessions.members(roomid).values(), data, label=data["type"])
+
 	async def handle_message_deletion(self, websocket: WebSocket, data):
 		user = self.get_user_from_websocket(websocket)
 		roomid = self.get_room_from_websocket(websocket)
@@ -498,6 +486,7 @@ class ChatApp:
 			return
 			
 		try:
+			await self.message_writer.flush(parse_message_id(message_id))
 			result = await async_db.get_message_owner(message_id, roomid)
 			if not result:
 				return
@@ -509,6 +498,7 @@ class ChatApp:
 				return
 			
 			await async_db.mark_message_removed(message_id)
+			self.history_cache.remove_message(roomid, message_id)
 			
 			data = {
 				"type": "message_deleted",
@@ -517,34 +507,76 @@ class ChatApp:
 				"date": time()
 			}
 			
-			if roomid in self.active_rooms:
-				for user_data in self.active_rooms[roomid]:
-					websocket_user = user_data["websocket"]
-					try:
-						if self.is_websocket_connected(websocket_user):
-							await websocket_user.send_text(dumps(data))
-					except:
-						print_exc()
-						logger.error(f"Error sending message deletion to {user_data['username']}")
+			self.fanout.broadcast(self.sessions.members(roomid).values(), data, label="message_deleted")
 		except:
 			print_exc()
 
-	async def send_history_to_websocket(self, websocket: WebSocket, roomid: str, lastMessageDate: float = 0, limit = 15, before_message_id = None):
+	async def send_history_to_websocket(self, websocket: WebSocket, roomid: str, limit = 15, before_message_id = None):
 		try:
 			if limit > 15 or limit < 1:
 				logger.error("send_history_to_websocket: limit error:", limit)
 				return
 			
-			messages, has_more, is_pagination = await async_db.get_messages_history(roomid, lastMessageDate, before_message_id, limit)
+			if before_message_id or not self.history_cache.is_warm(roomid):
+				# queued rows must be in the db before it is read, a warm buffer already has them
+				await self.message_writer.flush()
+			if before_message_id:
+				messages, has_more, is_pagination, next_cursor = await async_db.get_messages_history(roomid, before_message_id, limit)
+			else:
+				messages, has_more, next_cursor = await self.history_cache.get_page(roomid, limit)
+				is_pagination = False
 			
 			data = {
 				"type": "room_history",
 				"messages": messages,
 				"has_more": has_more,
-				"is_pagination": is_pagination
+				"is_pagination": is_pagination,
+				"next_cursor": next_cursor
 			}
 			if self.is_websocket_connected(websocket):
-				await websocket.send_text(dumps(data))
+				await self.send_to_websocket(websocket, data)
+		except:
+			print_exc()
+
+	async def send_catchup_to_websocket(self, websocket: WebSocket, roomid: str, last_message_id: int):
+		try:
+			await self.message_writer.flush()
+			missed = await async_db.count_messages_after(roomid, last_message_id, self.catchup_max_messages + 1)
+			if missed > self.catchup_max_messages:
+				logger.debug(f"send_catchup_to_websocket: gap too large roomid`{roomid}` last_message_id`{last_message_id}`")
+				if self.is_websocket_connected(websocket):
+					await self.send_to_websocket(websocket, {
+						"type": "history_gap",
+						"last_message_id": last_message_id,
+						"message": "gap too large, reload latest page"
+					})
+				await self.send_history_to_websocket(websocket, roomid, limit=15)
+				return
+			
+			# the first chunk goes out now, the client asks for each next one with catchup_more
+			await self.send_catchup_chunk(websocket, roomid, last_message_id, missed > 0)
+		except:
+			print_exc()
+
+	async def send_catchup_chunk(self, websocket: WebSocket, roomid: str, after_id: int, missed: bool = True):
+		try:
+			# always answer with a frame, even when nothing was missed
+			messages, more = [], False
+			if missed:
+				messages, more = await async_db.get_messages_after(roomid, after_id, self.catchup_chunk_size)
+			if messages:
+				after_id = messages[-1]["id"]
+			if not self.is_websocket_connected(websocket):
+				return
+			await self.send_to_websocket(websocket, {
+				"type": "room_history",
+				"messages": messages,
+				"has_more": False,
+				"is_pagination": False,
+				"is_catchup": True,
+				"catchup_more": more and bool(messages),
+				"last_message_id": after_id
+			})
 		except:
 			print_exc()
 
@@ -557,29 +589,34 @@ class ChatApp:
 		}
 		try:
 			if self.is_websocket_connected(websocket):
-				await websocket.send_text(dumps(data))
+				await self.send_to_websocket(websocket, data)
 		except:
 			print_exc()
 
 	async def send_message_to_room(self, roomid: str, message: str, sender: str = "system", no_history: bool = False, reply_to_id = None):
-		if roomid in self.active_rooms:
+		if self.sessions.has_room(roomid):
 			message_id = None
 			reply_to_data = None
+			reply_to_id = parse_message_id(reply_to_id)
 			
 			if reply_to_id:
 				try:
-					reply_result = await async_db.get_message_by_id(reply_to_id)
-					if reply_result:
-						if reply_result[2]:
-							reply_to_data = {"id": reply_to_id, "user": reply_result[0], "message": None, "is_deleted": True}
-						else:
-							reply_to_data = {"id": reply_to_id, "user": reply_result[0], "message": reply_result[1], "is_deleted": False}
+					await self.message_writer.flush(reply_to_id)
+					reply_result = await async_db.get_message_by_id(reply_to_id, roomid)
+					if not reply_result:
+						# not a message of this room, send it as a plain message
+						reply_to_id = None
+					elif reply_result[2]:
+						reply_to_data = {"id": reply_to_id, "user": reply_result[0], "message": None, "is_deleted": True}
+					else:
+						reply_to_data = {"id": reply_to_id, "user": reply_result[0], "message": reply_result[1], "is_deleted": False}
 				except:
+					reply_to_id = None
 					print_exc()
 			
 			if not no_history:
 				try:
-					message_id = await async_db.insert_message(roomid, sender, message, "new_message", reply_to_id)
+					message_id = await self.message_writer.submit(roomid, sender, message, "new_message", reply_to_id)
 				except:
 					print_exc()
 
@@ -591,16 +628,10 @@ class ChatApp:
 				"date": time(),
 				"reply_to": reply_to_data
 			}
+			if message_id:
+				self.history_cache.add_message(roomid, data)
 
-			for user_data in self.active_rooms[roomid]:
-				websocket = user_data["websocket"]
-				try:
-					if self.is_websocket_connected(websocket):
-						await websocket.send_text(dumps(data))
-				except:
-					print_exc()
-					logger.error(f"send_message_to_room: Error sending message to {user_data['username']}")
-			# maybe disconnect unavailable users?
+			self.fanout.broadcast(self.sessions.members(roomid).values(), data, label="new_message")
 
 	async def handle_user_image_request(self, websocket: WebSocket, data):
 		target_user = data.get("username")
@@ -614,7 +645,7 @@ class ChatApp:
 		}
 		try:
 			if self.is_websocket_connected(websocket):
-				await websocket.send_text(dumps(response))
+				await self.send_to_websocket(websocket, response)
 		except:
 			print_exc()
 					
@@ -623,33 +654,60 @@ class ChatApp:
 chat = ChatApp()
 
 
+@app.get("/stats")
+async def stats():
+	return {
+		"connections": len(chat.sessions),
+		"send_queues": aggregate_stats(session.queue for session in chat.sessions.by_socket.values()),
+		"fanout": chat.fanout.stats(),
+		"history_cache": chat.history_cache.stats(),
+		"message_writer": chat.message_writer.stats(),
+		"watchers": chat.watchers.stats(),
+		"typing": chat.typing.stats(),
+		"keepalive": chat.keepalive.stats(),
+		"rate_limit": chat.rate_limiter.stats()
+	}
+
+
 @app.websocket("/")
 async def websocket_endpoint(
 	websocket: WebSocket,
-	user: str = Query(...),
-	psw: str = Query(...),
-	roomid: str = Query(...),
-	roompsw: str = Query(...),
+	user: str = Query(""),
+	psw: str = Query(""),
+	roomid: str = Query(""),
+	roompsw: str = Query(""),
+	token: str = Query(""),
 	lastMessageDate: float = Query(0),
+	lastMessageId: int = Query(0),
 ):
 
 	await websocket.accept()
 
-	if not (user and psw and roomid and roompsw):
-		logger.error("Missing required parameters")
-		await websocket.close(code=1008, reason="Missing required parameters")
-		return
-
-	if not await async_db.check_user(user, psw):
-		logger.error("Invalid user credentials")
-		await websocket.close(code=1008, reason="Invalid user credentials")
-		return
-
-	room_name = await async_db.check_room_get_name(roomid, roompsw)
-	if not room_name:
-		logger.error("Invalid room credentials")
-		await websocket.close(code=1008, reason="Invalid room credentials")
-		return
+	if token:
+		# the room name rides in the token, a warm reconnect does no db or bcrypt work
+		claims = await check_token(token)
+		if not claims or (roomid and claims[1] != roomid) or (user and claims[0] != user):
+			logger.error("Invalid session token")
+			await websocket.close(code=1008, reason="Invalid session token")
+			return
+		user, roomid, room_name = claims
+	else:
+		if not (user and psw and roomid and roompsw):
+			logger.error("Missing required parameters")
+			await websocket.close(code=1008, reason="Missing required parameters")
+			return
+
+		if not await async_db.check_user(user, psw):
+			logger.error("Invalid user credentials")
+			await websocket.close(code=1008, reason="Invalid user credentials")
+			return
+
+		room_name = await async_db.check_room_get_name(roomid, roompsw)
+		if not room_name:
+			logger.error("Invalid room credentials")
+			await websocket.close(code=1008, reason="Invalid room credentials")
+			return
+		token = await issue_session_token(user, roomid, room_name)
 	
 	logger.info(f"accepted connection: user`{user}` roomid`{roomid}`")
 	
@@ -658,14 +716,15 @@ async def websocket_endpoint(
 			await websocket.send_text(dumps({
 				"type": "room_info",
 				"room_name": room_name,
-				"message": f"Connected to room: {room_name}"
+				"message": f"Connected to room: {room_name}",
+				"session_token": token
 			}))
 	except:
 		print_exc()
 
 	disconnect_code = None
 	try:
-		await chat.handle_connect(websocket, user, roomid, lastMessageDate)
+		await chat.handle_connect(websocket, user, roomid, lastMessageDate, lastMessageId)
 
 		while True:
 			try:
@@ -673,16 +732,26 @@ async def websocket_endpoint(
 				try:
 					message_data = loads(data)
 
+					if message_data.get("type") in ("server_pong", "pong"):
+						# keepalive answers are never limited, a throttled client would time out
+						chat.keepalive.touch(websocket)
+						continue
+
 					if message_data.get("type") == "ping":
+						chat.keepalive.touch(websocket)
 						try:
 							if chat.is_websocket_connected(websocket):
-								await websocket.send_text(dumps({"type": "pong", "ts": time()}))
+								await chat.send_to_websocket(websocket, {"type": "pong", "ts": time()})
 								# logger.debug(f"client ping received, pong sent: user`{user}` roomid`{roomid}`")
 						except:
 							print_exc()
 						continue
 
-					if message_data.get("type") in ["send_message", "watcher_update", "request_user_image", "new_reaction", "delete_message", "load_more_messages", "server_pong", "pong", "video_history_update", "typing_start", "typing_stop"]:
+					if not chat.rate_limiter.is_allowed(f"ws:{user}:{roomid}"):
+						logger.warning(f"Rate limited WS user: {user}")
+						continue
+
+					if message_data.get("type") in ["send_message", "watcher_update", "watchers_resync", "request_user_image", "new_reaction", "delete_message", "load_more_messages", "catchup_more", "server_pong", "pong", "video_history_update", "typing_start", "typing_stop"]:
 						await chat.handle_message(websocket, message_data)
 				except JSONDecodeError:
 					try:
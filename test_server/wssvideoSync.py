@@ -4,14 +4,16 @@ from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
 from os import getenv, path, remove
-from signal import signal, SIGTERM, SIGINT
-import sys
 import re
+import asyncio
+from time import monotonic
 from base64 import b64decode, b64encode
-from videoSyncBinary import BinaryProtocol, RoomManager
+from videoSyncBinary import BinaryProtocol, RoomManager, OP, MAX_TIME, PROTOCOL_VERSION, server_ts, seq_before
+from send_queue import aggregate_stats
 import async_db
-from collections import defaultdict
-import time as time_module
+from session_tokens import issue_session_token, check_token, token_expires_at
+from rate_limit import RateLimiter
+from state_journal import StateJournal
 
 load_dotenv()
 
@@ -26,6 +28,28 @@ MAX_URL_LENGTH = 2048
 MAX_SUBTITLE_SIZE = 10 * 1024 * 1024
 MAX_ROOMS = 1000
 MAX_WS_MESSAGE_SIZE = 65536
+CLOCK_SYNC_INTERVAL = float(getenv("CLOCK_SYNC_INTERVAL", "5"))
+# drift of a passive report against the room clock: ignored below DEADBAND, corrected with
+# RATE up to HARD, a seek above. MAX_RATE_ADJUST caps how far from 1.0 the rate goes
+DRIFT_DEADBAND = float(getenv("DRIFT_DEADBAND", "1.0"))
+DRIFT_HARD = float(getenv("DRIFT_HARD", "8"))
+MAX_RATE_ADJUST = float(getenv("MAX_RATE_ADJUST", "0.05"))
+# aim to remove small drift over this many seconds, slower when MAX_RATE_ADJUST caps it
+DRIFT_CORRECTION_SECS = float(getenv("DRIFT_CORRECTION_SECS", "10"))
+# at most one seek per connection this often, a buffering client keeps reporting a stale
+# position and would otherwise be seeked on every report
+DRIFT_HARD_COOLDOWN = float(getenv("DRIFT_HARD_COOLDOWN", "10"))
+# TIME/STATE changes within one tick leave as a single frame per room, 0 sends immediately
+BROADCAST_TICK = float(getenv("BROADCAST_TICK", "0.05"))
+# rooms nobody is connected to are saved and unloaded after this long, loaded again on access
+ROOM_IDLE_TTL = float(getenv("ROOM_IDLE_TTL", "300"))
+# changed rooms are written every CHECKPOINT_INTERVAL, at most CHECKPOINT_BATCH rows per statement
+CHECKPOINT_INTERVAL = float(getenv("CHECKPOINT_INTERVAL", "10"))
+CHECKPOINT_BATCH = int(getenv("CHECKPOINT_BATCH", "500"))
+# the last checkpoint on shutdown gives up after this long
+SHUTDOWN_FLUSH_TIMEOUT = float(getenv("SHUTDOWN_FLUSH_TIMEOUT", "5"))
+# optional local journal of room state, replayed on startup ahead of the db
+JOURNAL_DIR = getenv("JOURNAL_DIR") or None
 ROOMID_PATTERN = re.compile(r'^[a-zA-Z0-9_-]{1,64}$')
 
 app = FastAPI()
@@ -43,33 +67,21 @@ app.add_middleware(
 	allow_headers=["Content-Type", "Authorization"],
 )
 
-class RateLimiter:
-	def __init__(self, max_requests: int = 30, window_seconds: int = 60):
-		self.max_requests = max_requests
-		self.window_seconds = window_seconds
-		self.requests = defaultdict(list)
-	
-	def is_allowed(self, key: str) -> bool:
-		now = time_module.time()
-		self.requests[key] = [t for t in self.requests[key] if now - t < self.window_seconds]
-		if len(self.requests[key]) >= self.max_requests:
-			return False
-		self.requests[key].append(now)
-		return True
-	
-	def cleanup(self):
-		now = time_module.time()
-		keys_to_delete = [k for k, v in self.requests.items() if not v or now - max(v) > self.window_seconds * 2]
-		for k in keys_to_delete:
-			del self.requests[k]
-
 rate_limiter = RateLimiter(max_requests=60, window_seconds=60)
 ws_rate_limiter = RateLimiter(max_requests=100, window_seconds=10)
 
 HOME = getenv("DIR_SERVER")
 SUBTITLES_DIR = fr"{HOME}/subtitles"
 
-room_manager = RoomManager()
+async def save_rooms(rooms) -> bool:
+	rows = [(room.roomid, room.state.url, room.state.time, room.state.is_playing, room.state.subtitle_exist) for room in rooms]
+	ok = True
+	for i in range(0, len(rows), CHECKPOINT_BATCH):
+		ok = await async_db.save_room_states(rows[i:i + CHECKPOINT_BATCH]) and ok
+	return ok
+
+room_manager = RoomManager(loader=async_db.fetch_room_state, saver=save_rooms, idle_ttl=ROOM_IDLE_TTL, checkpoint_interval=CHECKPOINT_INTERVAL)
+journal = StateJournal(JOURNAL_DIR)
 
 def check_url(url: str) -> bool:
 	if not url:
@@ -145,159 +157,350 @@ def subtitle_exists(roomid: str) -> bool:
 		return False
 	return path.exists(path.join(SUBTITLES_DIR, f"{roomid}.vtt"))
 
-async def save_rooms_to_db():
-	try:
-		for roomid, room in room_manager.rooms.items():
-			await async_db.save_room_state(roomid, room.state.url, room.state.time, room.state.is_playing, room.state.subtitle_exist)
-		logger.info(f"Saved {len(room_manager.rooms)} rooms to database")
-	except:
-		print_exc()
+async def authorize_request(data: dict, need_user: bool = True):
+	# accepts either a session token or user/psw + room/roompsw, returns (user, roomid, error)
+	token = str(data.get("token", "") or "")
+	if token:
+		claims = await check_token(token)
+		if not claims:
+			return None, None, "Invalid token"
+		user, roomid, _ = claims
+		requested_room = str(data.get("room", "") or "")
+		if requested_room and requested_room != roomid:
+			return None, None, "Token not valid for room"
+		return user, roomid, None
 
-async def load_rooms_from_db():
+	user = str(data.get("user", "") or "")
+	userpsw = str(data.get("psw", "") or "")
+	roomid = str(data.get("room", "") or "")
+	roompsw = str(data.get("roompsw", "") or data.get("room_psw", "") or "")
+	if not (roomid and roompsw) or (need_user and not (user and userpsw)):
+		return None, None, "Missing parameters"
+	if need_user and not await async_db.check_user(user, userpsw):
+		return None, None, "Invalid user credentials"
+	if not await async_db.check_room(roomid, roompsw):
+		return None, None, "Invalid room credentials"
+	return user, roomid, None
+
+async def flush_rooms_to_db():
+	# uvicorn turns SIGTERM/SIGINT into a graceful shutdown, so this runs on every clean exit
 	try:
-		rows = await async_db.load_all_room_states()
-		for roomid, url, time_val, is_playing, subtitle_exist in rows:
-			if not is_valid_roomid(roomid):
-				continue
-			room = room_manager.get_or_create_room(roomid)
-			room.state.url = url or ""
-			try:
-				room.state.time = int(time_val) if time_val else 0
-			except (ValueError, TypeError):
-				room.state.time = 0
-			room.state.is_playing = bool(is_playing)
-			room.state.subtitle_exist = bool(subtitle_exist)
-		logger.info(f"Loaded {len(room_manager.rooms)} rooms from database")
+		saved = await asyncio.wait_for(room_manager.checkpoint(max_age=0), SHUTDOWN_FLUSH_TIMEOUT)
+		logger.info(f"Saved {saved} rooms to database")
+	except asyncio.TimeoutError:
+		logger.error(f"Saving rooms timed out after {SHUTDOWN_FLUSH_TIMEOUT}s")
 	except:
 		print_exc()
 
-def signal_handler(sig, frame):
-	logger.info(f"Received signal {sig}")
-	sys.exit(0)
-
-signal(SIGTERM, signal_handler)
-signal(SIGINT, signal_handler)
-
 @app.on_event("startup")
 async def startup_event():
 	await async_db.init_pool()
-	logger.info("Starting up, loading room states...")
-	await load_rooms_from_db()
+	# rooms in the journal come back right away (and are checkpointed to the db, which may
+	# be behind), the rest are loaded from the db on first access
+	for roomid, (url, position, is_playing, subtitle_exist) in journal.replay(MAX_ROOMS).items():
+		if is_valid_roomid(roomid):
+			room_manager.get_or_create_room(roomid).state.restore(url, position, is_playing, subtitle_exist)
+	journal.start(lambda: list(room_manager.rooms.values()))
+	room_manager.start()
+	rate_limiter.start()
+	ws_rate_limiter.start()
+	video_sync.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
+	await rate_limiter.stop()
+	await ws_rate_limiter.stop()
+	await video_sync.stop()
+	await room_manager.stop()
+	await journal.stop()
 	logger.info("Shutting down, saving room states...")
-	await save_rooms_to_db()
+	await flush_rooms_to_db()
 	await async_db.close_pool()
 
 
 class VideoSyncHandler:
 	def __init__(self):
 		self.room_manager = room_manager
-
-	async def broadcast(self, room, data: bytes, exclude_user: str | None = None):
-		for user, conn in room.connections.items():
-			if exclude_user and user == exclude_user:
-				continue
+		self.clock_task = None
+		self.broadcast_task = None
+		# roomids with a pending coalesced TIME/STATE broadcast
+		self.dirty_rooms = set()
+		self.soft_corrections = 0
+		self.hard_corrections = 0
+		self.hard_suppressed = 0
+		self.sync_events = 0
+		self.sync_frames = 0
+		# SYNC_REQs answered without an INIT, UPTODATEs from clients that missed a version
+		self.sync_unchanged = 0
+		self.lost_updates = 0
+
+	def start(self):
+		if self.clock_task is None:
+			self.clock_task = asyncio.create_task(self._clock_sync_loop())
+		if self.broadcast_task is None and BROADCAST_TICK > 0:
+			self.broadcast_task = asyncio.create_task(self._broadcast_loop())
+
+	async def stop(self):
+		for task in (self.clock_task, self.broadcast_task):
+			if task:
+				task.cancel()
+				try:
+					await task
+				except asyncio.CancelledError:
+					pass
+		self.clock_task = None
+		self.broadcast_task = None
+		await self.flush_broadcasts()
+
+	async def schedule_broadcast(self, room, user: str, kind: str, passive: bool = False, v1_only: bool = False):
+		# state is already applied, only the announcement waits for the tick
+		self.sync_events += 1
+		room.schedule(user, kind, passive, v1_only)
+		if self.broadcast_task is None:
+			await self.flush_room(room)
+		else:
+			self.dirty_rooms.add(room.roomid)
+
+	async def flush_room(self, room):
+		pending = room.pending
+		room.pending = None
+		if pending is None:
+			return
+		self.sync_frames += 1
+		if pending.state:
+			encode = lambda version, lead: BinaryProtocol.encode_state(room.state.is_playing, room.state.position(monotonic() + lead), 0, version=version, seq=room.seq)
+		else:
+			# v2 frames carry the extrapolated position at encode time next to the server timestamp
+			encode = lambda version, lead: None if pending.v1_only and version >= 2 else BinaryProtocol.encode_time(room.state.position(monotonic() + lead), 0, passive=pending.passive, version=version, seq=room.seq)
+		await self.broadcast(room, encode, exclude_user=pending.exclude_user, key='state' if pending.state else 'time')
+
+	async def flush_broadcasts(self):
+		dirty, self.dirty_rooms = self.dirty_rooms, set()
+		for roomid in dirty:
+			room = self.room_manager.get_room(roomid)
+			if room:
+				await self.flush_room(room)
+
+	async def _broadcast_loop(self):
+		while True:
+			await asyncio.sleep(BROADCAST_TICK)
 			try:
-				if conn.websocket.client_state.value == 1:
-					await conn.websocket.send_bytes(data)
+				await self.flush_broadcasts()
 			except:
-				logger.error(f"broadcast: Error sending to {user}")
+				print_exc()
 
-	async def handle_connect(self, websocket: WebSocket, user: str, roomid: str):
-		if len(self.room_manager.rooms) >= MAX_ROOMS and roomid not in self.room_manager.rooms:
+	async def _clock_sync_loop(self):
+		# one PING per v2 connection per interval, the PONG updates the connection's rtt/offset
+		while True:
+			await asyncio.sleep(CLOCK_SYNC_INTERVAL)
+			try:
+				ping = BinaryProtocol.encode_ping(server_ts())
+				for room in list(self.room_manager.rooms.values()):
+					for conn in list(room.connections.values()):
+						if conn.version >= 2 and conn.queue:
+							conn.queue.put(ping, 'ping')
+			except:
+				print_exc()
+
+	async def broadcast(self, room, data, exclude_user: str | None = None, key: str | None = None):
+		# queued per connection, key makes the frame latest-wins (time/state)
+		# data is bytes, or encode(version, lead) -> bytes for frames that differ per protocol
+		# version and per receiver latency; lead is the receiver's one-way delay in seconds
+		encoded = {}
+		for user, conn in list(room.connections.items()):
+			if exclude_user and user == exclude_user:
+				continue
+			if conn.websocket.client_state.value == 1 and conn.queue:
+				if callable(data):
+					# 10ms buckets so receivers with similar latency share a frame
+					lead = round(conn.one_way, 2)
+					cache_key = (conn.version, lead)
+					if cache_key not in encoded:
+						encoded[cache_key] = data(conn.version, lead)
+					frame = encoded[cache_key]
+					# None means this version doesn't get the frame
+					if frame is None:
+						continue
+				else:
+					frame = data
+				conn.queue.put(frame, key)
+
+	def update_ack(self, conn, room, request_id: int) -> bytes:
+		# v2 writers learn the version their update produced
+		return BinaryProtocol.encode_ack(True, request_id, seq=room.seq if conn.version >= 2 else None)
+
+	async def correct_drift(self, room, conn, reported: float):
+		# passive reports from v2 clients are checked against the room clock instead of moving it
+		now = monotonic()
+		conn.drift = reported - room.state.position(now)
+		drift = abs(conn.drift)
+		if drift <= DRIFT_DEADBAND:
+			return
+		if drift >= DRIFT_HARD:
+			if conn.hard_seek_at is not None and now - conn.hard_seek_at < DRIFT_HARD_COOLDOWN:
+				self.hard_suppressed += 1
+				return
+			# too far for rate correction, seek only this client
+			conn.hard_seek_at = now
+			self.hard_corrections += 1
+			conn.is_uptodate = False
+			room.send(conn.user, BinaryProtocol.encode_time(room.state.position(now + conn.one_way), 0, passive=False, version=conn.version, seq=room.seq), 'time')
+			return
+		self.soft_corrections += 1
+		adjust = min(MAX_RATE_ADJUST, drift / DRIFT_CORRECTION_SECS)
+		rate = 1 - adjust if conn.drift > 0 else 1 + adjust
+		room.send(conn.user, BinaryProtocol.encode_rate(rate, drift / adjust), 'rate')
+
+	async def handle_connect(self, websocket: WebSocket, user: str, roomid: str, version: int = 1):
+		# only rooms with someone connected count, idle ones are unloaded on their own
+		loaded = self.room_manager.get_room(roomid)
+		if not (loaded and loaded.connections) and self.room_manager.active_count() >= MAX_ROOMS:
 			logger.error(f"Max rooms reached, rejecting {user}@{roomid}")
 			await websocket.close(code=1008, reason="Max rooms reached")
 			return False
 		
-		room = self.room_manager.get_or_create_room(roomid)
-		existing = room.add_connection(user, websocket)
+		try:
+			room = await self.room_manager.load_room(roomid)
+		except:
+			print_exc()
+			await websocket.close(code=1011, reason="Room unavailable")
+			return False
+		existing = room.add_connection(user, websocket, version)
 		if existing:
 			logger.info(f"Kicking existing connection: {user}@{roomid}")
 			try:
 				await existing.websocket.close(code=1008, reason="New connection")
 			except:
 				pass
-			room.connections[user].websocket = websocket
-			room.connections[user].is_uptodate = False
+			room.replace_websocket(user, websocket, version)
 		
-		room.state.subtitle_exist = subtitle_exists(roomid)
+		if room.state.set_subtitle_exist(subtitle_exists(roomid)):
+			journal.record(room, 'subtitle')
 		
-		try:
-			init_data = BinaryProtocol.encode_init(room.state)
-			await websocket.send_bytes(init_data)
-		except:
-			logger.error(f"Error sending init to {user}")
+		init_data = BinaryProtocol.encode_init(room.state, 0, version, room.seq)
+		room.send(user, init_data)
+		if version >= 2:
+			# first clock sample right away so compensation doesn't wait a full interval
+			room.send(user, BinaryProtocol.encode_ping(server_ts()), 'ping')
 		return True
 
-	async def handle_disconnect(self, user: str, roomid: str):
+	async def handle_disconnect(self, user: str, roomid: str, websocket: WebSocket | None = None):
 		room = self.room_manager.get_room(roomid)
 		if room:
-			room.remove_connection(user)
-		self.room_manager.cleanup_empty_rooms()
+			room.remove_connection(user, websocket)
 
 	async def handle_message(self, websocket: WebSocket, data: bytes, user: str, roomid: str):
 		room = self.room_manager.get_room(roomid)
 		if not room:
 			return
 		
-		msg = BinaryProtocol.decode(data)
+		conn = room.get_connection(user)
+		if not conn:
+			return
+		msg = BinaryProtocol.decode(data, conn.version)
 		if not msg:
 			logger.warning(f"Failed to decode message from {user}")
 			return
 		
+		if msg['type'] == 'batch':
+			# every sub-op is handled as if it came alone, their replies go back as one BATCH
+			conn.replies = []
+			try:
+				for op in msg['ops']:
+					await self.handle_op(room, conn, user, roomid, op)
+			finally:
+				replies, conn.replies = conn.replies, None
+			if len(replies) == 1:
+				room.send(user, replies[0])
+			elif replies:
+				room.send(user, BinaryProtocol.encode_batch(replies, msg['request_id']))
+			return
+		await self.handle_op(room, conn, user, roomid, msg)
+
+	async def handle_op(self, room, conn, user: str, roomid: str, msg: dict):
 		request_id = msg.get('request_id', 0)
 		msg_type = msg['type']
 		logger.debug(f"msg: type={msg_type} user={user} room={roomid}")
 
 		if msg_type == 'sync_req':
-			init_data = BinaryProtocol.encode_init(room.state, request_id)
-			await websocket.send_bytes(init_data)
+			if msg.get('seen') == room.seq:
+				# the client already has this version, an ACK carrying it means no change
+				self.sync_unchanged += 1
+				room.send(user, BinaryProtocol.encode_ack(True, request_id, seq=room.seq))
+				return
+			init_data = BinaryProtocol.encode_init(room.state, request_id, conn.version, room.seq, monotonic() + conn.one_way)
+			room.send(user, init_data)
+
+		elif msg_type == 'ping':
+			room.send(user, BinaryProtocol.encode_pong(msg['ts'], server_ts()))
+
+		elif msg_type == 'pong':
+			now = server_ts()
+			rtt = now - msg['echo']
+			if 0 <= rtt < 60000:
+				# client clock at the midpoint of the exchange minus ours
+				conn.record_clock_sample(rtt / 1000, (msg['ts'] - (msg['echo'] + rtt / 2)) / 1000)
 
 		elif msg_type == 'uptodate':
-			conn = room.get_connection(user)
-			if conn:
+			seen = msg.get('seen')
+			if seen is None or seen == room.seq:
 				conn.is_uptodate = True
+				return
+			# the client missed updates, it stays not up to date until it has the current state
+			self.lost_updates += 1
+			conn.is_uptodate = False
+			if seq_before(seen, room.reset_seq):
+				room.send(user, BinaryProtocol.encode_init(room.state, 0, conn.version, room.seq, monotonic() + conn.one_way))
+			else:
+				room.send(user, BinaryProtocol.encode_state(room.state.is_playing, room.state.position(monotonic() + conn.one_way), 0, version=conn.version, seq=room.seq), 'state')
 
 		elif msg_type == 'time':
 			timeout_pass = msg.get('timeout_pass', False)
-			time_val = min(max(0, int(msg.get('time', 0))), 0xFFFFFFFF)
+			time_val = min(max(0, msg.get('time', 0)), MAX_TIME)
 			if room.can_update(user, 'time', timeout_pass):
+				# the reported position is one-way delay old by now
+				if room.state.is_playing:
+					time_val += conn.one_way * room.state.rate
+				if timeout_pass and conn.version >= 2 and room.state.is_playing:
+					await self.correct_drift(room, conn, time_val)
+					# v1 peers still rely on passive TIME to notice drift, give them the room clock
+					await self.schedule_broadcast(room, user, 'time', passive=True, v1_only=True)
+					room.send(user, self.update_ack(conn, room, request_id))
+					return
 				room.state.time = time_val
 				room.state.time_user = user
+				journal.record(room, 'time')
 				
-				if timeout_pass:
-					broadcast_data = BinaryProtocol.encode_time(time_val, 0, passive=True)
-					await self.broadcast(room, broadcast_data, exclude_user=user)
-				else:
+				if not timeout_pass:
+					# only authoritative changes move seq, a passive report must not make
+					# every other client look like it missed an update
+					room.next_seq()
 					room.mark_all_not_uptodate(user)
-					broadcast_data = BinaryProtocol.encode_time(time_val, 0, passive=False)
-					await self.broadcast(room, broadcast_data, exclude_user=user)
+				await self.schedule_broadcast(room, user, 'time', passive=timeout_pass)
 				
-				ack = BinaryProtocol.encode_ack(True, request_id)
-				await websocket.send_bytes(ack)
+				room.send(user, self.update_ack(conn, room, request_id))
 			else:
 				ack = BinaryProtocol.encode_ack(False, request_id, "not authorized")
-				await websocket.send_bytes(ack)
+				room.send(user, ack)
 
 		elif msg_type == 'state':
-			time_val = min(max(0, int(msg.get('time', 0))), 0xFFFFFFFF)
+			time_val = min(max(0, msg.get('time', 0)), MAX_TIME)
 			if room.can_update(user, 'state'):
-				room.state.is_playing = msg['is_playing']
-				room.state.time = time_val
+				if msg['is_playing']:
+					time_val += conn.one_way * room.state.rate
+				room.state.anchor(time_val, is_playing=msg['is_playing'])
 				room.state.playing_user = user
 				room.state.time_user = user
 				room.mark_all_not_uptodate(user)
+				room.next_seq()
+				journal.record(room, 'state')
 				
-				broadcast_data = BinaryProtocol.encode_state(msg['is_playing'], time_val, 0)
-				await self.broadcast(room, broadcast_data, exclude_user=user)
+				await self.schedule_broadcast(room, user, 'state')
 				
-				ack = BinaryProtocol.encode_ack(True, request_id)
-				await websocket.send_bytes(ack)
+				room.send(user, self.update_ack(conn, room, request_id))
 			else:
 				ack = BinaryProtocol.encode_ack(False, request_id, "not authorized")
-				await websocket.send_bytes(ack)
+				room.send(user, ack)
 
 
 video_sync = VideoSyncHandler()
@@ -316,52 +519,65 @@ async def websocket_endpoint(websocket: WebSocket):
 		return
 	
 	msg = BinaryProtocol.decode(data)
-	if not msg or msg.get('type') != 'auth':
+	if not msg or msg.get('type') not in ('auth', 'auth_token'):
 		logger.error("First message must be AUTH")
 		ack = BinaryProtocol.encode_ack(False, 0, "auth required")
 		await websocket.send_bytes(ack)
 		await websocket.close(code=1008, reason="Auth required")
 		return
 	
-	user = msg.get('user', '')
-	psw = msg.get('psw', '')
-	roomid = msg.get('roomid', '')
-	roompsw = msg.get('roompsw', '')
-
-	if not (user and psw and roomid and roompsw):
-		logger.error("Missing auth parameters")
-		ack = BinaryProtocol.encode_ack(False, 0, "missing parameters")
-		await websocket.send_bytes(ack)
-		await websocket.close(code=1008, reason="Missing parameters")
-		return
+	if msg['type'] == 'auth_token':
+		claims = await check_token(msg.get('token', ''))
+		if not claims or not is_valid_roomid(claims[1]):
+			logger.error("Invalid session token")
+			ack = BinaryProtocol.encode_ack(False, 0, "invalid token")
+			await websocket.send_bytes(ack)
+			await websocket.close(code=1008, reason="Invalid token")
+			return
+		user, roomid, _ = claims
+	else:
+		user = msg.get('user', '')
+		psw = msg.get('psw', '')
+		roomid = msg.get('roomid', '')
+		roompsw = msg.get('roompsw', '')
+
+		if not (user and psw and roomid and roompsw):
+			logger.error("Missing auth parameters")
+			ack = BinaryProtocol.encode_ack(False, 0, "missing parameters")
+			await websocket.send_bytes(ack)
+			await websocket.close(code=1008, reason="Missing parameters")
+			return
 
-	if not await async_db.check_user(user, psw):
-		logger.error("Invalid user credentials")
-		ack = BinaryProtocol.encode_ack(False, 0, "invalid user")
-		await websocket.send_bytes(ack)
-		await websocket.close(code=1008, reason="Invalid user")
-		return
+		if not await async_db.check_user(user, psw):
+			logger.error("Invalid user credentials")
+			ack = BinaryProtocol.encode_ack(False, 0, "invalid user")
+			await websocket.send_bytes(ack)
+			await websocket.close(code=1008, reason="Invalid user")
+			return
 
-	if not is_valid_roomid(roomid):
-		logger.error("Invalid roomid format")
-		ack = BinaryProtocol.encode_ack(False, 0, "invalid room format")
-		await websocket.send_bytes(ack)
-		await websocket.close(code=1008, reason="Invalid room format")
-		return
+		if not is_valid_roomid(roomid):
+			logger.error("Invalid roomid format")
+			ack = BinaryProtocol.encode_ack(False, 0, "invalid room format")
+			await websocket.send_bytes(ack)
+			await websocket.close(code=1008, reason="Invalid room format")
+			return
 
-	if not await async_db.check_room(roomid, roompsw):
-		logger.error("Invalid room credentials")
-		ack = BinaryProtocol.encode_ack(False, 0, "invalid room")
-		await websocket.send_bytes(ack)
-		await websocket.close(code=1008, reason="Invalid room")
-		return
+		if not await async_db.check_room(roomid, roompsw):
+			logger.error("Invalid room credentials")
+			ack = BinaryProtocol.encode_ack(False, 0, "invalid room")
+			await websocket.send_bytes(ack)
+			await websocket.close(code=1008, reason="Invalid room")
+			return
 
-	ack = BinaryProtocol.encode_ack(True, 0)
+	# clients that send no version byte are v1 and get the plain ack
+	requested = msg.get('version', 1)
+	version = max(1, min(requested, PROTOCOL_VERSION))
+	ack = BinaryProtocol.encode_ack(True, 0, protocol_version=version if requested > 1 else None)
 	await websocket.send_bytes(ack)
-	logger.info(f"WS auth OK: {user}@{roomid}")
+	logger.info(f"WS auth OK: {user}@{roomid} protocol v{version}")
 
 	try:
-		if not await video_sync.handle_connect(websocket, user, roomid):
+		if not await video_sync.handle_connect(websocket, user, roomid, version):
 			return
 
 		while True:
@@ -370,7 +586,8 @@ async def websocket_endpoint(websocket: WebSocket):
 				if len(data) > MAX_WS_MESSAGE_SIZE:
 					logger.error(f"Message too large from {user}: {len(data)}")
 					continue
-				if not ws_rate_limiter.is_allowed(f"ws:{user}:{roomid}"):
+				# a BATCH costs one token per sub-op, PONGs are exempt so keepalive survives throttling
+				if (not data or data[0] != OP.PONG) and not ws_rate_limiter.is_allowed(f"ws:{user}:{roomid}", BinaryProtocol.batch_size(data)):
 					logger.warn(f"Rate limited WS user: {user}")
 					continue
 				await video_sync.handle_message(websocket, data, user, roomid)
@@ -380,12 +597,12 @@ async def websocket_endpoint(websocket: WebSocket):
 				logger.error(f"WS error for {user}: {e}")
 				break
 
-		await video_sync.handle_disconnect(user, roomid)
+		await video_sync.handle_disconnect(user, roomid, websocket)
 	except WebSocketDisconnect:
-		await video_sync.handle_disconnect(user, roomid)
+		await video_sync.handle_disconnect(user, roomid, websocket)
 	except Exception as e:
 		logger.error(f"WS exception: {e}")
-		await video_sync.handle_disconnect(user, roomid)
+		await video_sync.handle_disconnect(user, roomid, websocket)
 
 
 @app.post('/login_user')
@@ -410,37 +627,87 @@ async def login_room(request: Request):
 	logger.info(f"login_room: {room}")
 	return {"status": await async_db.check_room(room, psw)}
 
+def clock_stats() -> dict:
+	measured = [conn for room in room_manager.rooms.values() for conn in room.connections.values() if conn.rtt_samples]
+	rtts = [conn.rtt for conn in measured]
+	return {
+		"measured": len(rtts),
+		"avg_rtt_ms": round(sum(rtts) / len(rtts) * 1000, 1) if rtts else 0,
+		"max_rtt_ms": round(max(rtts) * 1000, 1) if rtts else 0,
+		"max_drift_ms": round(max(abs(conn.drift) for conn in measured) * 1000, 1) if measured else 0
+	}
+
+@app.get('/stats')
+async def stats():
+	queues = [conn.queue for room in room_manager.rooms.values() for conn in room.connections.values() if conn.queue]
+	return {
+		"rooms": room_manager.stats(),
+		"send_queues": aggregate_stats(queues),
+		"clock": clock_stats(),
+		"drift": {"soft_corrections": video_sync.soft_corrections, "hard_corrections": video_sync.hard_corrections, "hard_suppressed": video_sync.hard_suppressed},
+		"sync_broadcasts": {"events": video_sync.sync_events, "frames": video_sync.sync_frames, "saved": video_sync.sync_events - video_sync.sync_frames},
+		"versions": {"sync_unchanged": video_sync.sync_unchanged, "lost_updates": video_sync.lost_updates},
+		"rate_limit": {"http": rate_limiter.stats(), "ws": ws_rate_limiter.stats()},
+		"journal": journal.stats()
+	}
+
+@app.post('/session_token')
+async def session_token(request: Request):
+	client_ip = request.client.host if request.client else "unknown"
+	if not rate_limiter.is_allowed(f"login:{client_ip}"):
+		return {"status": False, "error": "Rate limited"}
+	data = await request.json()
+	if data.get("token"):
+		# refreshing a still valid token keeps the room name it carries
+		claims = await check_token(str(data["token"]))
+		if not claims:
+			return {"status": False, "error": "Invalid token"}
+		user, roomid, room_name = claims
+	else:
+		user = str(data.get("user", "") or "")
+		userpsw = str(data.get("psw", "") or "")
+		roomid = str(data.get("room", "") or "")
+		roompsw = str(data.get("roompsw", "") or data.get("room_psw", "") or "")
+		if not (user and userpsw and roomid and roompsw):
+			return {"status": False, "error": "Missing parameters"}
+		if not await async_db.check_user(user, userpsw):
+			return {"status": False, "error": "Invalid user credentials"}
+		room_name = await async_db.check_room_get_name(roomid, roompsw)
+		if not room_name:
+			return {"status": False, "error": "Invalid room credentials"}
+	if not is_valid_roomid(roomid):
+		return {"status": False, "error": "Invalid room format"}
+	token = await issue_session_token(user, roomid, room_name)
+	if not token:
+		return {"status": False, "error": "Could not issue token"}
+	logger.info(f"session_token issued: {user}@{roomid}")
+	return {"status": True, "token": token, "expires": token_expires_at(token)}
+
 @app.post('/get_current_url')
 async def get_current_url(request: Request):
 	data = await request.json()
-	room = str(data.get("room", "") or "")
-	roompsw = str(data.get("roompsw", "") or "")
-	if not (room and roompsw):
-		return {"status": False, "error": "Missing parameters"}
-	if not await async_db.check_room(room, roompsw):
-		return {"status": False, "error": "Invalid room"}
-	r = room_manager.get_room(room)
-	url = r.state.url if r else ""
-	return {"status": True, "url": url}
+	_, room, error = await authorize_request(data, need_user=False)
+	if error:
+		return {"status": False, "error": error}
+	try:
+		r = await room_manager.load_room(room)
+	except:
+		print_exc()
+		return {"status": False, "error": "Room unavailable"}
+	return {"status": True, "url": r.state.url, "time": r.state.position(), "is_playing": r.state.is_playing}
 
 @app.post('/setvideourl_offline')
 async def setvideourl_offline(request: Request):
 	data = await request.json()
-	user = str(data.get("user", "") or "")
-	userpsw = str(data.get("psw", "") or "")
-	roomid = str(data.get("room", "") or "")
-	roompsw = str(data.get("roompsw", "") or data.get("room_psw", "") or "")
 	new_url = str(data.get("new_url", "") or "")
+	if not new_url:
+		return {"status": False, "error": "Missing required parameters"}
+	user, roomid, error = await authorize_request(data)
+	if error:
+		return {"status": False, "error": error}
 	
 	logger.info(f"setvideourl_offline: {user}@{roomid} url={new_url}")
 	
-	if not (user and userpsw and roomid and roompsw and new_url):
-		return {"status": False, "error": "Missing required parameters"}
-	if not await async_db.check_user(user, userpsw):
-		return {"status": False, "error": "Invalid user credentials"}
-	if not await async_db.check_room(roomid, roompsw):
-		return {"status": False, "error": "Invalid room credentials"}
-	
 	url_valid = check_url(new_url)
 	if not url_valid:
 		return {"status": False, "error": "Invalid URL"}
@@ -451,57 +718,70 @@ async def setvideourl_offline(request: Request):
 		return {"status": False, "error": "URL is the same as the current one"}
 	
 	history_entry = await async_db.add_to_history(roomid, user, new_url, url_valid)
+	# loaded after the last await so an idle eviction can't leave the change on a dropped room
+	try:
+		room = await room_manager.load_room(roomid)
+	except:
+		print_exc()
+		return {"status": False, "error": "Room unavailable"}
 	
-	room = room_manager.get_or_create_room(roomid)
 	room.state.url = new_url
-	room.state.time = 0
-	room.state.is_playing = True
-	room.state.subtitle_exist = False
+	room.state.anchor(0, is_playing=True)
+	room.state.set_subtitle_exist(False)
 	room.state.url_user = user
 	room.mark_all_not_uptodate(user)
+	room.next_seq(reset=True)
+	journal.record(room, 'url')
+	# TIME/STATE still waiting for the tick belong to the old video
+	room.pending = None
 	delete_subtitle(roomid)
 	
-	broadcast_data = BinaryProtocol.encode_url(new_url, 0)
-	await video_sync.broadcast(room, broadcast_data, exclude_user=user)
+	url_data = BinaryProtocol.encode_url(new_url, 0)
+	# v2 clients get the whole reset in one frame instead of waiting for follow-ups
+	await video_sync.broadcast(
+		room,
+		lambda version, lead: url_data if version < 2 else BinaryProtocol.encode_batch([
+			BinaryProtocol.encode_url(new_url, 0, version=version, seq=room.seq),
+			BinaryProtocol.encode_state(True, room.state.position(monotonic() + lead), 0, version=version, seq=room.seq),
+			BinaryProtocol.encode_subtitle_flag(False, version=version, seq=room.seq)
+		]),
+		exclude_user=user
+	)
 	
 	return {"status": True, "history_entry": history_entry}
 
 @app.post('/subtitle/upload')
 async def upload_subtitle(request: Request):
 	data = await request.json()
-	user = str(data.get("user", "") or "")
-	userpsw = str(data.get("psw", "") or "")
-	roomid = str(data.get("room", "") or "")
-	roompsw = str(data.get("roompsw", "") or "")
 	subtitle_data = str(data.get("subtitle_data", "") or "")
 	filename = str(data.get("filename", "subtitle.vtt") or "subtitle.vtt")
 
-	if not (user and userpsw and roomid and roompsw and subtitle_data):
+	if not subtitle_data:
 		return {"status": False, "error": "Missing parameters"}
-	if not await async_db.check_user(user, userpsw):
-		return {"status": False, "error": "Invalid user"}
-	if not await async_db.check_room(roomid, roompsw):
-		return {"status": False, "error": "Invalid room"}
+	user, roomid, error = await authorize_request(data)
+	if error:
+		return {"status": False, "error": error}
 
 	if save_subtitle(roomid, subtitle_data, filename):
-		room = room_manager.get_room(roomid)
+		try:
+			room = await room_manager.load_room(roomid)
+		except:
+			print_exc()
+			room = None
 		if room:
-			room.state.subtitle_exist = True
-			flag_data = BinaryProtocol.encode_subtitle_flag(True)
-			await video_sync.broadcast(room, flag_data)
+			room.state.set_subtitle_exist(True)
+			room.next_seq(reset=True)
+			journal.record(room, 'subtitle')
+			await video_sync.broadcast(room, lambda version, lead: BinaryProtocol.encode_subtitle_flag(True, version=version, seq=room.seq))
 		return {"status": True}
 	return {"status": False, "error": "Failed to save"}
 
 @app.post('/subtitle/download')
 async def download_subtitle(request: Request):
 	data = await request.json()
-	roomid = str(data.get("room", "") or "")
-	roompsw = str(data.get("roompsw", "") or "")
-
-	if not (roomid and roompsw):
-		return {"status": False, "error": "Missing parameters"}
-	if not await async_db.check_room(roomid, roompsw):
-		return {"status": False, "error": "Invalid room"}
+	_, roomid, error = await authorize_request(data, need_user=False)
+	if error:
+		return {"status": False, "error": error}
 
 	subtitle_data = load_subtitle(roomid)
 	if subtitle_data:
@@ -23,6 +23,8 @@ class VideoSyncManager {
         this.serverEndpoint = null
         this.userId = null
         this.roomId = null
+        // from /session_token after the first password login, reused for reconnects and HTTP calls
+        this.sessionToken = null
         this.secureStorage = null
         this.mainWindow = null
         this.isVLCwatching = false
@@ -72,6 +74,13 @@ class VideoSyncManager {
             }
         }
 
+        this.client.onRateChange = async (rate, durationMs) => {
+            this.logger.debug('Server drift correction:', rate, durationMs)
+            if (this.onRateChange) {
+                await this.onRateChange(rate, durationMs)
+            }
+        }
+
         this.client.onSubtitleFlag = async (exists) => {
             this.logger.info('Subtitle flag changed:', exists)
             try {
@@ -101,6 +110,7 @@ class VideoSyncManager {
         this.serverEndpoint = serverEndpoint
         this.userId = userId
         this.secureStorage = secureStorage
+        this.sessionToken = null
     }
 
     setMainWindow(mainWindow) {
@@ -108,6 +118,7 @@ class VideoSyncManager {
     }
 
     setRoomId(roomId) {
+        if (roomId !== this.roomId) this.sessionToken = null
         this.roomId = roomId
     }
 
@@ -117,16 +128,67 @@ class VideoSyncManager {
             return false
         }
 
+        if (this.sessionToken) {
+            // reconnects skip the password checks on the server
+            if (await this.client.connect(this.serverEndpoint, this.userId, '', this.roomId, '', this.sessionToken)) {
+                return true
+            }
+            if (!this.client.tokenRejected) return false
+            // expired, or a password changed since it was issued
+            this.logger.info('Session token rejected, logging in with password')
+            this.sessionToken = null
+            this.client.lastConnectionAttempt = 0
+        }
+
         const userPsw = await this.secureStorage.getPassword('turkuazz', 'userpsw')
         const roomPsw = await this.secureStorage.getPassword('turkuazz', 'roompsw')
 
-        return await this.client.connect(
+        const connected = await this.client.connect(
             this.serverEndpoint,
             this.userId,
             userPsw,
             this.roomId,
             roomPsw
         )
+        if (connected) this.refreshSessionToken(userPsw, roomPsw)
+        return connected
+    }
+
+    async refreshSessionToken(userPsw, roomPsw) {
+        try {
+            const response = await axios.post(
+                `https://${this.serverEndpoint}/session_token`,
+                { user: this.userId, psw: userPsw, room: this.roomId, roompsw: roomPsw },
+                { timeout: 5000 }
+            )
+            if (response.data && response.data.status) {
+                this.sessionToken = response.data.token
+            }
+        } catch (error) {
+            this.logger.debug('Could not get a session token:', error.message)
+        }
+    }
+
+    // token when we have one, passwords otherwise
+    async authFields() {
+        if (this.sessionToken) {
+            return { token: this.sessionToken, room: this.roomId }
+        }
+        return {
+            user: this.userId,
+            psw: await this.secureStorage.getPassword('turkuazz', 'userpsw'),
+            room: this.roomId,
+            roompsw: await this.secureStorage.getPassword('turkuazz', 'roompsw')
+        }
+    }
+
+    async postWithAuth(path, body, timeout) {
+        const response = await axios.post(`https://${this.serverEndpoint}${path}`, { ...(await this.authFields()), ...body }, { timeout })
+        if (this.sessionToken && response.data && response.data.error === 'Invalid token') {
+            this.sessionToken = null
+            return await this.postWithAuth(path, body, timeout)
+        }
+        return response.data
     }
 
     disconnect() {
@@ -161,8 +223,8 @@ class VideoSyncManager {
         return await this.client.updateUrl(url)
     }
 
-    async requestSync() {
-        return await this.client.requestSync()
+    async requestSync(ifChanged = false) {
+        return await this.client.requestSync(ifChanged)
     }
 
     async markUpToDate() {
@@ -175,22 +237,7 @@ class VideoSyncManager {
         }
 
         try {
-            const userPsw = await this.secureStorage.getPassword('turkuazz', 'userpsw')
-            const roomPsw = await this.secureStorage.getPassword('turkuazz', 'roompsw')
-
-            const response = await axios.post(
-                `https://${this.serverEndpoint}/subtitle/upload`,
-                {
-                    user: this.userId,
-                    psw: userPsw,
-                    room: this.roomId,
-                    roompsw: roomPsw,
-                    subtitle_data: base64Data,
-                    filename: filename
-                },
-                { timeout: 10000 }
-            )
-            return response.data
+            return await this.postWithAuth('/subtitle/upload', { subtitle_data: base64Data, filename: filename }, 10000)
         } catch (error) {
             this.logger.error('Failed to upload subtitle:', error.message)
             return { status: false, error: error.message }
@@ -203,17 +250,7 @@ class VideoSyncManager {
         }
 
         try {
-            const roomPsw = await this.secureStorage.getPassword('turkuazz', 'roompsw')
-
-            const response = await axios.post(
-                `https://${this.serverEndpoint}/subtitle/download`,
-                {
-                    room: this.roomId,
-                    roompsw: roomPsw
-                },
-                { timeout: 10000 }
-            )
-            return response.data
+            return await this.postWithAuth('/subtitle/download', {}, 10000)
         } catch (error) {
             this.logger.error('Failed to download subtitle:', error.message)
             return { status: false, error: error.message }
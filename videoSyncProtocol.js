@@ -9,15 +9,26 @@ const OP = {
     ACK: 0x06,
     UPTODATE: 0x07,
     SUBTITLE_FLAG: 0x08,
-    AUTH: 0x09
+    AUTH: 0x09,
+    AUTH_TOKEN: 0x0A,
+    PING: 0x0B,
+    PONG: 0x0C,
+    RATE: 0x0D,
+    BATCH: 0x0E
 }
 
 const ACK_SUCCESS = 1
 const ACK_FAIL = 0
 
 const MAX_TIME = 0xFFFFFFFF
+// v1: whole seconds. v2: millisecond positions with server timestamp and sequence,
+// the sequence is the room's state version and also trails URL, SUBTITLE_FLAG and update ACKs
+const PROTOCOL_VERSION = 2
 const MAX_URL_LENGTH = 2048
 const MAX_CRED_LENGTH = 255
+// BATCH limits, the server rejects bigger batches and AUTH/AUTH_TOKEN/BATCH sub-frames
+const MAX_BATCH_OPS = 16
+const BATCH_OPS_ALLOWED = new Set([OP.TIME, OP.STATE, OP.URL, OP.SYNC_REQ, OP.UPTODATE, OP.PING, OP.PONG])
 
 class VideoSyncClient {
     constructor(logger) {
@@ -32,14 +43,24 @@ class VideoSyncClient {
         }
         this.pendingRequests = new Map()
         this.requestId = 0
+        // negotiated in the auth ack, stays 1 against servers that don't know v2
+        this.version = 1
+        // room state version of the last applied frame (v2), null until the first INIT
+        this.stateVersion = null
         this.onStateChange = null
         this.onUrlChange = null
         this.onTimeChange = null
         this.onPlayingChange = null
         this.onSubtitleFlag = null
+        this.onRateChange = null
         this.onConnectionChange = null
         this.reconnectTimeout = null
         this.lastConnectionAttempt = 0
+        this.tokenRejected = false
+        // the first ACK on a socket answers the auth, later ones belong to requests
+        this.authenticated = false
+        // v2: frames sent in the same tick, they leave together as one BATCH
+        this.outbox = []
     }
 
     clampTime(time) {
@@ -47,13 +68,26 @@ class VideoSyncClient {
         return Math.min(Math.floor(time), MAX_TIME)
     }
 
+    // wire value for a position in seconds, milliseconds on v2
+    encodeTimeValue(time) {
+        if (this.version >= 2) {
+            if (typeof time !== 'number' || isNaN(time) || time < 0) return 0
+            return Math.min(Math.round(time * 1000), MAX_TIME)
+        }
+        return this.clampTime(time)
+    }
+
+    decodeTimeValue(value) {
+        return this.version >= 2 ? value / 1000 : value
+    }
+
 		// convert values to raw bytes for network transmission
     encodeTime(time, requestId = 0, timeoutPass = false) {
         const buf = Buffer.alloc(6) // 6 bytes
         buf.writeUInt8(OP.TIME, 0) // write opcode at byte 0
         // flags byte: bits 0-6 store requestId (max 127), bit 7 stores timeoutPass
         buf.writeUInt8((requestId & 0x7F) | (timeoutPass ? 0x80 : 0), 1) // write flags at byte 1
-        buf.writeUInt32BE(this.clampTime(time), 2) // write time at bytes 2-5
+        buf.writeUInt32BE(this.encodeTimeValue(time), 2) // write time at bytes 2-5
         return buf // [opcode:1B][flags:1B][time:4B] = 6 bytes
     }
 
@@ -63,7 +97,7 @@ class VideoSyncClient {
         buf.writeUInt8(OP.STATE, 0)
         buf.writeUInt8(requestId & 0x7F, 1)
         buf.writeUInt8(isPlaying ? 1 : 0, 2)
-        buf.writeUInt32BE(this.clampTime(time), 3)
+        buf.writeUInt32BE(this.encodeTimeValue(time), 3)
         return buf
     }
 
@@ -79,17 +113,64 @@ class VideoSyncClient {
         return buf
     }
 
-    encodeSyncReq(requestId = 0) {
-        const buf = Buffer.alloc(2)
-        buf.writeUInt8(OP.SYNC_REQ, 0)
+    // v2: seen is the last state version applied, sent as a trailing 4B seq
+    encodeSyncReq(requestId = 0, seen = null) {
+        return this.encodeVersioned(OP.SYNC_REQ, requestId, seen)
+    }
+
+    encodeUpToDate(requestId = 0, seen = null) {
+        return this.encodeVersioned(OP.UPTODATE, requestId, seen)
+    }
+
+    encodeVersioned(opcode, requestId, seen) {
+        const withSeen = this.version >= 2 && seen !== null
+        const buf = Buffer.alloc(withSeen ? 6 : 2)
+        buf.writeUInt8(opcode, 0)
         buf.writeUInt8(requestId & 0x7F, 1)
+        if (withSeen) buf.writeUInt32BE(seen, 2)
         return buf
     }
 
-    encodeUpToDate(requestId = 0) {
-        const buf = Buffer.alloc(2)
-        buf.writeUInt8(OP.UPTODATE, 0)
-        buf.writeUInt8(requestId & 0x7F, 1)
+    // true when seq is older than the version already applied, seq wraps at 32 bits
+    isStaleVersion(seq) {
+        if (this.stateVersion === null) return false
+        const diff = (this.stateVersion - seq) >>> 0
+        return diff !== 0 && diff < 0x80000000
+    }
+
+    // v2 only: several complete frames in one, each keeps its own opcode and request id
+    encodeBatch(frames, requestId = 0) {
+        const head = Buffer.alloc(3)
+        head.writeUInt8(OP.BATCH, 0)
+        head.writeUInt8(requestId & 0x7F, 1)
+        head.writeUInt8(frames.length, 2)
+        const parts = [head]
+        for (const frame of frames) {
+            const len = Buffer.alloc(2)
+            len.writeUInt16BE(frame.length, 0)
+            parts.push(len, frame)
+        }
+        return Buffer.concat(parts)
+    }
+
+    encodePong(echo, ts) {
+        // 18 bytes: 1B opcode, 1B flags, 8B echoed ping timestamp, 8B our timestamp ms
+        const buf = Buffer.alloc(18)
+        buf.writeUInt8(OP.PONG, 0)
+        buf.writeUInt8(0, 1)
+        buf.writeBigUInt64BE(BigInt(echo), 2)
+        buf.writeBigUInt64BE(BigInt(ts), 10)
+        return buf
+    }
+
+    // AUTH_TOKEN: 1B op, 2B tokenLen, nB token, 1B version
+    encodeAuthToken(token) {
+        const tokenBuf = Buffer.from(token, 'ascii')
+        const buf = Buffer.alloc(4 + tokenBuf.length)
+        buf.writeUInt8(OP.AUTH_TOKEN, 0)
+        buf.writeUInt16BE(tokenBuf.length, 1)
+        tokenBuf.copy(buf, 3)
+        buf.writeUInt8(PROTOCOL_VERSION, 3 + tokenBuf.length)
         return buf
     }
 
@@ -98,8 +179,8 @@ class VideoSyncClient {
         const pswBuf = Buffer.from(userPsw.slice(0, MAX_CRED_LENGTH), 'utf8')
         const roomBuf = Buffer.from(roomId.slice(0, MAX_CRED_LENGTH), 'utf8')
         const roomPswBuf = Buffer.from(roomPsw.slice(0, MAX_CRED_LENGTH), 'utf8')
-        // AUTH: 1B op, 1B userLen, nB user, 1B pswLen, nB psw, 1B roomLen, nB room, 1B roomPswLen, nB roomPsw
-        const totalLen = 1 + 1 + userBuf.length + 1 + pswBuf.length + 1 + roomBuf.length + 1 + roomPswBuf.length
+        // AUTH: 1B op, 1B userLen, nB user, 1B pswLen, nB psw, 1B roomLen, nB room, 1B roomPswLen, nB roomPsw, 1B version
+        const totalLen = 1 + 1 + userBuf.length + 1 + pswBuf.length + 1 + roomBuf.length + 1 + roomPswBuf.length + 1
         const buf = Buffer.alloc(totalLen)
         let offset = 0
         buf.writeUInt8(OP.AUTH, offset++)
@@ -110,7 +191,8 @@ class VideoSyncClient {
         buf.writeUInt8(roomBuf.length, offset++)
         roomBuf.copy(buf, offset); offset += roomBuf.length
         buf.writeUInt8(roomPswBuf.length, offset++)
-        roomPswBuf.copy(buf, offset)
+        roomPswBuf.copy(buf, offset); offset += roomPswBuf.length
+        buf.writeUInt8(PROTOCOL_VERSION, offset)
         return buf
     }
 
@@ -131,48 +213,72 @@ class VideoSyncClient {
         switch (opcode) {
             case OP.TIME: {
                 if (data.length < 6) return null // need 6 bytes for TIME
-                return {
+                const msg = {
                     type: 'time',
                     requestId,
-                    time: data.readUInt32BE(2), // read time at bytes 2-5
+                    time: this.decodeTimeValue(data.readUInt32BE(2)), // read time at bytes 2-5
                     passive
                 }
+                if (this.version >= 2 && data.length >= 18) {
+                    // v2: 8B server timestamp ms, 4B sequence
+                    msg.serverTs = Number(data.readBigUInt64BE(6))
+                    msg.seq = data.readUInt32BE(14)
+                }
+                return msg
             }
             case OP.STATE: {
                 if (data.length < 7) return null
-                return {
+                const msg = {
                     type: 'state',
                     requestId,
                     isPlaying: data.readUInt8(2) === 1,
-                    time: data.readUInt32BE(3)
+                    time: this.decodeTimeValue(data.readUInt32BE(3))
                 }
+                if (this.version >= 2 && data.length >= 19) {
+                    msg.serverTs = Number(data.readBigUInt64BE(7))
+                    msg.seq = data.readUInt32BE(15)
+                }
+                return msg
             }
             case OP.URL: {
                 if (data.length < 4) return null
                 const urlLen = data.readUInt16BE(2)
                 if (data.length < 4 + urlLen) return null
-                return {
+                const msg = {
                     type: 'url',
                     requestId,
                     url: data.slice(4, 4 + urlLen).toString('utf8')
                 }
+                if (this.version >= 2 && data.length >= 8 + urlLen) {
+                    msg.seq = data.readUInt32BE(4 + urlLen)
+                }
+                return msg
             }
             case OP.INIT: {
                 if (data.length < 8) return null
                 const urlLen = data.readUInt16BE(2)
                 if (data.length < 10 + urlLen) return null
-                return {
+                const msg = {
                     type: 'init',
                     requestId,
                     url: data.slice(4, 4 + urlLen).toString('utf8'),
-                    time: data.readUInt32BE(4 + urlLen),
+                    time: this.decodeTimeValue(data.readUInt32BE(4 + urlLen)),
                     isPlaying: data.readUInt8(8 + urlLen) === 1,
                     subtitleExist: data.readUInt8(9 + urlLen) === 1
                 }
+                if (this.version >= 2 && data.length >= 22 + urlLen) {
+                    msg.serverTs = Number(data.readBigUInt64BE(10 + urlLen))
+                    msg.seq = data.readUInt32BE(18 + urlLen)
+                }
+                return msg
             }
             case OP.ACK: {
                 if (data.length < 3) return null
                 const success = data.readUInt8(2) === ACK_SUCCESS
+                if (success && data.length === 7) {
+                    // v2 ack of an update or an unchanged sync, carries the state version
+                    return { type: 'ack', requestId, success, error: null, version: null, seq: data.readUInt32BE(3) }
+                }
                 let error = null
                 if (data.length > 3) {
                     const errLen = data.readUInt8(3)
@@ -184,23 +290,63 @@ class VideoSyncClient {
                     type: 'ack',
                     requestId,
                     success,
-                    error
+                    error,
+                    // only the auth ack of a versioned handshake is exactly 4 bytes
+                    version: success && data.length === 4 ? data.readUInt8(3) : null
                 }
             }
-            case OP.SUBTITLE_FLAG: {
+            case OP.PING: {
+                if (data.length < 10) return null
+                return {
+                    type: 'ping',
+                    requestId,
+                    ts: data.readBigUInt64BE(2)
+                }
+            }
+            case OP.BATCH: {
                 if (data.length < 3) return null
+                const frames = []
+                let offset = 3
+                for (let i = 0; i < data.readUInt8(2); i++) {
+                    if (data.length < offset + 2) return null
+                    const len = data.readUInt16BE(offset)
+                    offset += 2
+                    if (data.length < offset + len) return null
+                    frames.push(data.slice(offset, offset + len))
+                    offset += len
+                }
+                return { type: 'batch', requestId, frames }
+            }
+            case OP.RATE: {
+                if (data.length < 8) return null
+                // 2B rate in thousandths, 4B duration ms
                 return {
+                    type: 'rate',
+                    requestId,
+                    rate: data.readUInt16BE(2) / 1000,
+                    durationMs: data.readUInt32BE(4)
+                }
+            }
+            case OP.SUBTITLE_FLAG: {
+                if (data.length < 3) return null
+                const msg = {
                     type: 'subtitle_flag',
                     requestId,
                     exists: data.readUInt8(2) === 1
                 }
+                if (this.version >= 2 && data.length >= 7) {
+                    msg.seq = data.readUInt32BE(3)
+                }
+                return msg
             }
             default:
                 return null
         }
     }
 
-    async connect(serverEndpoint, user, userPsw, roomId, roomPsw) {
+    // with a session token the password fields are not sent, tokenRejected tells the caller
+    // to fall back to a password login
+    async connect(serverEndpoint, user, userPsw, roomId, roomPsw, token = null) {
         if (this.ws && this.ws.readyState === WebSocket.OPEN) {
             return true
         }
@@ -224,21 +370,28 @@ class VideoSyncClient {
                 this.ws.binaryType = 'nodebuffer'
 
                 this.ws.on('open', () => {
+                    this.version = 1
+                    this.stateVersion = null
+                    this.authenticated = false
                     this.logger.info('VideoSync WebSocket connected, sending auth...')
-                    const authMsg = this.encodeAuth(user, userPsw, roomId, roomPsw)
+                    this.tokenRejected = false
+                    const authMsg = token ? this.encodeAuthToken(token) : this.encodeAuth(user, userPsw, roomId, roomPsw)
                     this.ws.send(authMsg)
                 })
 
                 this.ws.on('message', (data) => {
                     const msg = this.decodeMessage(data)
-                    if (msg && msg.type === 'ack' && !this.state.isUpToDate) {
+                    if (msg && msg.type === 'ack' && !this.authenticated) {
                         if (msg.success) {
-                            this.logger.info('VideoSync auth successful')
+                            this.authenticated = true
+                            this.version = msg.version || 1
+                            this.logger.info(`VideoSync auth successful, protocol v${this.version}`)
                             this.state.isUpToDate = false
                             if (this.onConnectionChange) this.onConnectionChange(true)
                             resolve(true)
                         } else {
                             this.logger.error('VideoSync auth failed:', msg.error)
+                            if (token) this.tokenRejected = true
                             this.ws.close()
                             resolve(false)
                         }
@@ -251,6 +404,7 @@ class VideoSyncClient {
                     this.logger.warn('VideoSync WebSocket disconnected')
                     this.clearPendingRequests('Connection closed')
                     this.ws = null
+                    this.authenticated = false
                     this.state.isUpToDate = false
                     if (this.onConnectionChange) this.onConnectionChange(false)
                 })
@@ -269,6 +423,7 @@ class VideoSyncClient {
     }
 
     disconnect() {
+        this.outbox = []
         this.clearPendingRequests('Disconnecting')
         if (this.ws) {
             try { this.ws.close() } catch {}
@@ -292,6 +447,30 @@ class VideoSyncClient {
             return
         }
 
+        if (msg.type === 'batch') {
+            // sub-frames are handled in order as if they arrived alone
+            for (const frame of msg.frames) {
+                this.handleMessage(frame)
+            }
+            return
+        }
+
+        if (msg.type === 'ping') {
+            // answered immediately, the server measures rtt and clock offset from it
+            try { this.ws.send(this.encodePong(msg.ts, Date.now())) } catch {}
+            return
+        }
+
+        if (msg.seq !== undefined) {
+            if (msg.type === 'init' || !this.isStaleVersion(msg.seq)) {
+                this.stateVersion = msg.seq
+            } else if (msg.type !== 'ack') {
+                // crossed in flight with something newer that was already applied
+                this.logger.debug(`Dropping stale ${msg.type} v${msg.seq}, have v${this.stateVersion}`)
+                return
+            }
+        }
+
         if (msg.requestId && this.pendingRequests.has(msg.requestId)) {
             const { resolve } = this.pendingRequests.get(msg.requestId)
             this.pendingRequests.delete(msg.requestId)
@@ -336,6 +515,9 @@ class VideoSyncClient {
                 this.state.isUpToDate = false
                 if (this.onPlayingChange) this.onPlayingChange(msg.isPlaying, msg.time)
                 break
+            case 'rate':
+                if (this.onRateChange) this.onRateChange(msg.rate, msg.durationMs)
+                break
             case 'subtitle_flag':
                 this.state.subtitleExist = msg.exists
                 if (this.onSubtitleFlag) this.onSubtitleFlag(msg.exists)
@@ -353,7 +535,7 @@ class VideoSyncClient {
         buffer.writeUInt8((buffer.readUInt8(1) & 0x80) | requestId, 1)
 
         if (!expectAck) {
-            this.ws.send(buffer)
+            this.transmit(buffer)
             return { success: true }
         }
 
@@ -373,7 +555,7 @@ class VideoSyncClient {
             }, 2000)
 
             try {
-                this.ws.send(buffer)
+                this.transmit(buffer)
             } catch (err) {
                 this.pendingRequests.delete(requestId)
                 resolve({ success: false, error: err.message })
@@ -381,6 +563,40 @@ class VideoSyncClient {
         })
     }
 
+    // v1 or ops the server won't take in a BATCH go out at once, the rest wait for the
+    // end of the tick so e.g. an UPTODATE and a TIME sent back to back share one frame
+    transmit(buffer) {
+        if (this.version < 2 || !BATCH_OPS_ALLOWED.has(buffer[0])) {
+            this.ws.send(buffer)
+            return
+        }
+        this.outbox.push(buffer)
+        if (this.outbox.length === 1) {
+            setImmediate(() => this.flushOutbox())
+        }
+    }
+
+    flushOutbox() {
+        const frames = this.outbox
+        this.outbox = []
+        for (let i = 0; i < frames.length; i += MAX_BATCH_OPS) {
+            const chunk = frames.slice(i, i + MAX_BATCH_OPS)
+            try {
+                if (!this.ws || this.ws.readyState !== WebSocket.OPEN) throw new Error('Not connected')
+                // each sub-frame keeps its request id, the replies come back as a BATCH too
+                this.ws.send(chunk.length === 1 ? chunk[0] : this.encodeBatch(chunk))
+            } catch (err) {
+                for (const frame of chunk) {
+                    const pending = this.pendingRequests.get(frame[1] & 0x7F)
+                    if (pending) {
+                        this.pendingRequests.delete(frame[1] & 0x7F)
+                        pending.resolve({ success: false, error: err.message })
+                    }
+                }
+            }
+        }
+    }
+
     async updateTime(time, timeoutPass = false) {
         const buf = this.encodeTime(time, 0, timeoutPass)
         const result = await this.send(buf)
@@ -415,13 +631,20 @@ class VideoSyncClient {
         return result
     }
 
-    async requestSync() {
-        const buf = this.encodeSyncReq()
-        return await this.send(buf)
+    // ifChanged: a server that sees we already have its version answers with an ACK
+    // (result.unchanged) instead of a full INIT
+    async requestSync(ifChanged = false) {
+        const buf = this.encodeSyncReq(0, ifChanged ? this.stateVersion : null)
+        const result = await this.send(buf)
+        if (result && result.type === 'ack' && result.seq !== undefined) {
+            result.unchanged = true
+        }
+        return result
     }
 
     async markUpToDate() {
-        const buf = this.encodeUpToDate()
+        // the server compares the version to its own and resends what we missed
+        const buf = this.encodeUpToDate(0, this.stateVersion)
         const result = await this.send(buf, false)
         if (result.success) {
             this.state.isUpToDate = true
@@ -438,4 +661,4 @@ class VideoSyncClient {
     }
 }
 
-module.exports = { VideoSyncClient, OP, ACK_SUCCESS, ACK_FAIL }
+module.exports = { VideoSyncClient, OP, ACK_SUCCESS, ACK_FAIL, PROTOCOL_VERSION }